@@ -0,0 +1,185 @@
+from collections import Counter
+import threading
+import time
+
+
+class ControleAdmissao:
+    """Controle de admissão de conexões no servidor: limites de capacidade e ritmo de entrada
+
+    Conexões acima dos limites são descartadas antes de qualquer estado de sessão ser
+    criado. O ritmo é um balde de fichas; conexões recusadas recebem um horário de
+    retorno numa fila virtual, de modo que clientes recusados ao mesmo tempo voltem
+    espaçados em vez de todos juntos.
+    """
+
+    def __init__(
+        self,
+        taxa=50.0,
+        rajada=100,
+        espera_max=60.0,
+        max_conexoes=10000,
+        max_por_ip=64,
+        max_por_sala=5000,
+        max_handshakes=256,
+        tempo_handshake=10.0,
+    ):
+        """Inicializa o controle
+
+        Args:
+            taxa: Conexões admitidas por segundo em regime contínuo
+            rajada: Conexões que podem ser admitidas de uma só vez
+            espera_max: Maior espera, em segundos, sugerida a um cliente recusado
+            max_conexoes: Total de conexões simultâneas
+            max_por_ip: Conexões simultâneas de um mesmo endereço IP
+            max_por_sala: Membros de uma mesma sala
+            max_handshakes: Conexões aguardando a conclusão do handshake
+            tempo_handshake: Segundos que um cliente tem para concluir o handshake
+        """
+        self.taxa = taxa
+        self.rajada = rajada
+        self.espera_max = espera_max
+        self.max_conexoes = max_conexoes
+        self.max_por_ip = max_por_ip
+        self.max_por_sala = max_por_sala
+        self.max_handshakes = max_handshakes
+        self.tempo_handshake = tempo_handshake
+        self.fichas = float(rajada)
+        self.ultimo = time.monotonic()
+        self.proximo_horario = self.ultimo
+        self.conexoes = 0
+        self.conexoes_por_ip = {}
+        self.handshakes = 0
+        self.descartes = Counter()
+        self.lock = threading.Lock()
+
+    def admitir(self, addr):
+        """Decide se uma nova conexão pode ser admitida agora
+
+        Uma conexão admitida passa a contar como conexão ativa e como handshake
+        pendente, até liberar e concluir_handshake serem chamados.
+
+        Args:
+            addr: Endereço do cliente
+
+        Returns:
+            float: None se a conexão foi admitida, ou os segundos que o cliente deve aguardar
+        """
+        ip = obter_ip(addr)
+        with self.lock:
+            agora = time.monotonic()
+            if self.conexoes >= self.max_conexoes:
+                motivo = 'conexoes'
+            elif self.handshakes >= self.max_handshakes:
+                motivo = 'handshakes'
+            elif self.conexoes_por_ip.get(ip, 0) >= self.max_por_ip:
+                motivo = 'ip'
+            else:
+                self.fichas = min(
+                    self.rajada,
+                    self.fichas + (agora - self.ultimo) * self.taxa,
+                )
+                self.ultimo = agora
+                if self.fichas >= 1:
+                    self.fichas -= 1
+                    self.conexoes += 1
+                    self.conexoes_por_ip[ip] = (
+                        self.conexoes_por_ip.get(ip, 0) + 1
+                    )
+                    self.handshakes += 1
+                    return None
+                motivo = 'taxa'
+
+            self.descartes[motivo] += 1
+            return self.agendar_retorno(agora)
+
+    def admitir_na_sala(self, membros):
+        """Decide se uma sala com a quantidade de membros informada aceita mais um
+
+        Args:
+            membros: Quantidade atual de membros da sala
+
+        Returns:
+            bool: True se há vaga na sala
+        """
+        if membros < self.max_por_sala:
+            return True
+        with self.lock:
+            self.descartes['sala'] += 1
+        return False
+
+    def sugerir_espera(self):
+        """Reserva um horário de retorno para um cliente recusado fora do accept, como em salas lotadas
+
+        Returns:
+            float: Segundos que o cliente deve aguardar
+        """
+        with self.lock:
+            return self.agendar_retorno(time.monotonic())
+
+    def agendar_retorno(self, agora):
+        """Reserva o próximo horário livre da fila virtual de retorno
+
+        Args:
+            agora: Instante atual do relógio monotônico
+
+        Returns:
+            float: Segundos até o horário reservado
+        """
+        self.proximo_horario = min(
+            max(self.proximo_horario, agora) + 1 / self.taxa,
+            agora + self.espera_max,
+        )
+        return self.proximo_horario - agora
+
+    def concluir_handshake(self):
+        """Registra que uma conexão admitida concluiu (ou abandonou) o handshake"""
+        with self.lock:
+            self.handshakes -= 1
+
+    def liberar(self, addr):
+        """Registra o encerramento de uma conexão admitida
+
+        Args:
+            addr: Endereço do cliente
+        """
+        ip = obter_ip(addr)
+        with self.lock:
+            self.conexoes -= 1
+            restantes = self.conexoes_por_ip.get(ip, 0) - 1
+            if restantes > 0:
+                self.conexoes_por_ip[ip] = restantes
+            else:
+                self.conexoes_por_ip.pop(ip, None)
+
+    @property
+    def total_descartes(self):
+        """Total de conexões descartadas desde o início do servidor"""
+        return sum(self.descartes.values())
+
+    def estatisticas(self):
+        """Retorna um resumo do estado da admissão
+
+        Returns:
+            dict: Conexões ativas, handshakes pendentes e descartes por motivo
+        """
+        with self.lock:
+            return {
+                'conexoes': self.conexoes,
+                'handshakes': self.handshakes,
+                'descartes': dict(self.descartes),
+                'total_descartes': sum(self.descartes.values()),
+            }
+
+
+def obter_ip(addr):
+    """Extrai o IP do endereço de um cliente
+
+    Args:
+        addr: Endereço retornado por accept
+
+    Returns:
+        str: IP do cliente, ou string vazia para endereços sem IP
+    """
+    if isinstance(addr, tuple) and addr:
+        return addr[0]
+    return ''
@@ -0,0 +1,530 @@
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+from protocolo import (
+    SOLICITACAO_SALA,
+    ler_tente_novamente,
+    resolver_endereco,
+)
+
+MARCADOR_ENVIAR = '#ANEXO_ENVIAR#'
+MARCADOR_BAIXAR = '#ANEXO_BAIXAR#'
+MARCADOR_ANUNCIO = '#ANEXO#'
+TAMANHO_BLOCO = 64 * 1024
+TAMANHO_MAX_CABECALHO = 4096
+TAMANHO_MAX_ANEXO = 1 << 30
+COTA_POR_USUARIO = 2 << 30
+RETENCAO_ANEXOS = 7 * 24 * 3600
+PRAZO_PARCIAL = 24 * 3600
+INTERVALO_LIMPEZA = 3600
+PADRAO_ID = re.compile(r'[0-9a-f]{32}')
+PADRAO_ANUNCIO = re.compile(re.escape(MARCADOR_ANUNCIO) + r'([0-9a-f]{32})')
+
+
+class ErroAnexo(Exception):
+    """Erro de protocolo ou de armazenamento durante a transferência de um anexo"""
+
+
+def novo_id():
+    """Gera um ID para um novo anexo
+
+    Returns:
+        str: ID hexadecimal de 32 caracteres
+    """
+    return uuid.uuid4().hex
+
+
+def validar_id(id_anexo):
+    """Verifica se o ID tem o formato esperado, impedindo caminhos arbitrários no disco
+
+    Args:
+        id_anexo: ID recebido pela rede
+
+    Returns:
+        str: O próprio ID, se válido
+    """
+    if not isinstance(id_anexo, str) or not PADRAO_ID.fullmatch(id_anexo):
+        raise ErroAnexo(f'ID de anexo inválido: {id_anexo!r}')
+    return id_anexo
+
+
+def priorizar_como_transferencia(sock):
+    """Marca o socket do canal de anexos como tráfego de volume, abaixo do chat
+
+    Args:
+        sock: Socket do canal lateral
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, 0x08)
+    except (AttributeError, OSError):
+        pass
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, 0)
+    except (AttributeError, OSError):
+        pass
+
+
+def ler_linha(sock):
+    """Lê uma linha de cabeçalho terminada em \\n sem consumir bytes além dela
+
+    Args:
+        sock: Socket de origem
+
+    Returns:
+        str: Linha decodificada, sem o terminador
+    """
+    dados = bytearray()
+    while not dados.endswith(b'\n'):
+        if len(dados) > TAMANHO_MAX_CABECALHO:
+            raise ErroAnexo('Cabeçalho de anexo muito grande')
+        byte = sock.recv(1)
+        if not byte:
+            raise ErroAnexo('Conexão encerrada durante o cabeçalho')
+        dados += byte
+    return dados[:-1].decode()
+
+
+def montar_cabecalho(marcador, dados):
+    """Monta a linha de cabeçalho de uma transferência
+
+    Args:
+        marcador: MARCADOR_ENVIAR ou MARCADOR_BAIXAR
+        dados: Dicionário com os campos do cabeçalho
+
+    Returns:
+        bytes: Linha pronta para envio
+    """
+    return f'{marcador}{json.dumps(dados)}\n'.encode()
+
+
+def ler_cabecalho(linha, marcador):
+    """Extrai os campos de uma linha de cabeçalho
+
+    Args:
+        linha: Linha recebida, incluindo o marcador
+        marcador: Marcador esperado no início da linha
+
+    Returns:
+        dict: Campos do cabeçalho
+    """
+    try:
+        dados = json.loads(linha[len(marcador) :])
+    except ValueError:
+        raise ErroAnexo('Cabeçalho de anexo malformado')
+    if not isinstance(dados, dict):
+        raise ErroAnexo('Cabeçalho de anexo malformado')
+    return dados
+
+
+def enviar_arquivo(sock, caminho, offset):
+    """Transmite um arquivo a partir de um deslocamento, direto do disco para o socket
+
+    Args:
+        sock: Socket de destino
+        caminho: Caminho do arquivo
+        offset: Posição inicial da transmissão
+
+    Returns:
+        int: Quantidade de bytes enviados
+    """
+    with open(caminho, 'rb') as arquivo:
+        return sock.sendfile(arquivo, offset)
+
+
+def receber_arquivo(sock, caminho, restante, progresso=None):
+    """Recebe bytes do socket e os acrescenta ao final de um arquivo
+
+    Args:
+        sock: Socket de origem
+        caminho: Caminho do arquivo parcial
+        restante: Quantidade de bytes que ainda faltam
+        progresso: Função opcional chamada com o total de bytes recebidos
+
+    Returns:
+        int: Quantidade de bytes recebidos
+    """
+    buffer = bytearray(TAMANHO_BLOCO)
+    visao = memoryview(buffer)
+    recebido = 0
+    with open(caminho, 'ab') as arquivo:
+        while recebido < restante:
+            n = sock.recv_into(visao, min(TAMANHO_BLOCO, restante - recebido))
+            if not n:
+                break
+            arquivo.write(visao[:n])
+            recebido += n
+            if progresso:
+                progresso(recebido)
+    return recebido
+
+
+class RepositorioAnexos:
+    """Armazena os anexos recebidos pelo servidor, incluindo transferências parciais
+
+    Cada ID aceita um envio por vez: dois envios simultâneos acrescentariam bytes
+    intercalados ao mesmo arquivo parcial. Cada usuário tem uma cota para a soma dos
+    tamanhos dos seus anexos, e uma thread apaga os anexos completos mais antigos que
+    a retenção e os envios parciais abandonados.
+    """
+
+    def __init__(
+        self,
+        pasta,
+        cota=COTA_POR_USUARIO,
+        retencao=RETENCAO_ANEXOS,
+        prazo_parcial=PRAZO_PARCIAL,
+        intervalo=INTERVALO_LIMPEZA,
+    ):
+        """Inicializa o repositório
+
+        Args:
+            pasta: Diretório onde os anexos são gravados
+            cota: Bytes que os anexos guardados de um usuário podem somar
+            retencao: Segundos que um anexo completo fica guardado
+            prazo_parcial: Segundos sem progresso após os quais um envio parcial é descartado
+            intervalo: Segundos entre limpezas
+        """
+        self.pasta = pasta
+        self.cota = cota
+        self.retencao = retencao
+        self.prazo_parcial = prazo_parcial
+        self.intervalo = intervalo
+        self.em_recebimento = set()
+        # Bytes de anexos guardados por dono; refeito a cada limpeza
+        self.uso = {}
+        self.lock = threading.Lock()
+        self.parar_limpeza = threading.Event()
+        self.thread_limpeza = None
+
+    def caminho(self, id_anexo):
+        """Retorna o caminho do anexo completo"""
+        return os.path.join(self.pasta, validar_id(id_anexo))
+
+    def caminho_parcial(self, id_anexo):
+        """Retorna o caminho do anexo ainda em recebimento"""
+        return self.caminho(id_anexo) + '.parte'
+
+    def caminho_meta(self, id_anexo):
+        """Retorna o caminho dos metadados do anexo"""
+        return self.caminho(id_anexo) + '.json'
+
+    def iniciar_recebimento(self, id_anexo, arquivo, tamanho, dono):
+        """Prepara o recebimento de um anexo, retomando uma transferência anterior se existir
+
+        O ID fica reservado até encerrar_recebimento; um segundo envio do mesmo ID
+        enquanto isso é recusado. Só o dono retoma um envio, e um anexo novo precisa
+        caber na cota dele.
+
+        Args:
+            id_anexo: ID do anexo
+            arquivo: Nome original do arquivo
+            tamanho: Tamanho total em bytes
+            dono: Nome do usuário que envia
+
+        Returns:
+            int: Deslocamento a partir do qual o cliente deve enviar
+        """
+        if not 0 <= tamanho <= TAMANHO_MAX_ANEXO:
+            raise ErroAnexo('Tamanho de anexo fora do limite permitido')
+
+        with self.lock:
+            if id_anexo in self.em_recebimento:
+                raise ErroAnexo(
+                    'Anexo já está sendo enviado por outra conexão'
+                )
+            self.em_recebimento.add(id_anexo)
+        try:
+            return self.preparar_parcial(id_anexo, arquivo, tamanho, dono)
+        except:
+            self.encerrar_recebimento(id_anexo)
+            raise
+
+    def preparar_parcial(self, id_anexo, arquivo, tamanho, dono):
+        """Registra os metadados do anexo e retorna quanto do arquivo parcial já existe"""
+        os.makedirs(self.pasta, exist_ok=True)
+        meta = self.carregar_meta(id_anexo)
+        if meta is not None:
+            if meta.get('dono') != dono:
+                raise ErroAnexo('Anexo registrado por outro usuário')
+            if meta['tamanho'] != tamanho:
+                raise ErroAnexo('Tamanho divergente do anexo já registrado')
+            if os.path.exists(self.caminho(id_anexo)):
+                return tamanho
+        else:
+            with self.lock:
+                if self.uso.get(dono, 0) + tamanho > self.cota:
+                    raise ErroAnexo('Cota de anexos do usuário esgotada')
+                with open(self.caminho_meta(id_anexo), 'w') as arquivo_meta:
+                    json.dump(
+                        {
+                            'arquivo': os.path.basename(arquivo),
+                            'tamanho': tamanho,
+                            'dono': dono,
+                        },
+                        arquivo_meta,
+                    )
+                self.uso[dono] = self.uso.get(dono, 0) + tamanho
+
+        parcial = self.caminho_parcial(id_anexo)
+        with open(parcial, 'ab'):
+            pass
+        return min(os.path.getsize(parcial), tamanho)
+
+    def encerrar_recebimento(self, id_anexo):
+        """Libera o ID reservado por iniciar_recebimento
+
+        Args:
+            id_anexo: ID do anexo
+        """
+        with self.lock:
+            self.em_recebimento.discard(id_anexo)
+
+    def concluir(self, id_anexo):
+        """Marca o anexo como completo caso todos os bytes tenham chegado
+
+        Args:
+            id_anexo: ID do anexo
+
+        Returns:
+            bool: True se o anexo está completo
+        """
+        meta = self.carregar_meta(id_anexo)
+        parcial = self.caminho_parcial(id_anexo)
+        if meta is None or not os.path.exists(parcial):
+            return False
+        if os.path.getsize(parcial) != meta['tamanho']:
+            return False
+        os.replace(parcial, self.caminho(id_anexo))
+        return True
+
+    def carregar_meta(self, id_anexo):
+        """Carrega os metadados de um anexo
+
+        Args:
+            id_anexo: ID do anexo
+
+        Returns:
+            dict: Metadados com nome e tamanho, ou None se o anexo não existe
+        """
+        try:
+            with open(self.caminho_meta(id_anexo)) as arquivo_meta:
+                return json.load(arquivo_meta)
+        except (OSError, ValueError):
+            return None
+
+    def apagar(self, id_anexo):
+        """Remove o anexo, o arquivo parcial e os metadados, ignorando os que faltam"""
+        for caminho in (
+            self.caminho(id_anexo),
+            self.caminho_parcial(id_anexo),
+            self.caminho_meta(id_anexo),
+        ):
+            try:
+                os.remove(caminho)
+            except FileNotFoundError:
+                pass
+
+    def limpar(self, agora=None):
+        """Apaga os anexos vencidos e refaz a contagem de uso de cada dono
+
+        Um anexo completo vence pela retenção, contada da conclusão; um envio parcial,
+        pelo prazo sem receber bytes. Envios em andamento não são tocados.
+
+        Args:
+            agora: Horário Unix de referência; por padrão, o atual
+
+        Returns:
+            int: Quantidade de anexos apagados
+        """
+        if agora is None:
+            agora = time.time()
+        apagados = 0
+        uso = {}
+        with self.lock:
+            try:
+                nomes = os.listdir(self.pasta)
+            except FileNotFoundError:
+                nomes = []
+            for nome in nomes:
+                id_anexo = nome[: -len('.json')]
+                if not nome.endswith('.json'):
+                    continue
+                if not PADRAO_ID.fullmatch(id_anexo):
+                    continue
+                meta = self.carregar_meta(id_anexo)
+                if meta is None:
+                    continue
+                if id_anexo not in self.em_recebimento and self.vencido(
+                    id_anexo, agora
+                ):
+                    self.apagar(id_anexo)
+                    apagados += 1
+                    continue
+                dono = meta.get('dono')
+                uso[dono] = uso.get(dono, 0) + meta['tamanho']
+            self.uso = uso
+        return apagados
+
+    def vencido(self, id_anexo, agora):
+        """Indica se o anexo passou da retenção ou, se incompleto, do prazo parcial"""
+        referencia, prazo = self.caminho(id_anexo), self.retencao
+        if not os.path.exists(referencia):
+            referencia = self.caminho_parcial(id_anexo)
+            prazo = self.prazo_parcial
+            if not os.path.exists(referencia):
+                referencia = self.caminho_meta(id_anexo)
+        try:
+            return agora - os.path.getmtime(referencia) > prazo
+        except OSError:
+            return False
+
+    def executar_limpeza(self):
+        """Loop da thread de limpeza"""
+        while not self.parar_limpeza.wait(self.intervalo):
+            try:
+                self.limpar()
+            except OSError:
+                pass
+
+    def iniciar(self):
+        """Cria a pasta dos anexos, conta o uso de cada dono e inicia a thread de limpeza"""
+        if self.thread_limpeza is not None:
+            return
+        os.makedirs(self.pasta, exist_ok=True)
+        self.limpar()
+        self.parar_limpeza.clear()
+        self.thread_limpeza = threading.Thread(
+            target=self.executar_limpeza, daemon=True
+        )
+        self.thread_limpeza.start()
+
+    def parar(self):
+        """Encerra a thread de limpeza"""
+        if self.thread_limpeza is None:
+            return
+        self.parar_limpeza.set()
+        self.thread_limpeza.join()
+        self.thread_limpeza = None
+
+
+def conectar_canal(host, port):
+    """Abre o canal lateral de anexos e conclui o handshake inicial do servidor
+
+    Args:
+        host: Endereço do servidor, ou unix: seguido do caminho do socket
+        port: Porta do servidor
+
+    Returns:
+        socket.socket: Socket pronto para receber o cabeçalho da transferência
+    """
+    familia, tipo, proto, endereco = resolver_endereco(host, port)
+    sock = socket.socket(familia, tipo, proto)
+    sock.settimeout(10)
+    try:
+        sock.connect(endereco)
+    except OSError:
+        sock.close()
+        raise
+    priorizar_como_transferencia(sock)
+    linha = ler_linha(sock)
+    if linha != SOLICITACAO_SALA:
+        sock.close()
+        tentar_apos = ler_tente_novamente(linha)
+        if tentar_apos is not None:
+            raise ErroAnexo(
+                f'Servidor ocupado, tente novamente em {tentar_apos:.1f}s'
+            )
+        raise ErroAnexo('Resposta inesperada do servidor')
+    return sock
+
+
+def enviar_anexo(host, port, caminho, token, id_anexo, progresso=None):
+    """Envia um arquivo ao servidor pelo canal lateral, retomando de onde parou
+
+    O anexo é anunciado na sala e com o nome da sessão de chat dona do token, que
+    precisa estar conectada durante o envio.
+
+    Args:
+        host: Endereço do servidor
+        port: Porta do servidor
+        caminho: Caminho local do arquivo
+        token: Token da sessão de chat ativa
+        id_anexo: ID do anexo; reutilize o mesmo ID para retomar um envio interrompido
+        progresso: Função opcional chamada com (enviado, total)
+
+    Returns:
+        int: Tamanho total do anexo
+    """
+    tamanho = os.path.getsize(caminho)
+    with conectar_canal(host, port) as sock:
+        sock.sendall(
+            montar_cabecalho(
+                MARCADOR_ENVIAR,
+                {
+                    'id': id_anexo,
+                    'token': token,
+                    'arquivo': os.path.basename(caminho),
+                    'tamanho': tamanho,
+                },
+            )
+        )
+        resposta = ler_linha(sock)
+        if not resposta.isdigit():
+            raise ErroAnexo(resposta)
+
+        offset = int(resposta)
+        if offset < tamanho:
+            sock.settimeout(None)
+            enviar_arquivo(sock, caminho, offset)
+        if ler_linha(sock) != 'OK':
+            raise ErroAnexo('Servidor não confirmou o recebimento do anexo')
+        if progresso:
+            progresso(tamanho, tamanho)
+    return tamanho
+
+
+def baixar_anexo(host, port, id_anexo, destino, progresso=None):
+    """Baixa um anexo do servidor, retomando a partir de um arquivo parcial existente
+
+    Args:
+        host: Endereço do servidor
+        port: Porta do servidor
+        id_anexo: ID do anexo
+        destino: Caminho local onde o anexo será salvo
+        progresso: Função opcional chamada com (recebido, total)
+
+    Returns:
+        int: Tamanho total do anexo
+    """
+    parcial = destino + '.parte'
+    offset = os.path.getsize(parcial) if os.path.exists(parcial) else 0
+    with conectar_canal(host, port) as sock:
+        sock.sendall(
+            montar_cabecalho(
+                MARCADOR_BAIXAR, {'id': validar_id(id_anexo), 'offset': offset}
+            )
+        )
+        resposta = ler_linha(sock)
+        if not resposta.isdigit():
+            raise ErroAnexo(resposta)
+
+        tamanho = int(resposta)
+        sock.settimeout(None)
+        receber_arquivo(
+            sock,
+            parcial,
+            tamanho - offset,
+            progresso and (lambda n: progresso(offset + n, tamanho)),
+        )
+
+    if os.path.getsize(parcial) != tamanho:
+        raise ErroAnexo(
+            'Transferência interrompida; tente novamente para retomar'
+        )
+    os.replace(parcial, destino)
+    return tamanho
@@ -0,0 +1,111 @@
+"""Benchmark de bytes por mensagem entregue e de custo de leitura no cliente
+
+Monta as mesmas mensagens de chat nos protocolos de texto e binário, como o
+servidor as entrega a uma sessão (no binário, com a apresentação de cada nome
+uma única vez), e mede os bytes por mensagem e o tempo que o cliente leva para
+separar remetente e texto de cada uma: no texto, LeitorLinhas seguido da
+divisão da linha em "nome: texto"; no binário, DecodificadorQuadros.
+
+Uso:
+    python benchmarks/bytes_por_mensagem.py [--mensagens 100000] [--remetentes 50] [--tamanho 40]
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocolo import LeitorLinhas
+from quadros import Carga, DecodificadorQuadros, quadro_nome
+
+
+def montar_fluxos(total_mensagens, total_remetentes, tamanho):
+    """Monta os bytes recebidos por uma sessão em cada protocolo
+
+    Args:
+        total_mensagens: Quantidade de mensagens
+        total_remetentes: Quantidade de autores distintos
+        tamanho: Caracteres do texto de cada mensagem
+
+    Returns:
+        tuple: (bytes no protocolo de texto, bytes no protocolo binário)
+    """
+    aleatorio = random.Random(42)
+    nomes = [f'usuario_{i:04d}' for i in range(total_remetentes)]
+    texto = bytearray()
+    binario = bytearray()
+    apresentados = set()
+    for _ in range(total_mensagens):
+        remetente = aleatorio.randrange(total_remetentes)
+        mensagem = ''.join(
+            aleatorio.choices(string.ascii_lowercase + ' ', k=tamanho)
+        )
+        carga = Carga.mensagem(remetente, nomes[remetente], mensagem)
+        texto += carga.texto
+        if remetente not in apresentados:
+            apresentados.add(remetente)
+            binario += quadro_nome(remetente, nomes[remetente])
+        binario += carga.binario
+    return bytes(texto), bytes(binario)
+
+
+def ler_texto(dados, pedaco):
+    """Lê o fluxo de texto em pedaços, separando remetente e texto de cada linha"""
+    leitor = LeitorLinhas()
+    itens = 0
+    for inicio in range(0, len(dados), pedaco):
+        for linha in leitor.alimentar(dados[inicio : inicio + pedaco]):
+            nome, _, texto = linha.partition(': ')
+            itens += 1
+    return itens
+
+
+def ler_binario(dados, pedaco):
+    """Lê o fluxo binário em pedaços com o decodificador do cliente"""
+    decodificador = DecodificadorQuadros()
+    itens = 0
+    for inicio in range(0, len(dados), pedaco):
+        itens += len(decodificador.alimentar(dados[inicio : inicio + pedaco]))
+    return itens
+
+
+def cronometrar(funcao, dados, pedaco):
+    """Retorna a quantidade de itens lidos e os segundos gastos"""
+    inicio = time.perf_counter()
+    itens = funcao(dados, pedaco)
+    return itens, time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mensagens', type=int, default=100_000)
+    parser.add_argument('--remetentes', type=int, default=50)
+    parser.add_argument('--tamanho', type=int, default=40)
+    parser.add_argument('--pedaco', type=int, default=4096)
+    args = parser.parse_args()
+
+    texto, binario = montar_fluxos(
+        args.mensagens, args.remetentes, args.tamanho
+    )
+    print(
+        f'{"protocolo":>10} {"bytes/msg":>10} {"µs/msg":>8} '
+        f'{"mensagens":>10}'
+    )
+    for rotulo, dados, funcao in (
+        ('texto', texto, ler_texto),
+        ('binário', binario, ler_binario),
+    ):
+        itens, segundos = cronometrar(funcao, dados, args.pedaco)
+        print(
+            f'{rotulo:>10} {len(dados) / args.mensagens:>10.1f} '
+            f'{segundos / itens * 1e6:>8.2f} {itens:>10}'
+        )
+    print(f'redução de bytes: {1 - len(binario) / len(texto):.1%}')
+
+
+if __name__ == '__main__':
+    main()
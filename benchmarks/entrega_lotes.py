@@ -0,0 +1,214 @@
+"""Compara a entrega imediata com a entrega em lotes numa sala movimentada
+
+Sobe um servidor sem interface, coloca N membros numa sala e faz alguns deles
+enviarem mensagens a uma taxa fixa. A medição roda duas vezes: com a entrega
+em lotes desligada (cada mensagem é um envio por membro) e com a troca
+automática de modo ligada. Para cada execução informa as chamadas de envio
+feitas pelo servidor por mensagem, a latência do envio até a chegada a alguns
+membros observadores e a fração das mensagens que saiu em lotes.
+
+Os membros são sockets simples lidos por um único loop: os observadores
+separam as linhas para medir a latência, e os demais apenas descartam os
+bytes recebidos.
+
+Uso:
+    python benchmarks/entrega_lotes.py [--membros 300] [--taxa 300] [--duracao 5]
+"""
+
+import argparse
+import os
+import re
+import selectors
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admissao import ControleAdmissao
+from entrega import TAXA_ATIVAR
+from protocolo import SOLICITACAO_SALA, TAMANHO_LEITURA, LeitorLinhas
+from servidor_local import criar_servidor, iniciar_servidor, parar_servidor
+
+PADRAO_MARCA = re.compile(r'#L(\d+)#')
+SALA = 'movimentada'
+
+
+def configurar_servidor(servidor, taxa_ativar, membros):
+    """Ajusta a admissão e a entrega do servidor e passa a contar os broadcasts
+
+    Args:
+        servidor: Servidor ainda parado
+        taxa_ativar: Taxa de ativação da entrega em lotes
+        membros: Membros previstos na sala
+
+    Returns:
+        list: Contador de chamadas de broadcast, na posição 0
+    """
+    servidor.admissao = ControleAdmissao(
+        taxa=10000,
+        rajada=membros + 10,
+        max_por_ip=membros + 10,
+        max_por_sala=membros + 10,
+    )
+    servidor.entrega.taxa_ativar = taxa_ativar
+    chamadas = [0]
+    broadcast = servidor.broadcast
+
+    def contar(sala_id, dados):
+        chamadas[0] += 1
+        broadcast(sala_id, dados)
+
+    servidor.entrega.publicar = contar
+    return chamadas
+
+
+def conectar(porta, nome):
+    """Conecta um membro à sala de forma bloqueante e o deixa não bloqueante"""
+    sock = socket.create_connection(('127.0.0.1', porta))
+    leitor = LeitorLinhas(sock)
+    if leitor.ler_linha() != SOLICITACAO_SALA:
+        raise RuntimeError('Servidor recusou a conexão')
+    sock.sendall(f'{SALA}\n{nome}\n'.encode())
+    sock.setblocking(False)
+    return sock, LeitorLinhas()
+
+
+def executar(
+    porta, chamadas, membros, observadores, remetentes, taxa, duracao
+):
+    """Conduz uma medição
+
+    Returns:
+        dict: Chamadas de envio por mensagem, percentis de latência e mensagens recebidas
+    """
+    seletor = selectors.DefaultSelector()
+    conexoes = []
+    for i in range(membros):
+        sock, leitor = conectar(porta, f'membro{i}')
+        observador = i < observadores
+        seletor.register(sock, selectors.EVENT_READ, (leitor, observador))
+        conexoes.append(sock)
+
+    envios = {}
+    latencias = []
+
+    def drenar(timeout):
+        for chave, _ in seletor.select(timeout):
+            leitor, observador = chave.data
+            try:
+                dados = chave.fileobj.recv(TAMANHO_LEITURA)
+            except BlockingIOError:
+                continue
+            if not observador:
+                continue
+            agora = time.perf_counter()
+            for linha in leitor.alimentar(dados):
+                encontrada = PADRAO_MARCA.search(linha)
+                if encontrada:
+                    envio = envios.get(int(encontrada.group(1)))
+                    if envio is not None:
+                        latencias.append(agora - envio)
+
+    # Deixa as entradas serem publicadas antes de medir
+    fim = time.monotonic() + 1
+    while time.monotonic() < fim:
+        drenar(0.05)
+
+    chamadas_antes = chamadas[0]
+    inicio = time.monotonic()
+    total = int(taxa * duracao)
+    for sequencia in range(total):
+        alvo = inicio + sequencia / taxa
+        while True:
+            restante = alvo - time.monotonic()
+            if restante <= 0:
+                break
+            drenar(restante)
+        envios[sequencia] = time.perf_counter()
+        remetente = conexoes[sequencia % remetentes]
+        remetente.setblocking(True)
+        remetente.sendall(
+            f'#L{sequencia}# mensagem do benchmark\n'.encode()
+        )
+        remetente.setblocking(False)
+
+    fim = time.monotonic() + 1
+    while time.monotonic() < fim:
+        drenar(0.05)
+    chamadas_medidas = chamadas[0] - chamadas_antes
+
+    seletor.close()
+    for sock in conexoes:
+        sock.close()
+
+    latencias.sort()
+
+    def percentil(p):
+        if not latencias:
+            return None
+        indice = min(len(latencias) - 1, int(p / 100 * len(latencias)))
+        return round(latencias[indice] * 1000, 2)
+
+    return {
+        'envios_por_mensagem': round(chamadas_medidas * membros / total, 1),
+        'p50_ms': percentil(50),
+        'p99_ms': percentil(99),
+        'recebidas': len(latencias),
+        'esperadas': total * observadores,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--membros', type=int, default=300)
+    parser.add_argument('--observadores', type=int, default=10)
+    parser.add_argument('--remetentes', type=int, default=10)
+    parser.add_argument(
+        '--taxa', type=float, default=300.0, help='mensagens por segundo'
+    )
+    parser.add_argument('--duracao', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(
+        f'{"modo":<12} {"envios/msg":>11} {"p50 (ms)":>9} {"p99 (ms)":>9} '
+        f'{"recebidas":>11} {"em lotes":>9}'
+    )
+    for modo, taxa_ativar in (
+        ('imediata', float('inf')),
+        ('automática', TAXA_ATIVAR),
+    ):
+        with tempfile.TemporaryDirectory() as pasta:
+            servidor = criar_servidor(pasta)
+            chamadas = configurar_servidor(
+                servidor, taxa_ativar, args.membros
+            )
+            porta = iniciar_servidor(servidor)
+            try:
+                resultado = executar(
+                    porta,
+                    chamadas,
+                    args.membros,
+                    args.observadores,
+                    args.remetentes,
+                    args.taxa,
+                    args.duracao,
+                )
+                estatisticas = servidor.entrega.estatisticas()
+            finally:
+                parar_servidor(servidor)
+
+        agrupadas = estatisticas['agrupadas'] / max(
+            1, estatisticas['mensagens']
+        )
+        print(
+            f'{modo:<12} {resultado["envios_por_mensagem"]:>11} '
+            f'{resultado["p50_ms"]:>9} {resultado["p99_ms"]:>9} '
+            f'{resultado["recebidas"]:>5}/{resultado["esperadas"]:<5}'
+            f'{agrupadas:>9.0%}'
+        )
+
+
+if __name__ == '__main__':
+    main()
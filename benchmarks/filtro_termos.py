@@ -0,0 +1,145 @@
+"""Compara o filtro de termos por autômato com uma expressão regular por termo
+
+Gera listas de termos de 10, 1.000 e 10.000 palavras e mede, para mensagens
+de chat sintéticas, o tempo por mensagem de três abordagens: uma expressão
+regular por termo (o custo cresce com a lista), uma única expressão regular
+com todos os termos em alternância e o FiltroTermos, que passa uma única vez
+por cada mensagem qualquer que seja o tamanho da lista. Também mede o tempo
+de montagem do autômato, que é o custo de uma recarga.
+
+Uso:
+    python benchmarks/filtro_termos.py [--termos 10 1000 10000] [--mensagens 2000]
+"""
+
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from filtros import FiltroTermos
+
+LIMITE_REGEX_POR_TERMO = 2000
+
+
+def gerar_palavras(quantidade, gerador):
+    """Gera palavras aleatórias distintas de 4 a 10 letras"""
+    palavras = set()
+    while len(palavras) < quantidade:
+        palavras.add(
+            ''.join(
+                gerador.choice(string.ascii_lowercase)
+                for _ in range(gerador.randint(4, 10))
+            )
+        )
+    return sorted(palavras)
+
+
+def gerar_mensagens(quantidade, termos, gerador):
+    """Gera mensagens de 5 a 20 palavras; uma em cada dez traz um termo da lista"""
+    vocabulario = gerar_palavras(500, gerador)
+    mensagens = []
+    for i in range(quantidade):
+        palavras = [
+            gerador.choice(vocabulario)
+            for _ in range(gerador.randint(5, 20))
+        ]
+        if i % 10 == 0:
+            palavras[gerador.randrange(len(palavras))] = gerador.choice(termos)
+        mensagens.append(' '.join(palavras))
+    return mensagens
+
+
+def cronometrar(funcao, mensagens):
+    """Retorna o tempo médio por mensagem, em microssegundos"""
+    inicio = time.perf_counter()
+    for mensagem in mensagens:
+        funcao(mensagem)
+    return (time.perf_counter() - inicio) / len(mensagens) * 1e6
+
+
+def medir(total_termos, mensagens_por_caso, gerador):
+    """Mede as três abordagens para uma lista de termos
+
+    Returns:
+        dict: Tempos por mensagem em microssegundos e montagem do autômato em milissegundos
+    """
+    termos = gerar_palavras(total_termos, gerador)
+    mensagens = gerar_mensagens(mensagens_por_caso, termos, gerador)
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho = os.path.join(pasta, 'termos.txt')
+        with open(caminho, 'w', encoding='utf-8') as arquivo:
+            arquivo.write('\n'.join(termos))
+        inicio = time.perf_counter()
+        filtro = FiltroTermos(caminho)
+        montagem = (time.perf_counter() - inicio) * 1000
+
+    resultado = {
+        'automato_us': cronometrar(filtro.processar, mensagens),
+        'montagem_ms': montagem,
+    }
+
+    alternancia = re.compile(
+        r'\b(?:' + '|'.join(map(re.escape, termos)) + r')\b', re.IGNORECASE
+    )
+    resultado['regex_unica_us'] = cronometrar(
+        lambda mensagem: alternancia.sub(
+            lambda m: '*' * len(m.group()), mensagem
+        ),
+        mensagens,
+    )
+
+    resultado['regex_por_termo_us'] = None
+    if total_termos <= LIMITE_REGEX_POR_TERMO:
+        expressoes = [
+            re.compile(r'\b' + re.escape(termo) + r'\b', re.IGNORECASE)
+            for termo in termos
+        ]
+
+        def por_termo(mensagem):
+            for expressao in expressoes:
+                mensagem = expressao.sub(
+                    lambda m: '*' * len(m.group()), mensagem
+                )
+            return mensagem
+
+        resultado['regex_por_termo_us'] = cronometrar(
+            por_termo, mensagens[: max(1, mensagens_por_caso // 10)]
+        )
+    return resultado
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--termos', type=int, nargs='+', default=[10, 1000, 10000]
+    )
+    parser.add_argument('--mensagens', type=int, default=2000)
+    parser.add_argument('--semente', type=int, default=1)
+    args = parser.parse_args()
+
+    gerador = random.Random(args.semente)
+    print(
+        f'{"termos":>8} {"por termo (µs)":>15} {"regex única (µs)":>17} '
+        f'{"autômato (µs)":>14} {"montagem (ms)":>14}'
+    )
+    for total in args.termos:
+        resultado = medir(total, args.mensagens, gerador)
+        por_termo = resultado['regex_por_termo_us']
+        print(
+            f'{total:>8} '
+            f'{"-" if por_termo is None else f"{por_termo:.1f}":>15} '
+            f'{resultado["regex_unica_us"]:>17.1f} '
+            f'{resultado["automato_us"]:>14.1f} '
+            f'{resultado["montagem_ms"]:>14.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Compara a latência do chat por TCP local e pelo socket Unix do servidor
+
+Sobe um servidor sem interface escutando ao mesmo tempo em 127.0.0.1 e num
+socket Unix temporário e, para cada transporte, conecta um cliente a uma sala
+e mede o tempo de ida e volta de mensagens enviadas uma de cada vez: do envio
+até o broadcast da própria mensagem voltar ao cliente. Em seguida envia uma
+rajada de mensagens sem esperar as respostas e mede a vazão até a última
+voltar.
+
+Uso:
+    python benchmarks/latencia_transporte.py [--mensagens 5000] [--rajada 20000] [--json resultado.json]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocolo import (
+    PREFIXO_UNIX,
+    SOLICITACAO_SALA,
+    LeitorLinhas,
+    resolver_endereco,
+)
+from servidor_local import criar_servidor, iniciar_servidor, parar_servidor
+
+
+def conectar(host, port, sala, nome):
+    """Conecta um cliente bloqueante a uma sala
+
+    Returns:
+        tuple: (socket, leitor de linhas)
+    """
+    familia, tipo, proto, endereco = resolver_endereco(host, port)
+    sock = socket.socket(familia, tipo, proto)
+    sock.connect(endereco)
+    if familia != getattr(socket, 'AF_UNIX', None):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    leitor = LeitorLinhas(sock)
+    if leitor.ler_linha() != SOLICITACAO_SALA:
+        raise RuntimeError('Servidor recusou a conexão')
+    sock.sendall(f'{sala}\n{nome}\n'.encode())
+    return sock, leitor
+
+
+def aguardar(leitor, esperada):
+    """Lê linhas até receber a esperada, descartando avisos da sala"""
+    while True:
+        linha = leitor.ler_linha()
+        if linha is None:
+            raise RuntimeError('Conexão encerrada pelo servidor')
+        if linha == esperada:
+            return
+
+
+def medir(host, port, nome, mensagens, rajada):
+    """Mede a latência de ida e volta e a vazão de um transporte
+
+    Args:
+        host: Endereço do servidor, ou unix: seguido do caminho do socket
+        port: Porta do servidor
+        nome: Nome do cliente e da sala, exclusivos do transporte
+        mensagens: Mensagens enviadas uma de cada vez
+        rajada: Mensagens enviadas sem esperar resposta
+
+    Returns:
+        dict: Percentis de latência em microssegundos e vazão em mensagens por segundo
+    """
+    sock, leitor = conectar(host, port, nome, nome)
+    try:
+        # Aquecimento, que também descarta o retrato e os avisos da entrada
+        for i in range(100):
+            sock.sendall(f'a{i}\n'.encode())
+            aguardar(leitor, f'{nome}: a{i}')
+
+        latencias = []
+        for i in range(mensagens):
+            inicio = time.perf_counter()
+            sock.sendall(f'm{i}\n'.encode())
+            aguardar(leitor, f'{nome}: m{i}')
+            latencias.append(time.perf_counter() - inicio)
+
+        dados = b''.join(f'r{i}\n'.encode() for i in range(rajada))
+        inicio = time.perf_counter()
+        envio = threading.Thread(target=sock.sendall, args=(dados,))
+        envio.start()
+        aguardar(leitor, f'{nome}: r{rajada - 1}')
+        duracao = time.perf_counter() - inicio
+        envio.join()
+    finally:
+        sock.close()
+
+    latencias.sort()
+
+    def percentil(p):
+        indice = min(len(latencias) - 1, int(p / 100 * len(latencias)))
+        return round(latencias[indice] * 1e6, 1)
+
+    return {
+        'p50_us': percentil(50),
+        'p95_us': percentil(95),
+        'p99_us': percentil(99),
+        'max_us': percentil(100),
+        'vazao_msg_s': round(rajada / duracao, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--mensagens',
+        type=int,
+        default=5000,
+        help='mensagens de ida e volta por transporte',
+    )
+    parser.add_argument(
+        '--rajada',
+        type=int,
+        default=20000,
+        help='mensagens da medição de vazão',
+    )
+    parser.add_argument('--json', help='grava o resultado neste arquivo')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as pasta:
+        caminho_unix = os.path.join(pasta, 'chat.sock')
+        servidor = criar_servidor(pasta)
+        porta = iniciar_servidor(servidor, caminho_unix)
+        try:
+            resultado = {
+                'tcp': medir(
+                    '127.0.0.1', porta, 'tcp', args.mensagens, args.rajada
+                ),
+                'unix': medir(
+                    PREFIXO_UNIX + caminho_unix,
+                    0,
+                    'unix',
+                    args.mensagens,
+                    args.rajada,
+                ),
+            }
+        finally:
+            parar_servidor(servidor)
+
+    colunas = ('p50_us', 'p95_us', 'p99_us', 'max_us', 'vazao_msg_s')
+    print(f'{"transporte":<10}' + ''.join(f'{c:>13}' for c in colunas))
+    for transporte, medidas in resultado.items():
+        print(
+            f'{transporte:<10}'
+            + ''.join(f'{medidas[c]:>13}' for c in colunas)
+        )
+    razao = resultado['unix']['p50_us'] / resultado['tcp']['p50_us']
+    print(
+        f'\nO socket Unix levou {razao:.0%} da latência mediana do TCP local'
+    )
+
+    if args.json:
+        with open(args.json, 'w') as arquivo:
+            json.dump(resultado, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Benchmark de memória das sessões ociosas do servidor
+
+Registra N sessões ociosas diretamente no registro de salas do servidor (sem
+threads nem sockets reais) e mede, com tracemalloc, quantos bytes do heap do
+Python cada conexão ocupa: registro Sessao, entrada no dicionário da sala e
+nome internado. Buffers de socket do kernel e pilhas de thread não entram na
+conta e devem ser somados à parte no dimensionamento dos hosts.
+
+Uso:
+    python benchmarks/memoria_sessoes.py [--sessoes 10000 100000] [--salas 100]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servidor import Servidor
+
+
+class SocketOcioso:
+    """Substituto mínimo de socket, compartilhado por todas as sessões"""
+
+    def send(self, dados):
+        return len(dados)
+
+    def close(self):
+        pass
+
+
+def medir(total_sessoes, total_salas):
+    """Mede os bytes por sessão ociosa
+
+    Args:
+        total_sessoes: Quantidade de sessões registradas
+        total_salas: Quantidade de salas entre as quais as sessões são distribuídas
+
+    Returns:
+        tuple: (bytes por sessão, bytes totais)
+    """
+    servidor = Servidor()
+    client = SocketOcioso()
+    salas = [f'sala{i}' for i in range(total_salas)]
+    addr = ('127.0.0.1', 50000)
+
+    gc.collect()
+    tracemalloc.start()
+    inicio = tracemalloc.get_traced_memory()[0]
+
+    for i in range(total_sessoes):
+        servidor.registrar_sessao(
+            client, f'usuario{i}', salas[i % total_salas], addr
+        )
+
+    gc.collect()
+    total = tracemalloc.get_traced_memory()[0] - inicio
+    tracemalloc.stop()
+    return total / total_sessoes, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--sessoes', type=int, nargs='+', default=[10_000, 100_000]
+    )
+    parser.add_argument('--salas', type=int, default=100)
+    args = parser.parse_args()
+
+    print(f'{"sessões":>10} {"bytes/sessão":>14} {"total (MiB)":>12}')
+    for total_sessoes in args.sessoes:
+        por_sessao, total = medir(total_sessoes, args.salas)
+        print(
+            f'{total_sessoes:>10} {por_sessao:>14.1f} {total / 2**20:>12.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+"""Microbenchmarks dos caminhos quentes do servidor
+
+Mede, isoladamente e sem rede, Servidor.broadcast, a entrega de uma menção a
+um único membro (Servidor.enviar_direta), a entrada e a saída de uma sala
+(adicionar_cliente_sala seguido de remover_cliente) e a leitura do handshake
+feita em processar_cliente, em salas de 10, 1.000 e 10.000 membros.
+
+Os sockets dos membros são pares de socketpair tirados de um pool pequeno e
+compartilhados entre as sessões, para não esbarrar no limite de descritores
+do processo; a outra ponta de cada par é esvaziada entre os lotes medidos,
+fora do tempo cronometrado. A vazão é a mediana de algumas repetições, e as
+alocações por chamada são medidas numa passada separada com tracemalloc: o
+pico de bytes alocados durante a chamada e os blocos que continuam alocados
+depois dela.
+
+Os resultados podem ser gravados como base e comparados em execuções
+futuras; o processo termina com código 1 se algum caso ficar mais lento que
+a base além da tolerância.
+
+Uso:
+    python benchmarks/micro.py [--tamanhos 10 1000 10000] [--salvar-base]
+    python benchmarks/micro.py --comparar [--tolerancia 0.2]
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import socket
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admissao import ControleAdmissao
+from protocolo import LeitorLinhas
+from retomada import MARCADOR_RETOMAR
+from servidor import Servidor
+
+ARQUIVO_BASE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'resultados', 'micro.json'
+)
+TAMANHO_POOL = 64
+BUFFER_ENVIO = 4 * 1024 * 1024
+MENSAGEM = 'usuario1: mensagem de teste do benchmark\n'.encode()
+HANDSHAKE = b'sala\nusuario\n'
+HANDSHAKE_RETOMADA = (
+    (MARCADOR_RETOMAR + 'ab' * 16 + '\n').encode() + HANDSHAKE
+)
+
+
+class PoolSockets:
+    """Pares de socketpair reaproveitados por muitas sessões falsas"""
+
+    def __init__(self, tamanho=TAMANHO_POOL):
+        """Cria os pares
+
+        Args:
+            tamanho: Quantidade de pares
+        """
+        self.pares = [socket.socketpair() for _ in range(tamanho)]
+        for escrita, leitura in self.pares:
+            escrita.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, BUFFER_ENVIO
+            )
+            leitura.setblocking(False)
+        self.proximo = 0
+        self.capacidade = self.medir_capacidade()
+
+    def medir_capacidade(self):
+        """Conta quantos envios de MENSAGEM cabem num par antes de o envio bloquear
+
+        Em sockets Unix o custo de cada envio no buffer vai muito além do tamanho dos
+        dados, então a capacidade é medida em envios, e não em bytes.
+
+        Returns:
+            int: Metade dos envios que couberam, como margem
+        """
+        escrita = self.pares[0][0]
+        escrita.setblocking(False)
+        envios = 0
+        try:
+            while True:
+                escrita.send(MENSAGEM)
+                envios += 1
+        except BlockingIOError:
+            pass
+        finally:
+            escrita.setblocking(True)
+        self.esvaziar()
+        return max(1, envios // 2)
+
+    def obter(self):
+        """Retorna a ponta de escrita do próximo par, em rodízio"""
+        escrita = self.pares[self.proximo][0]
+        self.proximo = (self.proximo + 1) % len(self.pares)
+        return escrita
+
+    def obter_descartavel(self):
+        """Retorna uma cópia do descritor do próximo par, que pode ser fechada sem afetar o pool"""
+        return self.obter().dup()
+
+    def esvaziar(self):
+        """Descarta tudo o que foi escrito nos pares"""
+        for _, leitura in self.pares:
+            try:
+                while leitura.recv(1 << 20):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def fechar(self):
+        """Fecha todos os pares"""
+        for escrita, leitura in self.pares:
+            escrita.close()
+            leitura.close()
+
+
+def criar_servidor(pool, membros):
+    """Cria um servidor sem interface com uma sala já povoada
+
+    Args:
+        pool: Pool de sockets dos membros
+        membros: Quantidade de membros da sala
+
+    Returns:
+        tuple: (servidor, ID da sala)
+    """
+    servidor = Servidor()
+    servidor.log = lambda mensagem: None
+    servidor.admissao = ControleAdmissao(max_por_sala=membros + 10)
+    addr = ('127.0.0.1', 50000)
+    for i in range(membros):
+        servidor.adicionar_cliente_sala(
+            pool.obter(), f'membro{i}', 'sala', addr
+        )
+        if i % TAMANHO_POOL == TAMANHO_POOL - 1:
+            pool.esvaziar()
+    # Consolida as entradas para que os retratos enviados nas próximas
+    # entradas tenham o tamanho real da sala; o delta da povoação não é
+    # enviado
+    servidor.presenca.publicar = lambda sala_id, dados: None
+    servidor.presenca.publicar_pendentes()
+    pool.esvaziar()
+    return servidor, servidor.tabela_salas.obter_id('sala')
+
+
+def cronometrar(lote, preparar, executar, limpar, tempo_minimo, repeticoes):
+    """Mede a vazão de uma operação em lotes, deixando o preparo e a limpeza fora do tempo
+
+    Args:
+        lote: Chamadas por lote
+        preparar: Função chamada antes de cada lote, fora do tempo
+        executar: Função que executa uma chamada
+        limpar: Função chamada depois de cada lote, fora do tempo
+        tempo_minimo: Segundos cronometrados mínimos por repetição
+        repeticoes: Repetições; a vazão final é a mediana
+
+    Returns:
+        float: Operações por segundo
+    """
+    vazoes = []
+    for _ in range(repeticoes):
+        decorrido = 0.0
+        chamadas = 0
+        while decorrido < tempo_minimo:
+            preparar()
+            inicio = time.perf_counter()
+            for _ in range(lote):
+                executar()
+            decorrido += time.perf_counter() - inicio
+            chamadas += lote
+            limpar()
+        vazoes.append(chamadas / decorrido)
+    return statistics.median(vazoes)
+
+
+def medir_alocacoes(preparar, executar, limpar, chamadas):
+    """Mede as alocações do heap do Python por chamada
+
+    Args:
+        preparar: Função chamada antes de cada chamada, fora da medição
+        executar: Função que executa uma chamada
+        limpar: Função chamada depois de cada chamada, fora da medição
+        chamadas: Quantidade de chamadas medidas
+
+    Returns:
+        tuple: (pico médio de bytes por chamada, blocos retidos por chamada)
+    """
+    gc.collect()
+    tracemalloc.start()
+    picos = 0
+    retidos = 0
+    try:
+        for _ in range(chamadas):
+            preparar()
+            antes = tracemalloc.get_traced_memory()[0]
+            blocos = sys.getallocatedblocks()
+            tracemalloc.reset_peak()
+            executar()
+            picos += tracemalloc.get_traced_memory()[1] - antes
+            retidos += sys.getallocatedblocks() - blocos
+            limpar()
+    finally:
+        tracemalloc.stop()
+    return picos / chamadas, retidos / chamadas
+
+
+def nada():
+    pass
+
+
+def caso_broadcast(pool, membros, tempo_minimo, repeticoes):
+    """Servidor.broadcast de uma mensagem já codificada para toda a sala"""
+    servidor, sala_id = criar_servidor(pool, membros)
+    por_socket = -(-membros // TAMANHO_POOL)
+    lote = max(1, pool.capacidade // por_socket)
+
+    def executar():
+        servidor.broadcast(sala_id, MENSAGEM)
+
+    vazao = cronometrar(
+        lote, nada, executar, pool.esvaziar, tempo_minimo, repeticoes
+    )
+    alocacoes = medir_alocacoes(nada, executar, pool.esvaziar, 20)
+    return vazao, alocacoes
+
+
+def caso_direta(pool, membros, tempo_minimo, repeticoes):
+    """Servidor.enviar_direta de uma menção a um membro, que não depende do tamanho da sala"""
+    servidor, sala_id = criar_servidor(pool, membros)
+    remetente = servidor.usuarios.sessoes(
+        servidor.tabela_nomes.buscar_id('membro0')
+    )[0]
+    destinatario = 'membro1' if membros > 1 else 'membro0'
+    texto = f'@{destinatario} mensagem de teste do benchmark'
+
+    def executar():
+        servidor.enviar_direta(
+            remetente, 'membro0', [destinatario], texto, sala_id
+        )
+
+    vazao = cronometrar(
+        pool.capacidade // 2,
+        nada,
+        executar,
+        pool.esvaziar,
+        tempo_minimo,
+        repeticoes,
+    )
+    alocacoes = medir_alocacoes(nada, executar, pool.esvaziar, 20)
+    return vazao, alocacoes
+
+
+def caso_entrada_saida(pool, membros, tempo_minimo, repeticoes):
+    """adicionar_cliente_sala seguido de remover_cliente na mesma sala"""
+    servidor, _ = criar_servidor(pool, membros)
+    addr = ('127.0.0.1', 50001)
+    clientes = []
+
+    def preparar():
+        clientes.extend(pool.obter_descartavel() for _ in range(lote))
+
+    def executar():
+        sessao = servidor.adicionar_cliente_sala(
+            clientes.pop(), 'visitante', 'sala', addr
+        )
+        servidor.remover_cliente(sessao)
+
+    def limpar():
+        # Sem a thread da presença, a entrada e a saída se anulam aqui
+        servidor.presenca.publicar_pendentes()
+        pool.esvaziar()
+
+    lote = TAMANHO_POOL
+    vazao = cronometrar(
+        lote, preparar, executar, limpar, tempo_minimo, repeticoes
+    )
+    lote = 1
+    alocacoes = medir_alocacoes(preparar, executar, limpar, 20)
+    return vazao, alocacoes
+
+
+def caso_handshake(pool, handshake, tempo_minimo, repeticoes):
+    """Servidor.ler_handshake sobre um socket com o handshake já recebido"""
+    servidor = Servidor()
+    servidor.log = lambda mensagem: None
+    escrita, leitura = socket.socketpair()
+    lote = 200
+    leitor = None
+
+    def preparar():
+        nonlocal leitor
+        # Os handshakes do lote chegam juntos, como se fossem de uma conexão
+        # só, e por isso compartilham o leitor
+        escrita.sendall(handshake * lote)
+        leitor = LeitorLinhas(leitura)
+
+    def executar():
+        servidor.ler_handshake(leitor)
+
+    try:
+        vazao = cronometrar(
+            lote, preparar, executar, nada, tempo_minimo, repeticoes
+        )
+        lote = 1
+        alocacoes = medir_alocacoes(preparar, executar, nada, 200)
+    finally:
+        escrita.close()
+        leitura.close()
+    return vazao, alocacoes
+
+
+def executar_casos(tamanhos, tempo_minimo, repeticoes):
+    """Executa todos os casos e os escreve na saída à medida que terminam
+
+    Returns:
+        dict: Resultados por nome de caso
+    """
+    pool = PoolSockets()
+    casos = []
+    for membros in tamanhos:
+        casos.append(
+            (
+                f'broadcast/{membros}',
+                lambda m=membros: caso_broadcast(
+                    pool, m, tempo_minimo, repeticoes
+                ),
+            )
+        )
+        casos.append(
+            (
+                f'direta/{membros}',
+                lambda m=membros: caso_direta(
+                    pool, m, tempo_minimo, repeticoes
+                ),
+            )
+        )
+        casos.append(
+            (
+                f'entrada_saida/{membros}',
+                lambda m=membros: caso_entrada_saida(
+                    pool, m, tempo_minimo, repeticoes
+                ),
+            )
+        )
+    casos.append(
+        (
+            'handshake',
+            lambda: caso_handshake(pool, HANDSHAKE, tempo_minimo, repeticoes),
+        )
+    )
+    casos.append(
+        (
+            'handshake_retomada',
+            lambda: caso_handshake(
+                pool, HANDSHAKE_RETOMADA, tempo_minimo, repeticoes
+            ),
+        )
+    )
+
+    resultados = {}
+    print(
+        f'{"caso":<22} {"ops/s":>12} {"µs/op":>10} '
+        f'{"bytes pico":>11} {"blocos retidos":>15}'
+    )
+    try:
+        for nome, caso in casos:
+            vazao, (pico, retidos) = caso()
+            resultados[nome] = {
+                'ops_s': round(vazao, 1),
+                'bytes_pico': round(pico, 1),
+                'blocos_retidos': round(retidos, 2),
+            }
+            print(
+                f'{nome:<22} {vazao:>12.1f} {1e6 / vazao:>10.2f} '
+                f'{pico:>11.0f} {retidos:>15.2f}',
+                flush=True,
+            )
+            gc.collect()
+    finally:
+        pool.fechar()
+    return resultados
+
+
+def comparar(resultados, base, tolerancia):
+    """Compara a vazão de cada caso com a base
+
+    Args:
+        resultados: Resultados desta execução
+        base: Resultados gravados como base
+        tolerancia: Queda relativa de vazão aceita, como 0.2 para 20%
+
+    Returns:
+        list: Nomes dos casos que regrediram
+    """
+    regressoes = []
+    print(f'\n{"caso":<22} {"base ops/s":>12} {"atual":>12} {"variação":>9}')
+    for nome, atual in resultados.items():
+        anterior = base.get(nome)
+        if anterior is None:
+            continue
+        variacao = atual['ops_s'] / anterior['ops_s'] - 1
+        marca = ''
+        if variacao < -tolerancia:
+            marca = '  REGRESSÃO'
+            regressoes.append(nome)
+        print(
+            f'{nome:<22} {anterior["ops_s"]:>12.1f} '
+            f'{atual["ops_s"]:>12.1f} {variacao:>+9.1%}{marca}'
+        )
+    return regressoes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--tamanhos', type=int, nargs='+', default=[10, 1000, 10000]
+    )
+    parser.add_argument(
+        '--tempo',
+        type=float,
+        default=0.3,
+        help='segundos cronometrados mínimos por repetição',
+    )
+    parser.add_argument('--repeticoes', type=int, default=3)
+    parser.add_argument(
+        '--base', default=ARQUIVO_BASE, help='arquivo da base'
+    )
+    parser.add_argument(
+        '--salvar-base',
+        action='store_true',
+        help='grava os resultados desta execução como base',
+    )
+    parser.add_argument(
+        '--comparar',
+        action='store_true',
+        help='compara com a base e termina com código 1 se houver regressão',
+    )
+    parser.add_argument(
+        '--tolerancia',
+        type=float,
+        default=0.2,
+        help='queda relativa de vazão aceita na comparação',
+    )
+    args = parser.parse_args()
+
+    resultados = executar_casos(args.tamanhos, args.tempo, args.repeticoes)
+
+    codigo = 0
+    if args.comparar:
+        try:
+            with open(args.base) as arquivo:
+                base = json.load(arquivo)['resultados']
+        except FileNotFoundError:
+            parser.error(f'base não encontrada: {args.base}')
+        regressoes = comparar(resultados, base, args.tolerancia)
+        if regressoes:
+            print(f'\n{len(regressoes)} caso(s) regrediram')
+            codigo = 1
+
+    if args.salvar_base:
+        os.makedirs(
+            os.path.dirname(os.path.abspath(args.base)), exist_ok=True
+        )
+        with open(args.base, 'w') as arquivo:
+            json.dump(
+                {
+                    'python': platform.python_version(),
+                    'plataforma': platform.platform(),
+                    'data': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'resultados': resultados,
+                },
+                arquivo,
+                indent=2,
+            )
+        print(f'\nBase gravada em {args.base}')
+    return codigo
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""Compara os perfis de rede do servidor e do cliente por TCP local
+
+Para cada perfil, sobe um servidor sem interface com o perfil aplicado ao
+socket de escuta e às conexões aceitas e conecta clientes com o mesmo perfil.
+Mede a latência de ida e volta de mensagens enviadas uma de cada vez, a vazão
+de uma rajada entregue a uma sala com vários membros (do primeiro envio até a
+última mensagem chegar ao último membro) e o tempo que o loop de aceite leva
+para sair depois que o servidor para, antes do encerramento das threads de
+apoio.
+
+Uso:
+    python benchmarks/perfis_rede.py [--perfis padrao baixa-latencia alta-vazao] [--mensagens 2000] [--rajada 20000] [--membros 20]
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from perfis_rede import PERFIS, ajustar_conexao, obter_perfil
+from protocolo import SOLICITACAO_SALA, LeitorLinhas
+from servidor_local import criar_servidor, iniciar_servidor, parar_servidor
+
+
+def conectar(porta, perfil, sala, nome):
+    """Conecta um cliente bloqueante com o perfil dado
+
+    Returns:
+        tuple: (socket, leitor de linhas)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ajustar_conexao(sock, perfil)
+    sock.connect(('127.0.0.1', porta))
+    leitor = LeitorLinhas(sock)
+    if leitor.ler_linha() != SOLICITACAO_SALA:
+        raise RuntimeError('Servidor recusou a conexão')
+    sock.sendall(f'{sala}\n{nome}\n'.encode())
+    return sock, leitor
+
+
+def aguardar(leitor, esperada):
+    """Lê linhas até receber a esperada, descartando avisos da sala"""
+    while True:
+        linha = leitor.ler_linha()
+        if linha is None:
+            raise RuntimeError('Conexão encerrada pelo servidor')
+        if linha == esperada:
+            return
+
+
+def medir_ida_e_volta(porta, perfil, mensagens):
+    """Mede a latência de mensagens enviadas uma de cada vez
+
+    Returns:
+        tuple: (p50 em microssegundos, p99 em microssegundos)
+    """
+    sock, leitor = conectar(porta, perfil, 'ida_e_volta', 'eco')
+    try:
+        for i in range(100):
+            sock.sendall(f'a{i}\n'.encode())
+            aguardar(leitor, f'eco: a{i}')
+        latencias = []
+        for i in range(mensagens):
+            inicio = time.perf_counter()
+            sock.sendall(f'm{i}\n'.encode())
+            aguardar(leitor, f'eco: m{i}')
+            latencias.append(time.perf_counter() - inicio)
+    finally:
+        sock.close()
+    latencias.sort()
+    p99 = latencias[min(len(latencias) - 1, int(0.99 * len(latencias)))]
+    return statistics.median(latencias) * 1e6, p99 * 1e6
+
+
+def medir_rajada(porta, perfil, rajada, membros):
+    """Mede a vazão de uma rajada entregue a todos os membros de uma sala
+
+    Returns:
+        float: Mensagens por segundo, contadas até o último membro receber a última
+    """
+    ouvintes = [
+        conectar(porta, perfil, 'rajada', f'ouvinte{i}')
+        for i in range(membros)
+    ]
+    sock, leitor = conectar(porta, perfil, 'rajada', 'fonte')
+    try:
+        sock.sendall(b'pronto\n')
+        for _, leitor_ouvinte in ouvintes:
+            aguardar(leitor_ouvinte, 'fonte: pronto')
+
+        ultima = f'fonte: r{rajada - 1}'
+        threads = [
+            threading.Thread(target=aguardar, args=(leitor_ouvinte, ultima))
+            for _, leitor_ouvinte in ouvintes
+        ]
+        for thread in threads:
+            thread.start()
+        dados = b''.join(f'r{i}\n'.encode() for i in range(rajada))
+        inicio = time.perf_counter()
+        envio = threading.Thread(target=sock.sendall, args=(dados,))
+        envio.start()
+        for thread in threads:
+            thread.join()
+        duracao = time.perf_counter() - inicio
+        envio.join()
+    finally:
+        sock.close()
+        for sock_ouvinte, _ in ouvintes:
+            sock_ouvinte.close()
+    return rajada / duracao
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--perfis', nargs='+', choices=list(PERFIS), default=list(PERFIS)
+    )
+    parser.add_argument('--mensagens', type=int, default=2000)
+    parser.add_argument('--rajada', type=int, default=20000)
+    parser.add_argument('--membros', type=int, default=20)
+    args = parser.parse_args()
+
+    print(
+        f'{"perfil":<16} {"p50 µs":>9} {"p99 µs":>9} '
+        f'{"rajada msg/s":>13} {"parada ms":>10}'
+    )
+    for nome in args.perfis:
+        perfil = obter_perfil(nome)
+        with tempfile.TemporaryDirectory() as pasta:
+            servidor = criar_servidor(pasta)
+            servidor.perfil_rede = perfil
+            porta = iniciar_servidor(servidor)
+            try:
+                p50, p99 = medir_ida_e_volta(porta, perfil, args.mensagens)
+                vazao = medir_rajada(porta, perfil, args.rajada, args.membros)
+            finally:
+                parada = parar_servidor(servidor)
+        print(
+            f'{nome:<16} {p50:>9.1f} {p99:>9.1f} {vazao:>13.1f} '
+            f'{parada * 1000:>10.2f}',
+            flush=True,
+        )
+
+
+if __name__ == '__main__':
+    main()
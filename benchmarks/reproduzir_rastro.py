@@ -0,0 +1,292 @@
+"""Reproduz um rastro gravado pelo servidor contra uma instância local
+
+Sobe um servidor sem interface numa porta livre e recria, com clientes não
+bloqueantes num único loop de eventos, as entradas, mensagens e saídas do
+rastro, mantendo os intervalos originais divididos pelo fator de velocidade.
+Cada mensagem reproduzida leva um marcador de sequência, o que permite medir a
+latência até cada membro da sala e contar as entregas perdidas. Entregas
+enviadas na janela de saída, pouco antes de o membro sair da sala, ainda podem
+estar em trânsito, comum em velocidades altas; essas são contadas à parte e não
+entram nas perdas. As demais entregas que não chegaram são perdas.
+
+O servidor local grava o estado num diretório temporário, apagado ao final.
+
+Rastros redigidos trazem apenas o tamanho das mensagens; o conteúdo é
+substituído por enchimento do mesmo tamanho.
+
+Uso:
+    python benchmarks/reproduzir_rastro.py rastros/rastro.bin [--velocidade 10] [--json resultado.json]
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admissao import ControleAdmissao
+from presenca import MARCADOR_MEMBROS
+from protocolo import ConexaoChat, LoopSelectores
+from rastro import (
+    EVENTO_ENTRADA,
+    EVENTO_MENSAGEM,
+    EVENTO_RECUSA,
+    EVENTO_SAIDA,
+    ler_rastro,
+)
+from servidor_local import criar_servidor, iniciar_servidor, parar_servidor
+
+PADRAO_SEQUENCIA = re.compile(r': #R(\d+)#')
+JANELA_SAIDA = 0.5
+
+
+class Reproducao:
+    """Estado da reprodução de um rastro: sessões, mensagens em trânsito e medições"""
+
+    def __init__(self, porta, redigido, janela_saida=JANELA_SAIDA):
+        """Inicializa a reprodução
+
+        Args:
+            porta: Porta do servidor local
+            redigido: Se o rastro traz apenas o tamanho das mensagens
+            janela_saida: Segundos antes da saída de um membro em que as entregas ainda não recebidas contam como em trânsito
+        """
+        self.porta = porta
+        self.redigido = redigido
+        self.janela_saida = janela_saida
+        self.loop = LoopSelectores()
+        self.sessoes = {}
+        self.membros = {}
+        self.sequencia = 0
+        self.latencias = []
+        self.esperadas = 0
+        self.recebidas = 0
+        self.pendentes_saida = 0
+        self.recusas_rastro = 0
+        self.recusas = 0
+        self.mensagens = 0
+        self.ignoradas = 0
+
+    def entrar(self, sessao_id, sala, nome):
+        """Abre a conexão de uma sessão do rastro"""
+        sessao = {
+            'sala': sala,
+            'nome': nome,
+            'membro': False,
+            # Sequência -> momento do envio das entregas ainda não recebidas
+            'pendentes': {},
+        }
+
+        def ao_receber(linha):
+            if not sessao['membro']:
+                # O retrato da lista de membros confirma a entrada na sala
+                if linha.startswith(MARCADOR_MEMBROS):
+                    sessao['membro'] = True
+                    self.membros.setdefault(sala, set()).add(sessao_id)
+                return
+            encontrado = PADRAO_SEQUENCIA.search(linha)
+            if encontrado:
+                envio = sessao['pendentes'].pop(
+                    int(encontrado.group(1)), None
+                )
+                if envio is not None:
+                    self.recebidas += 1
+                    self.latencias.append(time.perf_counter() - envio)
+
+        def ao_desconectar(erro):
+            if sessao['conexao'].tentar_apos is not None:
+                self.recusas += 1
+            self.sair(sessao_id)
+
+        sessao['conexao'] = ConexaoChat(
+            self.loop,
+            '127.0.0.1',
+            self.porta,
+            handshake=(sala, nome),
+            ao_receber=ao_receber,
+            ao_desconectar=ao_desconectar,
+        )
+        self.sessoes[sessao_id] = sessao
+        sessao['conexao'].iniciar()
+
+    def enviar(self, sessao_id, tamanho, conteudo):
+        """Envia uma mensagem em nome de uma sessão do rastro"""
+        sessao = self.sessoes.get(sessao_id)
+        if sessao is None or not sessao['membro']:
+            self.ignoradas += 1
+            return
+
+        self.sequencia += 1
+        marcador = f'#R{self.sequencia}#'
+        if conteudo is None or self.redigido:
+            texto = marcador + 'x' * max(0, tamanho - len(marcador))
+        else:
+            texto = marcador + conteudo
+
+        envio = time.perf_counter()
+        membros = self.membros.get(sessao['sala'], ())
+        for membro in membros:
+            self.sessoes[membro]['pendentes'][self.sequencia] = envio
+        self.esperadas += len(membros)
+        self.mensagens += 1
+        sessao['conexao'].enviar_linha(texto)
+
+    def sair(self, sessao_id):
+        """Encerra a conexão de uma sessão do rastro"""
+        sessao = self.sessoes.pop(sessao_id, None)
+        if sessao is None:
+            return
+        self.membros.get(sessao['sala'], set()).discard(sessao_id)
+        # Só as entregas enviadas pouco antes da saída podem estar em trânsito;
+        # as mais antigas que não chegaram são perdas
+        limite = time.perf_counter() - self.janela_saida
+        self.pendentes_saida += sum(
+            1 for envio in sessao['pendentes'].values() if envio >= limite
+        )
+        sessao['conexao'].fechar()
+
+    def executar(self, eventos, velocidade, drenagem):
+        """Reproduz os eventos respeitando os intervalos escalados
+
+        Args:
+            eventos: Eventos lidos do rastro
+            velocidade: Fator de aceleração dos intervalos originais
+            drenagem: Segundos aguardando entregas pendentes depois do último evento
+        """
+        inicio = time.monotonic()
+        for evento in eventos:
+            tipo, segundos = evento[0], evento[1]
+            alvo = inicio + segundos / velocidade
+            while True:
+                restante = alvo - time.monotonic()
+                if restante <= 0:
+                    break
+                self.loop.executar_uma_vez(restante)
+
+            if tipo == EVENTO_ENTRADA:
+                self.entrar(*evento[2:])
+            elif tipo == EVENTO_MENSAGEM:
+                self.enviar(*evento[2:])
+            elif tipo == EVENTO_SAIDA:
+                self.sair(evento[2])
+            elif tipo == EVENTO_RECUSA:
+                self.recusas_rastro += 1
+
+        fim = time.monotonic() + drenagem
+        while any(sessao['pendentes'] for sessao in self.sessoes.values()):
+            restante = fim - time.monotonic()
+            if restante <= 0:
+                break
+            self.loop.executar_uma_vez(min(restante, 0.05))
+
+        # Entregas que não chegaram durante a drenagem contam como perdas
+        for sessao in self.sessoes.values():
+            sessao['conexao'].fechar()
+        self.sessoes.clear()
+
+    def resultado(self, eventos, duracao):
+        """Resume as medições da reprodução
+
+        Returns:
+            dict: Contagens e percentis de latência em milissegundos
+        """
+        latencias = sorted(self.latencias)
+
+        def percentil(p):
+            if not latencias:
+                return None
+            indice = min(len(latencias) - 1, int(p / 100 * len(latencias)))
+            return round(latencias[indice] * 1000, 3)
+
+        perdidas = self.esperadas - self.recebidas - self.pendentes_saida
+        return {
+            'eventos': len(eventos),
+            'duracao_s': round(duracao, 3),
+            'sessoes': sum(1 for e in eventos if e[0] == EVENTO_ENTRADA),
+            'recusas_rastro': self.recusas_rastro,
+            'recusas': self.recusas,
+            'mensagens': self.mensagens,
+            'mensagens_ignoradas': self.ignoradas,
+            'entregas_esperadas': self.esperadas,
+            'entregas_recebidas': self.recebidas,
+            'pendentes_na_saida': self.pendentes_saida,
+            'perdas_pct': round(100 * perdidas / self.esperadas, 3)
+            if self.esperadas
+            else 0.0,
+            'latencia_ms': {
+                'p50': percentil(50),
+                'p95': percentil(95),
+                'p99': percentil(99),
+                'max': percentil(100),
+            },
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('rastro', help='arquivo gravado pelo servidor')
+    parser.add_argument(
+        '--velocidade',
+        type=float,
+        default=1.0,
+        help='fator de aceleração, de 1 a 100',
+    )
+    parser.add_argument(
+        '--drenagem',
+        type=float,
+        default=5.0,
+        help='segundos aguardando entregas pendentes ao final',
+    )
+    parser.add_argument(
+        '--janela-saida',
+        type=float,
+        default=JANELA_SAIDA,
+        help='segundos antes da saída de um membro em que entregas não '
+        'recebidas contam como em trânsito, e não como perdas',
+    )
+    parser.add_argument(
+        '--taxa',
+        type=float,
+        default=1000.0,
+        help='conexões admitidas por segundo no servidor local',
+    )
+    parser.add_argument('--json', help='grava o resultado neste arquivo')
+    args = parser.parse_args()
+
+    if not 1 <= args.velocidade <= 100:
+        parser.error('--velocidade deve estar entre 1 e 100')
+
+    redigido, eventos = ler_rastro(args.rastro)
+    with tempfile.TemporaryDirectory() as pasta:
+        servidor = criar_servidor(pasta)
+        # Todas as sessões reproduzidas vêm do mesmo IP
+        servidor.admissao = ControleAdmissao(
+            taxa=args.taxa, rajada=max(100, int(args.taxa)), max_por_ip=10000
+        )
+        porta = iniciar_servidor(servidor)
+        reproducao = Reproducao(porta, redigido, args.janela_saida)
+
+        inicio = time.monotonic()
+        try:
+            reproducao.executar(eventos, args.velocidade, args.drenagem)
+        finally:
+            parar_servidor(servidor)
+    resultado = reproducao.resultado(eventos, time.monotonic() - inicio)
+
+    for chave, valor in resultado.items():
+        if chave != 'latencia_ms':
+            print(f'{chave:>20}: {valor}')
+    for chave, valor in resultado['latencia_ms'].items():
+        print(f'{"latência " + chave + " (ms)":>20}: {valor}')
+
+    if args.json:
+        with open(args.json, 'w') as arquivo:
+            json.dump(resultado, arquivo, indent=2)
+
+
+if __name__ == '__main__':
+    main()
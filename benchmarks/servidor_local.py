@@ -0,0 +1,64 @@
+"""Servidor sem interface compartilhado pelos benchmarks de ponta a ponta
+
+Os benchmarks criam o servidor com criar_servidor, ajustam o que querem medir
+(admissão, perfil de rede, entrega) e o sobem com iniciar_servidor numa porta
+livre de localhost; parar_servidor o encerra.
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servidor import Servidor
+
+
+def criar_servidor(diretorio):
+    """Cria um servidor sem interface e sem log
+
+    Args:
+        diretorio: Diretório base do estado do servidor
+
+    Returns:
+        Servidor: Servidor ainda parado
+    """
+    servidor = Servidor(diretorio=diretorio)
+    servidor.log = lambda mensagem: None
+    return servidor
+
+
+def iniciar_servidor(servidor, caminho_unix=None):
+    """Sobe o servidor numa porta livre de localhost e espera ele ficar pronto
+
+    Args:
+        servidor: Servidor criado por criar_servidor
+        caminho_unix: Caminho de um socket Unix em que o servidor também escuta, ou None
+
+    Returns:
+        int: Porta TCP do servidor
+    """
+    servidor.servidor_rodando = True
+    servidor.thread_servidor = threading.Thread(
+        target=servidor.executar_servidor,
+        args=('127.0.0.1', 0, caminho_unix),
+        daemon=True,
+    )
+    servidor.thread_servidor.start()
+    if not servidor.servidor_pronto.wait(5):
+        raise RuntimeError('Servidor não iniciou')
+    return servidor.server.getsockname()[1]
+
+
+def parar_servidor(servidor):
+    """Para o servidor e retorna os segundos até o loop de aceite sair"""
+    inicio = time.perf_counter()
+    servidor.servidor_rodando = False
+    servidor.despertar()
+    # O loop limpa servidor_pronto assim que sai, antes de parar as threads
+    while servidor.servidor_pronto.is_set():
+        time.sleep(0.0001)
+    parada = time.perf_counter() - inicio
+    servidor.thread_servidor.join(5)
+    return parada
@@ -0,0 +1,692 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+import hashlib
+import json
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+from protocolo import (
+    ErroProtocolo,
+    codificar_texto,
+    codificar_varint,
+    ler_texto,
+    ler_varint,
+)
+
+MARCADOR_BUSCAR = '#BUSCAR#'
+MARCADOR_RESULTADO = '#RESULTADO_BUSCA#'
+MARCADOR_FIM = '#FIM_BUSCA#'
+ASSINATURA_INDICE = b'CSIX\x01'
+LIMITE_PADRAO = 20
+LIMITE_MAX = 100
+MAX_VERIFICACOES = 20000
+MAX_TERMOS_CONSULTA = 8
+TAMANHO_MAX_TERMO = 32
+TAMANHO_MAX_TRECHO = 500
+MAX_MENSAGENS_SALA = 50000
+INTERVALO_COMPACTACAO = 30.0
+PADRAO_TERMO = re.compile(r'\w{2,}')
+# Estimativas de memória: horário, posição na lista e tupla de cada mensagem;
+# posição e inteiro de cada postagem recente; array e entrada de cada termo
+CUSTO_MENSAGEM = 16 + sys.getsizeof((None, None))
+CUSTO_POSTAGEM_RECENTE = 8 + sys.getsizeof(2**16)
+CUSTO_TERMO = sys.getsizeof(array('I')) + 48
+
+
+class ErroBusca(Exception):
+    """Erro no pedido de busca ou no arquivo de índice"""
+
+
+def extrair_termos(texto):
+    """Separa os termos indexáveis de um texto, sem acentos e em minúsculas
+
+    Args:
+        texto: Texto da mensagem ou da consulta
+
+    Returns:
+        set: Termos distintos do texto
+    """
+    texto = texto.casefold()
+    if not texto.isascii():
+        texto = ''.join(
+            caractere
+            for caractere in unicodedata.normalize('NFKD', texto)
+            if not unicodedata.combining(caractere)
+        )
+    return {
+        sys.intern(termo[:TAMANHO_MAX_TERMO])
+        for termo in PADRAO_TERMO.findall(texto)
+    }
+
+
+def contem(segmentos, seq):
+    """Verifica se alguma das listas ordenadas de postagens contém a sequência"""
+    for segmento in segmentos:
+        if segmento[0] <= seq <= segmento[-1]:
+            posicao = bisect_left(segmento, seq)
+            if segmento[posicao] == seq:
+                return True
+    return False
+
+
+class IndiceSala:
+    """Índice invertido das mensagens de uma sala
+
+    Cada mensagem recebe uma sequência crescente. As postagens de cada termo ficam em
+    dois segmentos: a base compactada (arrays de inteiros) e as recentes (listas), que
+    recebem as mensagens novas em tempo constante. A compactação funde as recentes na
+    base fora do lock, sem alterar os arrays que uma busca em andamento pode estar lendo.
+
+    O índice mantém uma estimativa dos bytes que ocupa, usada no orçamento de memória.
+    """
+
+    __slots__ = (
+        'sala',
+        'primeiro',
+        'momentos',
+        'mensagens',
+        'base',
+        'compactando',
+        'recentes',
+        'coberto',
+        'alterado',
+        'tamanho_mensagens',
+        'tamanho_postagens',
+        'descartado',
+        'lock',
+    )
+
+    def __init__(self, sala):
+        """Inicializa o índice vazio
+
+        Args:
+            sala: Nome da sala
+        """
+        self.sala = sala
+        self.primeiro = 0
+        self.momentos = array('d')
+        self.mensagens = []
+        self.base = {}
+        self.compactando = None
+        self.recentes = {}
+        self.coberto = 0
+        self.alterado = False
+        self.tamanho_mensagens = 0
+        self.tamanho_postagens = 0
+        self.descartado = False
+        self.lock = threading.Lock()
+
+    @property
+    def tamanho(self):
+        """Bytes estimados das mensagens e postagens do índice"""
+        return self.tamanho_mensagens + self.tamanho_postagens
+
+    def indexar(self, nome, texto, momento=None):
+        """Acrescenta uma mensagem ao índice
+
+        Args:
+            nome: Nome do autor
+            texto: Texto da mensagem
+            momento: Horário da mensagem; por padrão, o atual
+
+        Returns:
+            bool: False se o índice foi descartado e a mensagem não entrou nele
+        """
+        termos = extrair_termos(texto)
+        if momento is None:
+            momento = time.time()
+        with self.lock:
+            if self.descartado:
+                return False
+            # Os horários precisam ser crescentes para a busca por intervalo
+            if self.momentos and momento < self.momentos[-1]:
+                momento = self.momentos[-1]
+            seq = self.primeiro + len(self.mensagens)
+            self.momentos.append(momento)
+            self.mensagens.append((nome, texto))
+            for termo in termos:
+                postagens = self.recentes.get(termo)
+                if postagens is None:
+                    self.recentes[termo] = [seq]
+                else:
+                    postagens.append(seq)
+            self.alterado = True
+            self.tamanho_mensagens += sys.getsizeof(texto) + CUSTO_MENSAGEM
+            self.tamanho_postagens += len(termos) * CUSTO_POSTAGEM_RECENTE
+        return True
+
+    def postagens(self, termo):
+        """Retorna os segmentos não vazios de postagens de um termo, em ordem crescente"""
+        segmentos = []
+        for fonte in (self.base, self.compactando, self.recentes):
+            if fonte:
+                segmento = fonte.get(termo)
+                if segmento:
+                    segmentos.append(segmento)
+        return segmentos
+
+    def buscar(self, termos, desde=None, ate=None, limite=LIMITE_PADRAO):
+        """Busca as mensagens mais recentes que contêm todos os termos
+
+        O custo é limitado: no máximo MAX_VERIFICACOES candidatas são examinadas,
+        percorrendo do fim para o começo as postagens do termo mais raro.
+
+        Args:
+            termos: Termos já extraídos da consulta
+            desde: Horário mínimo das mensagens, ou None
+            ate: Horário máximo das mensagens, ou None
+            limite: Quantidade máxima de resultados
+
+        Returns:
+            tuple: (lista de tuplas (momento, nome, texto), da mais recente para a mais antiga; True se a busca foi interrompida)
+        """
+        if not termos:
+            return [], False
+
+        resultados = []
+        with self.lock:
+            inicio = 0 if desde is None else bisect_left(self.momentos, desde)
+            fim = (
+                len(self.momentos)
+                if ate is None
+                else bisect_right(self.momentos, ate)
+            )
+            seq_inicio = self.primeiro + inicio
+            seq_fim = self.primeiro + fim
+            if seq_inicio >= seq_fim:
+                return [], False
+
+            listas = [self.postagens(termo) for termo in termos]
+            if not all(listas):
+                return [], False
+            listas.sort(key=lambda segmentos: sum(map(len, segmentos)))
+            principal, outras = listas[0], listas[1:]
+
+            verificacoes = 0
+            for segmento in reversed(principal):
+                acima = bisect_left(segmento, seq_fim)
+                abaixo = bisect_left(segmento, seq_inicio)
+                for posicao in range(acima - 1, abaixo - 1, -1):
+                    verificacoes += 1
+                    if verificacoes > MAX_VERIFICACOES:
+                        return resultados, True
+
+                    seq = segmento[posicao]
+                    if all(contem(segmentos, seq) for segmentos in outras):
+                        indice = seq - self.primeiro
+                        nome, texto = self.mensagens[indice]
+                        resultados.append((self.momentos[indice], nome, texto))
+                        if len(resultados) >= limite:
+                            return resultados, False
+
+        return resultados, False
+
+    def compactar(self, maximo_mensagens=MAX_MENSAGENS_SALA):
+        """Funde as postagens recentes na base e descarta as mensagens mais antigas que o limite
+
+        Args:
+            maximo_mensagens: Quantidade de mensagens mantidas na sala
+
+        Returns:
+            bool: True se o índice mudou desde a última compactação
+        """
+        with self.lock:
+            if not self.alterado:
+                return False
+            self.alterado = False
+            self.compactando, self.recentes = self.recentes, {}
+            excesso = len(self.mensagens) - maximo_mensagens
+            if excesso > 0:
+                self.tamanho_mensagens -= sum(
+                    sys.getsizeof(texto) + CUSTO_MENSAGEM
+                    for _, texto in self.mensagens[:excesso]
+                )
+                del self.mensagens[:excesso]
+                self.momentos = self.momentos[excesso:]
+                self.primeiro += excesso
+            primeiro = self.primeiro
+            coberto = primeiro + len(self.mensagens)
+            base, compactando = self.base, self.compactando
+
+        nova_base = {}
+        for termo, segmento in base.items():
+            if segmento[-1] < primeiro:
+                continue
+            if segmento[0] < primeiro:
+                segmento = segmento[bisect_left(segmento, primeiro) :]
+            nova_base[termo] = segmento
+        for termo, postagens in compactando.items():
+            postagens = array('I', postagens)
+            if postagens[-1] < primeiro:
+                continue
+            if postagens[0] < primeiro:
+                postagens = postagens[bisect_left(postagens, primeiro) :]
+            anterior = nova_base.get(termo)
+            nova_base[termo] = (
+                postagens if anterior is None else anterior + postagens
+            )
+        tamanho_base = sum(
+            CUSTO_TERMO + segmento.itemsize * len(segmento)
+            for segmento in nova_base.values()
+        )
+
+        with self.lock:
+            self.base = nova_base
+            self.coberto = coberto
+            self.compactando = None
+            recentes = sum(map(len, self.recentes.values()))
+            self.tamanho_postagens = (
+                tamanho_base + CUSTO_POSTAGEM_RECENTE * recentes
+            )
+        return True
+
+    def salvar(self, caminho):
+        """Grava no disco as mensagens e as postagens já compactadas
+
+        Mensagens indexadas depois da última compactação ficam para a próxima gravação.
+
+        Args:
+            caminho: Arquivo do índice, substituído de forma atômica
+        """
+        with self.lock:
+            base = self.base
+            primeiro = self.primeiro
+            coberto = max(self.coberto, primeiro)
+            total = coberto - primeiro
+            momentos = self.momentos[:total]
+            mensagens = self.mensagens[:total]
+
+        dados = bytearray(ASSINATURA_INDICE)
+        dados += codificar_texto(self.sala)
+        dados += codificar_varint(primeiro)
+        dados += codificar_varint(total)
+        anterior = 0
+        for momento, (nome, texto) in zip(momentos, mensagens):
+            milissegundos = int(momento * 1000)
+            dados += codificar_varint(max(0, milissegundos - anterior))
+            anterior = max(anterior, milissegundos)
+            dados += codificar_texto(nome)
+            dados += codificar_texto(texto)
+
+        termos = [
+            (termo, segmento)
+            for termo, segmento in base.items()
+            if segmento[0] < coberto
+        ]
+        dados += codificar_varint(len(termos))
+        for termo, segmento in termos:
+            dados += codificar_texto(termo)
+            fim = bisect_left(segmento, coberto)
+            dados += codificar_varint(fim)
+            anterior = primeiro
+            for seq in segmento[:fim]:
+                dados += codificar_varint(seq - anterior)
+                anterior = seq
+
+        temporario = caminho + '.tmp'
+        with open(temporario, 'wb') as arquivo:
+            arquivo.write(dados)
+        os.replace(temporario, caminho)
+
+    @classmethod
+    def carregar(cls, caminho):
+        """Lê um índice gravado por salvar
+
+        Args:
+            caminho: Arquivo do índice
+
+        Returns:
+            IndiceSala: Índice com as mensagens e postagens gravadas
+        """
+        with open(caminho, 'rb') as arquivo:
+            dados = arquivo.read()
+        if not dados.startswith(ASSINATURA_INDICE):
+            raise ErroBusca(f'Arquivo de índice inválido: {caminho}')
+
+        try:
+            sala, posicao = ler_texto(dados, len(ASSINATURA_INDICE))
+            indice = cls(sala)
+            indice.primeiro, posicao = ler_varint(dados, posicao)
+            total, posicao = ler_varint(dados, posicao)
+            milissegundos = 0
+            for _ in range(total):
+                intervalo, posicao = ler_varint(dados, posicao)
+                milissegundos += intervalo
+                nome, posicao = ler_texto(dados, posicao)
+                texto, posicao = ler_texto(dados, posicao)
+                indice.momentos.append(milissegundos / 1000)
+                indice.mensagens.append((sys.intern(nome), texto))
+                indice.tamanho_mensagens += (
+                    sys.getsizeof(texto) + CUSTO_MENSAGEM
+                )
+
+            total_termos, posicao = ler_varint(dados, posicao)
+            for _ in range(total_termos):
+                termo, posicao = ler_texto(dados, posicao)
+                quantidade, posicao = ler_varint(dados, posicao)
+                segmento = array('I')
+                seq = indice.primeiro
+                for _ in range(quantidade):
+                    intervalo, posicao = ler_varint(dados, posicao)
+                    seq += intervalo
+                    segmento.append(seq)
+                if segmento:
+                    indice.base[sys.intern(termo)] = segmento
+                    indice.tamanho_postagens += (
+                        CUSTO_TERMO + segmento.itemsize * len(segmento)
+                    )
+            indice.coberto = indice.primeiro + total
+        except ErroProtocolo as e:
+            raise ErroBusca(f'Arquivo de índice corrompido: {caminho}') from e
+        return indice
+
+
+class IndiceBusca:
+    """Índices de busca de todas as salas, compactados e gravados em segundo plano
+
+    Com um orçamento de memória, os índices das salas usadas há mais tempo são gravados
+    e tirados da memória; o próximo uso os lê de novo do disco.
+    """
+
+    def __init__(
+        self,
+        pasta,
+        maximo_mensagens=MAX_MENSAGENS_SALA,
+        intervalo=INTERVALO_COMPACTACAO,
+        orcamento=None,
+    ):
+        """Inicializa o conjunto de índices; os arquivos de cada sala são lidos no primeiro uso
+
+        Args:
+            pasta: Pasta dos arquivos de índice
+            maximo_mensagens: Mensagens mantidas por sala
+            intervalo: Segundos entre compactações
+            orcamento: OrcamentoMemoria que limita o total dos índices em memória, ou None
+        """
+        self.pasta = pasta
+        self.maximo_mensagens = maximo_mensagens
+        self.intervalo = intervalo
+        self.salas = {}
+        self.lock = threading.Lock()
+        # Serializa as gravações da compactação e dos descartes
+        self.lock_gravacao = threading.Lock()
+        self.parar_compactacao = threading.Event()
+        self.thread_compactacao = None
+        self.orcamento = orcamento
+        if orcamento is not None:
+            orcamento.registrar_dono('busca', self.descartar)
+
+    def caminho(self, sala):
+        """Retorna o arquivo do índice de uma sala"""
+        nome = hashlib.sha1(sala.encode()).hexdigest()
+        return os.path.join(self.pasta, f'{nome}.idx')
+
+    def obter(self, sala):
+        """Retorna o índice de uma sala, lendo-o do disco na primeira vez
+
+        Args:
+            sala: Nome da sala
+
+        Returns:
+            IndiceSala: Índice da sala
+        """
+        indice = self.salas.get(sala)
+        if indice is not None:
+            return indice
+
+        with self.lock:
+            indice = self.salas.get(sala)
+            if indice is None:
+                caminho = self.caminho(sala)
+                indice = IndiceSala(sala)
+                if os.path.exists(caminho):
+                    try:
+                        indice = IndiceSala.carregar(caminho)
+                    except (OSError, ErroBusca):
+                        pass
+                self.salas[sala] = indice
+                self.usar(indice)
+            return indice
+
+    def usar(self, indice):
+        """Informa ao orçamento de memória o uso e o tamanho de um índice"""
+        if self.orcamento is not None:
+            self.orcamento.usar('busca', indice.sala, indice.tamanho)
+
+    def indexar(self, sala, nome, texto):
+        """Acrescenta uma mensagem ao índice da sala"""
+        # Se o índice foi descartado entre obtê-lo e indexar, lê de novo
+        indice = self.obter(sala)
+        while not indice.indexar(nome, texto):
+            indice = self.obter(sala)
+        self.usar(indice)
+
+    def descartar(self, sala):
+        """Grava o índice de uma sala e o tira da memória
+
+        O lock do conjunto fica retido até o fim da gravação, para que um novo uso da
+        sala não leia o arquivo antes de ele estar completo.
+
+        Args:
+            sala: Nome da sala
+        """
+        with self.lock_gravacao, self.lock:
+            indice = self.salas.pop(sala, None)
+            if indice is None:
+                return
+            with indice.lock:
+                indice.descartado = True
+            if indice.compactar(self.maximo_mensagens):
+                try:
+                    indice.salvar(self.caminho(sala))
+                except OSError:
+                    pass
+
+    def buscar(self, sala, pedido):
+        """Executa um pedido de busca na sala
+
+        Args:
+            sala: Nome da sala
+            pedido: Dicionário retornado por ler_pedido
+
+        Returns:
+            tuple: (resultados, truncado), como em IndiceSala.buscar
+        """
+        termos = list(extrair_termos(pedido['termos']))[:MAX_TERMOS_CONSULTA]
+        indice = self.obter(sala)
+        self.usar(indice)
+        return indice.buscar(
+            termos, pedido['desde'], pedido['ate'], pedido['limite']
+        )
+
+    def compactar(self):
+        """Compacta e grava os índices que mudaram desde a última compactação"""
+        with self.lock_gravacao:
+            with self.lock:
+                indices = list(self.salas.values())
+            for indice in indices:
+                if indice.compactar(self.maximo_mensagens):
+                    try:
+                        indice.salvar(self.caminho(indice.sala))
+                    except OSError:
+                        pass
+
+    def executar_compactacao(self):
+        """Loop da thread de compactação"""
+        while not self.parar_compactacao.wait(self.intervalo):
+            self.compactar()
+
+    def iniciar(self):
+        """Cria a pasta dos índices e inicia a thread de compactação em segundo plano"""
+        if self.thread_compactacao is not None:
+            return
+        os.makedirs(self.pasta, exist_ok=True)
+        self.parar_compactacao.clear()
+        self.thread_compactacao = threading.Thread(
+            target=self.executar_compactacao, daemon=True
+        )
+        self.thread_compactacao.start()
+
+    def parar(self):
+        """Encerra a thread de compactação e grava o estado final dos índices"""
+        if self.thread_compactacao is None:
+            return
+        self.parar_compactacao.set()
+        self.thread_compactacao.join()
+        self.thread_compactacao = None
+        self.compactar()
+
+
+def ler_horario(valor):
+    """Converte uma data ISO 8601 (ex.: 2024-05-01 ou 2024-05-01T14:30) em horário Unix"""
+    try:
+        return datetime.fromisoformat(valor).timestamp()
+    except ValueError:
+        raise ErroBusca(f'Data inválida: {valor}')
+
+
+def interpretar_consulta(texto):
+    """Interpreta a consulta digitada pelo usuário
+
+    Palavras no formato desde:DATA e ate:DATA limitam o intervalo de tempo; as demais
+    são os termos buscados.
+
+    Args:
+        texto: Consulta digitada
+
+    Returns:
+        dict: Pedido com termos, desde, ate e limite
+    """
+    termos = []
+    desde = ate = None
+    for palavra in texto.split():
+        chave, separador, valor = palavra.partition(':')
+        if separador and chave.casefold() == 'desde' and valor:
+            desde = ler_horario(valor)
+        elif separador and chave.casefold() in ('ate', 'até') and valor:
+            ate = ler_horario(valor)
+        else:
+            termos.append(palavra)
+
+    if not extrair_termos(' '.join(termos)):
+        raise ErroBusca('Informe ao menos um termo com duas letras ou mais')
+    return {
+        'termos': ' '.join(termos),
+        'desde': desde,
+        'ate': ate,
+        'limite': LIMITE_PADRAO,
+    }
+
+
+def montar_pedido(pedido):
+    """Monta a linha de pedido de busca enviada pelo cliente
+
+    Args:
+        pedido: Dicionário retornado por interpretar_consulta
+
+    Returns:
+        str: Linha do protocolo
+    """
+    return MARCADOR_BUSCAR + json.dumps(pedido, separators=(',', ':'))
+
+
+def ler_pedido(linha):
+    """Valida uma linha de pedido de busca recebida pelo servidor
+
+    Args:
+        linha: Linha iniciada por MARCADOR_BUSCAR
+
+    Returns:
+        dict: Pedido com termos, desde, ate e limite
+    """
+    try:
+        pedido = json.loads(linha[len(MARCADOR_BUSCAR) :])
+    except ValueError:
+        raise ErroBusca('Pedido de busca malformado')
+    if not isinstance(pedido, dict) or not isinstance(
+        pedido.get('termos'), str
+    ):
+        raise ErroBusca('Pedido de busca sem termos')
+
+    intervalo = []
+    for chave in ('desde', 'ate'):
+        valor = pedido.get(chave)
+        if valor is not None and not isinstance(valor, (int, float)):
+            raise ErroBusca(f'Valor inválido para {chave}')
+        intervalo.append(valor)
+
+    limite = pedido.get('limite', LIMITE_PADRAO)
+    if not isinstance(limite, int):
+        limite = LIMITE_PADRAO
+    return {
+        'termos': pedido['termos'],
+        'desde': intervalo[0],
+        'ate': intervalo[1],
+        'limite': max(1, min(limite, LIMITE_MAX)),
+    }
+
+
+def montar_resultado(momento, nome, texto):
+    """Monta a linha de um resultado de busca enviada pelo servidor"""
+    if len(texto) > TAMANHO_MAX_TRECHO:
+        texto = texto[:TAMANHO_MAX_TRECHO] + '…'
+    return MARCADOR_RESULTADO + json.dumps(
+        {'momento': momento, 'nome': nome, 'texto': texto},
+        separators=(',', ':'),
+    )
+
+
+def montar_fim(total, truncado=False, erro=None):
+    """Monta a linha que encerra os resultados de uma busca
+
+    Args:
+        total: Quantidade de resultados enviados
+        truncado: Se a busca parou antes de examinar todas as mensagens
+        erro: Mensagem de erro, se o pedido foi recusado
+    """
+    return MARCADOR_FIM + json.dumps(
+        {'total': total, 'truncado': truncado, 'erro': erro},
+        separators=(',', ':'),
+    )
+
+
+def ler_resposta(linha):
+    """Interpreta uma linha de resposta de busca recebida pelo cliente
+
+    Args:
+        linha: Linha recebida do servidor
+
+    Returns:
+        tuple: ('resultado' ou 'fim', dados), ou None se a linha não é de busca
+    """
+    for marcador, tipo in (
+        (MARCADOR_RESULTADO, 'resultado'),
+        (MARCADOR_FIM, 'fim'),
+    ):
+        if linha.startswith(marcador):
+            try:
+                dados = json.loads(linha[len(marcador) :])
+            except ValueError:
+                return None
+            return (tipo, dados) if isinstance(dados, dict) else None
+    return None
+
+
+def formatar_resultado(resultado):
+    """Formata um resultado de busca para exibição
+
+    Args:
+        resultado: Dados de uma linha de resultado
+
+    Returns:
+        str: Linha com data, autor e texto
+    """
+    momento = time.strftime(
+        '%d/%m/%Y %H:%M', time.localtime(resultado.get('momento', 0))
+    )
+    return f'[{momento}] {resultado.get("nome")}: {resultado.get("texto")}'
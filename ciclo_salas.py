@@ -0,0 +1,183 @@
+from collections import OrderedDict
+import threading
+import time
+
+PRAZO_SALA_VAZIA = 300.0
+INTERVALO_VARREDURA = 5.0
+LIMITE_MEMORIA_FRIA = 64 * 1024 * 1024
+CUSTO_ENTRADA = 256
+
+
+class OrcamentoMemoria:
+    """LRU do estado frio das salas, como buffers de repetição e índices de busca, com um orçamento global de bytes
+
+    Cada dono (por exemplo, 'busca' ou 'retomada') informa o tamanho estimado do estado
+    de uma sala sempre que o usa; a entrada vai para o fim da fila. Quando o total passa
+    do limite, liberar descarta as entradas usadas há mais tempo, chamando a função de
+    descarte do dono com o nome da sala, até o total voltar ao limite.
+    """
+
+    def __init__(self, limite=LIMITE_MEMORIA_FRIA):
+        """Inicializa o orçamento vazio
+
+        Args:
+            limite: Bytes de estado frio mantidos em memória, somados todos os donos
+        """
+        self.limite = limite
+        self.donos = {}
+        self.entradas = OrderedDict()
+        self.usado = 0
+        self.descartes = 0
+        self.lock = threading.Lock()
+
+    def registrar_dono(self, dono, descartar):
+        """Registra um dono de estado frio
+
+        Args:
+            dono: Nome do dono
+            descartar: Função chamada com o nome da sala para tirar o estado dela da memória
+        """
+        self.donos[dono] = descartar
+
+    def usar(self, dono, sala, tamanho):
+        """Marca o estado de uma sala como usado agora e atualiza o seu tamanho
+
+        Args:
+            dono: Nome do dono registrado
+            sala: Nome da sala
+            tamanho: Bytes estimados do estado
+        """
+        chave = (dono, sala)
+        tamanho += CUSTO_ENTRADA
+        with self.lock:
+            anterior = self.entradas.get(chave)
+            if anterior is None:
+                self.entradas[chave] = tamanho
+            else:
+                self.entradas.move_to_end(chave)
+                self.entradas[chave] = tamanho
+                self.usado -= anterior
+            self.usado += tamanho
+
+    def esquecer(self, dono, sala):
+        """Retira uma entrada do orçamento sem chamar o descarte"""
+        with self.lock:
+            tamanho = self.entradas.pop((dono, sala), None)
+            if tamanho is not None:
+                self.usado -= tamanho
+
+    def liberar(self):
+        """Descarta o estado usado há mais tempo até o total voltar ao limite
+
+        O descarte é feito fora do lock; um estado usado de novo depois de escolhido
+        é descartado assim mesmo, e o dono volta a registrá-lo no próximo uso.
+
+        Returns:
+            int: Quantidade de entradas descartadas
+        """
+        escolhidas = []
+        with self.lock:
+            while self.usado > self.limite and self.entradas:
+                chave, tamanho = self.entradas.popitem(last=False)
+                self.usado -= tamanho
+                escolhidas.append(chave)
+            self.descartes += len(escolhidas)
+
+        for dono, sala in escolhidas:
+            self.donos[dono](sala)
+        return len(escolhidas)
+
+    def estatisticas(self):
+        """Retorna os bytes estimados em uso, o limite, as entradas e os descartes feitos"""
+        with self.lock:
+            return {
+                'usado': self.usado,
+                'limite': self.limite,
+                'entradas': len(self.entradas),
+                'descartes': self.descartes,
+            }
+
+
+class CicloSalas:
+    """Despejo das salas que ficam vazias além de um prazo e liberação periódica do estado frio
+
+    Guarda desde quando cada sala está vazia. Esse registro é protegido pelo lock das
+    salas do servidor, sob o qual marcar_vazia, marcar_ocupada e vencidas devem ser
+    chamadas. Uma thread chama periodicamente a função de despejo do servidor e, em
+    seguida, libera o orçamento de memória fria.
+    """
+
+    def __init__(
+        self,
+        despejar,
+        orcamento=None,
+        prazo=PRAZO_SALA_VAZIA,
+        intervalo=INTERVALO_VARREDURA,
+    ):
+        """Inicializa o ciclo
+
+        Args:
+            despejar: Função chamada com o instante atual do relógio monotônico para despejar as salas vencidas
+            orcamento: OrcamentoMemoria liberado a cada varredura, ou None
+            prazo: Segundos que uma sala pode ficar vazia antes de ser despejada
+            intervalo: Segundos entre varreduras
+        """
+        self.despejar = despejar
+        self.orcamento = orcamento
+        self.prazo = prazo
+        self.intervalo = intervalo
+        self.vazias = {}
+        self.parar_varredura = threading.Event()
+        self.thread_varredura = None
+
+    def marcar_vazia(self, sala_id, agora=None):
+        """Registra que a sala ficou vazia, mantendo o instante anterior se já estava; chamar sob o lock das salas"""
+        if sala_id not in self.vazias:
+            self.vazias[sala_id] = (
+                time.monotonic() if agora is None else agora
+            )
+
+    def marcar_ocupada(self, sala_id):
+        """Cancela o despejo de uma sala que recebeu um membro; chamar sob o lock das salas"""
+        self.vazias.pop(sala_id, None)
+
+    def vencidas(self, agora):
+        """Retira do registro e retorna as salas vazias há mais que o prazo; chamar sob o lock das salas"""
+        limite = agora - self.prazo
+        salas = [
+            sala_id
+            for sala_id, desde in self.vazias.items()
+            if desde <= limite
+        ]
+        for sala_id in salas:
+            del self.vazias[sala_id]
+        return salas
+
+    def varrer(self):
+        """Despeja as salas vencidas e libera o estado frio acima do orçamento"""
+        self.despejar(time.monotonic())
+        if self.orcamento is not None:
+            self.orcamento.liberar()
+
+    def executar_varredura(self):
+        """Loop da thread de varredura"""
+        while not self.parar_varredura.wait(self.intervalo):
+            self.varrer()
+
+    def iniciar(self):
+        """Inicia a thread de varredura"""
+        if self.thread_varredura is not None:
+            return
+        self.parar_varredura.clear()
+        self.thread_varredura = threading.Thread(
+            target=self.executar_varredura, daemon=True
+        )
+        self.thread_varredura.start()
+
+    def parar(self):
+        """Encerra a thread de varredura"""
+        if self.thread_varredura is None:
+            return
+        self.parar_varredura.set()
+        self.thread_varredura.join()
+        self.thread_varredura = None
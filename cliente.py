@@ -1,8 +1,121 @@
-import socket
+from collections import deque
+import os
+import queue
+import sys
 import threading
 import tkinter as tk
-from tkinter import messagebox, PhotoImage
-import time
+from tkinter import filedialog, messagebox, PhotoImage
+
+import anexos
+import busca
+import diretas
+from perfis_rede import PERFIL_BAIXA_LATENCIA, obter_perfil
+from historico import HistoricoLocal
+from presenca import MARCADOR_MEMBROS, ListaMembros
+from quadros import (
+    MARCADOR_BINARIO,
+    DecodificadorQuadros,
+    formatar_direta,
+    formatar_evento,
+    formatar_mensagem,
+)
+from retomada import MARCADOR_RETOMAR, MARCADOR_SESSAO
+from protocolo import (
+    MARCADOR_LISTAR_SALAS,
+    PREFIXO_UNIX,
+    TAMANHO_MAX_MENSAGEM,
+    ConexaoChat,
+    aguardar_eventos,
+    calcular_espera_reconexao,
+    formatar_endereco,
+)
+
+CAMINHO_HISTORICO = os.path.join(
+    os.path.expanduser('~'), '.chat_socket', 'historico.db'
+)
+LINHAS_JANELA = 500
+LINHAS_PAGINA = 100
+# O chat é interativo: cada mensagem sai na hora, sem esperar o algoritmo de Nagle
+PERFIL_CONEXAO = PERFIL_BAIXA_LATENCIA
+
+
+class LoopTk:
+    """Conduz conexões não bloqueantes a partir do loop de eventos do Tk, sem threads"""
+
+    def __init__(self, widget, intervalo_ms=20):
+        """Inicializa o loop
+
+        Args:
+            widget: Widget cujo interpretador Tk monitora os sockets
+            intervalo_ms: Intervalo de verificação quando o Tk não monitora descritores (Windows)
+        """
+        self.widget = widget
+        self.intervalo_ms = intervalo_ms
+        self.conexoes = set()
+        self.agendamento = None
+        self.usar_handlers = sys.platform != 'win32' and hasattr(
+            widget.tk, 'createfilehandler'
+        )
+
+    def registrar(self, conexao):
+        """Passa a monitorar uma conexão
+
+        Args:
+            conexao: Conexão recém iniciada
+        """
+        self.conexoes.add(conexao)
+        self.atualizar(conexao)
+
+    def atualizar(self, conexao):
+        """Ajusta os eventos monitorados conforme a conexão tenha ou não dados para enviar
+
+        Args:
+            conexao: Conexão monitorada
+        """
+        if self.usar_handlers:
+            mascara = tk.READABLE
+            if conexao.quer_escrever():
+                mascara |= tk.WRITABLE
+            self.widget.tk.createfilehandler(
+                conexao.sock,
+                mascara,
+                lambda arquivo, eventos: self.despachar(conexao, eventos),
+            )
+        elif self.agendamento is None:
+            self.agendamento = self.widget.after(
+                self.intervalo_ms, self.verificar
+            )
+
+    def remover(self, conexao):
+        """Deixa de monitorar uma conexão prestes a ser fechada
+
+        Args:
+            conexao: Conexão monitorada
+        """
+        self.conexoes.discard(conexao)
+        if self.usar_handlers:
+            self.widget.tk.deletefilehandler(conexao.sock)
+
+    def despachar(self, conexao, eventos):
+        """Repassa à conexão os eventos informados pelo Tk
+
+        Args:
+            conexao: Conexão monitorada
+            eventos: Máscara de eventos do Tk
+        """
+        if eventos & tk.WRITABLE and conexao.aberta:
+            conexao.processar_escrita()
+        if eventos & tk.READABLE and conexao.aberta:
+            conexao.processar_leitura()
+
+    def verificar(self):
+        """Verifica as conexões sem esperar, reagendando enquanto houver conexões abertas"""
+        self.agendamento = None
+        aguardar_eventos(list(self.conexoes), 0)
+        if self.conexoes:
+            self.agendamento = self.widget.after(
+                self.intervalo_ms, self.verificar
+            )
 
 
 class DialogBase(tk.Toplevel):
@@ -77,6 +190,8 @@ class ConfigDialog(DialogBase):
         super().__init__(parent, 'Conectar-se', '250x150')
         self.host = tk.StringVar()
         self.port = tk.StringVar()
+        self.teste = None
+        self.tempo_limite = None
         self.criar_widgets()
 
     def criar_widgets(self):
@@ -117,14 +232,15 @@ class ConfigDialog(DialogBase):
         button_frame = tk.Frame(frame)
         button_frame.grid(row=2, column=0, columnspan=2, pady=10)
 
-        tk.Button(
+        self.btn_conectar = tk.Button(
             button_frame,
             text='Conectar',
             command=self.on_ok,
             bg='#4CAF50',
             fg='white',
             width=10,
-        ).pack(side=tk.LEFT, padx=5)
+        )
+        self.btn_conectar.pack(side=tk.LEFT, padx=5)
         tk.Button(
             button_frame,
             text='Cancelar',
@@ -141,25 +257,28 @@ class ConfigDialog(DialogBase):
 
     def on_ok(self):
         """Valida os campos e testa a conexão antes de fechar o diálogo"""
-        if not self.validar_campos():
+        if self.teste is not None or not self.validar_campos():
             return
 
         host = self.host.get().strip()
-        port = int(self.port.get().strip())
+        # Em endereços unix: a porta não é usada
+        port = int(self.port.get().strip() or 0)
 
-        if self.testar_conexao(host, port):
-            self.result = (host, port)
-            self.destroy()
+        self.btn_conectar.config(state=tk.DISABLED)
+        self.testar_conexao(host, port)
 
     def validar_campos(self):
-        """Valida os campos de host e porta
+        """Valida os campos de host e porta; com um host unix:/caminho, a porta pode ficar vazia
 
         Returns:
             bool: True se os campos são válidos, False caso contrário
         """
-        if not self.host.get().strip():
+        host = self.host.get().strip()
+        if not host:
             messagebox.showerror('Erro', 'O campo Host não pode estar vazio')
             return False
+        if host.startswith(PREFIXO_UNIX) and not self.port.get().strip():
+            return True
 
         try:
             int(self.port.get().strip())
@@ -169,27 +288,64 @@ class ConfigDialog(DialogBase):
             return False
 
     def testar_conexao(self, host, port):
-        """Testa a conexão com o servidor
+        """Testa a conexão com o servidor sem bloquear a interface; o resultado chega em concluir_teste
 
         Args:
             host: Endereço do servidor
             port: Porta do servidor
+        """
 
-        Returns:
-            bool: True se a conexão foi bem sucedida, False caso contrário
+        def ao_conectar():
+            self.teste.fechar()
+            self.concluir_teste(host, port, None)
+
+        self.teste = ConexaoChat(
+            LoopTk(self),
+            host,
+            port,
+            ao_conectar=ao_conectar,
+            ao_desconectar=lambda erro: self.concluir_teste(host, port, erro),
+        )
+        self.tempo_limite = self.after(
+            3000, lambda: self.teste.encerrar('Tempo de conexão esgotado')
+        )
+        self.teste.iniciar()
+
+    def concluir_teste(self, host, port, erro):
+        """Fecha o diálogo se a conexão foi bem sucedida ou exibe o erro
+
+        Args:
+            host: Endereço do servidor
+            port: Porta do servidor
+            erro: Mensagem de erro, ou None em caso de sucesso
         """
-        try:
-            test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            test_socket.settimeout(3)
-            test_socket.connect((host, port))
-            test_socket.close()
-            return True
-        except Exception as e:
-            messagebox.showerror(
-                'Erro de Conexão',
-                f'Não foi possível conectar ao servidor {host}:{port}\n\nErro: {str(e)}',
-            )
-            return False
+        self.cancelar_teste()
+        if erro is None:
+            self.result = (host, port)
+            self.destroy()
+            return
+
+        messagebox.showerror(
+            'Erro de Conexão',
+            f'Não foi possível conectar ao servidor '
+            f'{formatar_endereco(host, port)}\n\nErro: {erro}',
+            parent=self,
+        )
+        self.btn_conectar.config(state=tk.NORMAL)
+
+    def cancelar_teste(self):
+        """Cancela o teste de conexão em andamento e seu tempo limite"""
+        if self.tempo_limite is not None:
+            self.after_cancel(self.tempo_limite)
+            self.tempo_limite = None
+        if self.teste is not None:
+            teste, self.teste = self.teste, None
+            teste.fechar()
+
+    def destroy(self):
+        """Cancela o teste pendente antes de fechar o diálogo"""
+        self.cancelar_teste()
+        super().destroy()
 
 
 class NomeDialog(DialogBase):
@@ -260,6 +416,8 @@ class SalaDialog(DialogBase):
         self.host = host
         self.port = port
         self.salas_disponiveis = []
+        self.consulta = None
+        self.tempo_limite = None
         self.criar_widgets()
         self.after(100, self.obter_salas)
 
@@ -344,31 +502,56 @@ class SalaDialog(DialogBase):
         self.btn_atualizar.pack(side=tk.RIGHT, padx=5)
 
     def obter_salas(self):
-        """Obtém a lista de salas disponíveis do servidor"""
+        """Solicita a lista de salas disponíveis ao servidor sem bloquear a interface"""
         self.status_label.config(text='Carregando salas...', fg='blue')
         self.sala_listbox.delete(0, tk.END)
         self.btn_entrar.config(state=tk.DISABLED)
+        self.cancelar_consulta()
+
+        self.consulta = ConexaoChat(
+            LoopTk(self),
+            self.host,
+            self.port,
+            handshake=(MARCADOR_LISTAR_SALAS,),
+            ao_receber=self.receber_lista_salas,
+            ao_desconectar=self.falha_consulta,
+        )
+        self.tempo_limite = self.after(
+            5000, lambda: self.consulta.encerrar('Tempo de resposta esgotado')
+        )
+        self.consulta.iniciar()
 
-        try:
-            with socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM
-            ) as temp_socket:
-                temp_socket.settimeout(5)
-                temp_socket.connect((self.host, self.port))
-
-                if temp_socket.recv(1024).decode() == 'SALA':
-                    temp_socket.send(b'#LISTAR_SALAS#')
-                    temp_socket.send(b'#LISTAR_SALAS#')
-
-                    salas_data = temp_socket.recv(1024).decode()
-                    self.atualizar_lista_salas(salas_data)
-                else:
-                    self.status_label.config(
-                        text='Erro ao comunicar com o servidor', fg='red'
-                    )
+    def receber_lista_salas(self, salas_data):
+        """Recebe a resposta do servidor e encerra a consulta
 
-        except Exception as e:
-            self.status_label.config(text=f'Erro: {str(e)}', fg='red')
+        Args:
+            salas_data: String com as salas disponíveis separadas por |
+        """
+        self.cancelar_consulta()
+        self.atualizar_lista_salas(salas_data)
+
+    def falha_consulta(self, erro):
+        """Exibe o erro de uma consulta encerrada antes da resposta
+
+        Args:
+            erro: Motivo do encerramento
+        """
+        self.cancelar_consulta()
+        self.status_label.config(text=f'Erro: {erro}', fg='red')
+
+    def cancelar_consulta(self):
+        """Cancela a consulta de salas em andamento e seu tempo limite"""
+        if self.tempo_limite is not None:
+            self.after_cancel(self.tempo_limite)
+            self.tempo_limite = None
+        if self.consulta is not None:
+            consulta, self.consulta = self.consulta, None
+            consulta.fechar()
+
+    def destroy(self):
+        """Cancela a consulta pendente antes de fechar o diálogo"""
+        self.cancelar_consulta()
+        super().destroy()
 
     def atualizar_lista_salas(self, salas_data):
         """Atualiza a interface com a lista de salas recebida
@@ -480,6 +663,92 @@ class NovaSalaDialog(DialogBase):
             )
 
 
+class BuscaDialog(DialogBase):
+    """Diálogo de busca no histórico da sala, com os resultados enviados pelo servidor"""
+
+    def __init__(self, parent, enviar_pedido):
+        """Inicializa o diálogo
+
+        Args:
+            parent: Janela pai do diálogo
+            enviar_pedido: Função que envia ao servidor o pedido de busca montado
+        """
+        super().__init__(parent, 'Buscar na Sala', '520x400')
+        self.enviar_pedido = enviar_pedido
+        self.criar_widgets()
+
+    def criar_widgets(self):
+        """Cria o campo da consulta, o botão de busca e a área de resultados"""
+        frame = tk.Frame(self, padx=10, pady=10)
+        frame.pack(fill=tk.BOTH, expand=True)
+
+        tk.Label(
+            frame,
+            text='Termos (opcional: desde:AAAA-MM-DD ate:AAAA-MM-DDTHH:MM)',
+        ).pack(anchor=tk.W)
+
+        consulta_frame = tk.Frame(frame)
+        consulta_frame.pack(fill=tk.X, pady=5)
+        self.consulta_entry = tk.Entry(consulta_frame)
+        self.consulta_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.consulta_entry.focus_set()
+        tk.Button(
+            consulta_frame,
+            text='Buscar',
+            command=self.on_ok,
+            bg='#2196F3',
+            fg='white',
+        ).pack(side=tk.RIGHT, padx=(5, 0))
+
+        self.status = tk.Label(frame, anchor=tk.W)
+        self.status.pack(fill=tk.X)
+
+        self.resultados_area = tk.Text(frame, wrap=tk.WORD, state=tk.DISABLED)
+        self.resultados_area.pack(fill=tk.BOTH, expand=True)
+
+        self.bind('<Return>', lambda e: self.on_ok())
+        self.bind('<Escape>', lambda e: self.on_cancel())
+
+    def on_ok(self):
+        """Valida a consulta e envia o pedido de busca"""
+        try:
+            pedido = busca.interpretar_consulta(self.consulta_entry.get())
+        except busca.ErroBusca as e:
+            messagebox.showwarning('Aviso', str(e), parent=self)
+            return
+
+        self.resultados_area.config(state=tk.NORMAL)
+        self.resultados_area.delete('1.0', tk.END)
+        self.resultados_area.config(state=tk.DISABLED)
+        if self.enviar_pedido(busca.montar_pedido(pedido)):
+            self.status.config(text='Buscando...')
+        else:
+            self.status.config(text='Sem conexão com o servidor')
+
+    def receber_resposta(self, tipo, dados):
+        """Exibe um resultado ou o resumo final da busca
+
+        Args:
+            tipo: 'resultado' ou 'fim'
+            dados: Dados da linha de resposta
+        """
+        if tipo == 'resultado':
+            self.resultados_area.config(state=tk.NORMAL)
+            self.resultados_area.insert(
+                tk.END, busca.formatar_resultado(dados) + '\n'
+            )
+            self.resultados_area.config(state=tk.DISABLED)
+        elif dados.get('erro'):
+            self.status.config(text=f'Busca recusada: {dados["erro"]}')
+        elif dados.get('truncado'):
+            self.status.config(
+                text=f'{dados.get("total", 0)} resultado(s); refine os '
+                'termos ou o período para ver mensagens mais antigas'
+            )
+        else:
+            self.status.config(text=f'{dados.get("total", 0)} resultado(s)')
+
+
 class ClienteChat:
     """Classe principal do cliente de chat, responsável por gerenciar a interface e a comunicação com o servidor"""
 
@@ -514,12 +783,26 @@ class ClienteChat:
         """Inicializa as variáveis de controle do cliente"""
         self.host = None
         self.port = None
-        self.client_socket = None
+        self.loop = LoopTk(self.root)
+        self.conexao = None
         self.connected = False
+        self.reconectando = False
+        self.tentativas_reconexao = 0
+        self.reconexao_agendada = None
         self.sala = None
         self.nome = None
-        self.thread_ativa = False
-        self.receive_thread = None
+        self.anexos_pendentes = {}
+        self.avisos = queue.SimpleQueue()
+        self.transferencias_ativas = 0
+        self.historico = None
+        self.conversa = None
+        self.linhas_visiveis = deque()
+        self.seguindo = True
+        self.inicio_alcancado = False
+        self.carregando_pagina = False
+        self.dialogo_busca = None
+        self.membros = ListaMembros()
+        self.token_sessao = None
 
     def iniciar_configuracao(self):
         """Inicia o processo de configuração do cliente, incluindo conexão, nome e sala"""
@@ -594,8 +877,12 @@ class ClienteChat:
         main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
         self.criar_barra_info(main_frame)
-        self.criar_area_mensagens(main_frame)
+        conteudo_frame = tk.Frame(main_frame)
+        conteudo_frame.pack(fill=tk.BOTH, expand=True)
+        self.criar_lista_membros(conteudo_frame)
+        self.criar_area_mensagens(conteudo_frame)
         self.criar_area_entrada(main_frame)
+        self.abrir_historico()
 
     def criar_barra_info(self, frame):
         """Cria a barra de informações superior
@@ -607,7 +894,8 @@ class ClienteChat:
         info_frame.pack(fill=tk.X)
 
         tk.Label(
-            info_frame, text=f'Conectado a: {self.host}:{self.port}'
+            info_frame,
+            text=f'Conectado a: {formatar_endereco(self.host, self.port)}',
         ).pack(side=tk.LEFT)
         tk.Label(info_frame, text=f'Sala: {self.sala}').pack(
             side=tk.LEFT, padx=10
@@ -622,6 +910,40 @@ class ClienteChat:
         )
         self.btn_sair_sala.pack(side=tk.RIGHT)
 
+        tk.Button(
+            info_frame,
+            text='Buscar',
+            command=self.abrir_busca,
+            bg='#2196F3',
+            fg='white',
+        ).pack(side=tk.RIGHT, padx=(0, 5))
+
+    def criar_lista_membros(self, frame):
+        """Cria o painel lateral com os membros da sala
+
+        Args:
+            frame: Frame onde o painel será adicionado
+        """
+        membros_frame = tk.Frame(frame)
+        membros_frame.pack(side=tk.RIGHT, fill=tk.Y, padx=(5, 0), pady=10)
+
+        self.membros_label = tk.Label(membros_frame, text='Membros')
+        self.membros_label.pack(anchor=tk.W)
+        self.membros_lista = tk.Listbox(membros_frame, width=18)
+        self.membros_lista.pack(fill=tk.Y, expand=True)
+
+    def atualizar_lista_membros(self):
+        """Exibe no painel lateral a lista de membros atual"""
+        try:
+            if not self.membros_lista.winfo_exists():
+                return
+            nomes = sorted(self.membros.membros)
+            self.membros_lista.delete(0, tk.END)
+            self.membros_lista.insert(tk.END, *nomes)
+            self.membros_label.config(text=f'Membros ({len(nomes)})')
+        except (AttributeError, tk.TclError):
+            pass
+
     def criar_area_mensagens(self, frame):
         """Cria a área de exibição de mensagens
 
@@ -632,11 +954,47 @@ class ClienteChat:
             frame, state=tk.DISABLED, wrap=tk.WORD, height=20, bg='#f5f5f5'
         )
         self.mensagens_area.pack(fill=tk.BOTH, expand=True, pady=10)
+        self.mensagens_area.tag_config(
+            'anexo', foreground='#2196F3', underline=True
+        )
+        self.mensagens_area.tag_bind('anexo', '<Button-1>', self.abrir_anexo)
+        self.mensagens_area.mark_set('insercao', '1.0')
 
-        scrollbar = tk.Scrollbar(self.mensagens_area)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-        self.mensagens_area.config(yscrollcommand=scrollbar.set)
-        scrollbar.config(command=self.mensagens_area.yview)
+        self.scrollbar_mensagens = tk.Scrollbar(self.mensagens_area)
+        self.scrollbar_mensagens.pack(side=tk.RIGHT, fill=tk.Y)
+        self.mensagens_area.config(yscrollcommand=self.ao_rolar_mensagens)
+        self.scrollbar_mensagens.config(command=self.mensagens_area.yview)
+
+    def abrir_historico(self):
+        """Abre o histórico local e exibe as linhas mais recentes da conversa atual"""
+        if self.historico is None:
+            try:
+                self.historico = HistoricoLocal(CAMINHO_HISTORICO)
+            except Exception as e:
+                messagebox.showwarning(
+                    'Aviso',
+                    f'Não foi possível abrir o histórico local: {e}\n'
+                    'As mensagens desta sessão não serão gravadas.',
+                    parent=self.root,
+                )
+                self.historico = HistoricoLocal(':memory:')
+
+        self.conversa = (
+            f'{self.nome}@{formatar_endereco(self.host, self.port)}/{self.sala}'
+        )
+        self.linhas_visiveis.clear()
+        self.seguindo = True
+        self.inicio_alcancado = False
+        self.carregando_pagina = False
+
+        linhas = self.historico.ultimas(self.conversa, LINHAS_JANELA)
+        self.inicio_alcancado = len(linhas) < LINHAS_JANELA
+        self.mensagens_area.config(state=tk.NORMAL)
+        for id_linha, texto in linhas:
+            self.inserir_texto(texto)
+            self.linhas_visiveis.append(id_linha)
+        self.mensagens_area.see(tk.END)
+        self.mensagens_area.config(state=tk.DISABLED)
 
     def criar_area_entrada(self, frame):
         """Cria a área de entrada de mensagens
@@ -663,81 +1021,463 @@ class ClienteChat:
         )
         self.btn_enviar.pack(side=tk.RIGHT)
 
+        self.btn_anexar = tk.Button(
+            entrada_frame,
+            text='Anexar',
+            command=self.selecionar_anexo,
+            bg='#2196F3',
+            fg='white',
+        )
+        self.btn_anexar.pack(side=tk.RIGHT, padx=(0, 5))
+
     def conectar_servidor(self):
-        """Estabelece conexão com o servidor e inicia a thread de recebimento de mensagens"""
+        """Inicia a conexão não bloqueante com o servidor; as mensagens chegam pelo loop do Tk
+
+        O cliente negocia o protocolo binário: as mensagens chegam em quadros com o ID do
+        remetente, e cada nome é recebido uma única vez por sessão.
+        """
+        self.membros = ListaMembros()
+        handshake = [self.sala, self.nome]
+        if self.token_sessao:
+            handshake.insert(0, MARCADOR_RETOMAR + self.token_sessao)
+        handshake.insert(0, MARCADOR_BINARIO)
+        self.conexao = ConexaoChat(
+            self.loop,
+            self.host,
+            self.port,
+            handshake=handshake,
+            ao_conectar=self.ao_conectar,
+            ao_receber=self.receber_linha,
+            ao_desconectar=self.ao_desconectar,
+            decodificador=DecodificadorQuadros(),
+            perfil=obter_perfil(PERFIL_CONEXAO),
+        )
+        self.conexao.iniciar()
+
+    def receber_linha(self, linha):
+        """Encaminha um item recebido à lista de membros, ao diálogo de busca ou à área de chat
+
+        Args:
+            linha: Linha de controle recebida do servidor, ou mensagem ou evento já interpretados
+        """
+        if isinstance(linha, tuple):
+            if linha[0] == 'mensagem':
+                self.adicionar_mensagem(formatar_mensagem(*linha[1:]))
+            elif linha[0] == 'direta':
+                self.adicionar_mensagem(formatar_direta(*linha[1:]))
+            else:
+                self.adicionar_mensagem('\n'.join(formatar_evento(*linha[1:])))
+            return
+
+        if linha.startswith(MARCADOR_SESSAO):
+            self.token_sessao = linha[len(MARCADOR_SESSAO) :]
+            return
+
+        mudou = self.membros.processar(linha)
+        if mudou is not None:
+            if self.membros.pedir_retrato() and self.connected:
+                self.conexao.enviar_linha(MARCADOR_MEMBROS)
+            if mudou:
+                self.atualizar_lista_membros()
+            return
+
+        resposta = busca.ler_resposta(linha)
+        if resposta is None:
+            self.adicionar_mensagem(linha)
+            return
+
+        dialogo = self.dialogo_busca
         try:
-            self.client_socket = socket.socket(
-                socket.AF_INET, socket.SOCK_STREAM
-            )
-            self.client_socket.connect((self.host, self.port))
+            if dialogo is not None and dialogo.winfo_exists():
+                dialogo.receber_resposta(*resposta)
+        except tk.TclError:
+            pass
 
-            if self.client_socket.recv(1024).decode() == 'SALA':
-                self.client_socket.send(self.sala.encode())
-                self.client_socket.send(self.nome.encode())
+    def abrir_busca(self):
+        """Abre o diálogo de busca no histórico da sala"""
+        self.dialogo_busca = BuscaDialog(self.root, self.enviar_pedido_busca)
+        self.root.wait_window(self.dialogo_busca)
+        self.dialogo_busca = None
 
-            self.connected = True
-            self.thread_ativa = True
+    def enviar_pedido_busca(self, pedido):
+        """Envia um pedido de busca ao servidor
 
-            self.receive_thread = threading.Thread(
-                target=self.receber_mensagens
-            )
-            self.receive_thread.daemon = True
-            self.receive_thread.start()
+        Args:
+            pedido: Linha do pedido
 
-            self.adicionar_mensagem(
-                f'Conectado ao servidor. Bem-vindo à sala {self.sala}!'
-            )
+        Returns:
+            bool: True se havia conexão para enviar o pedido
+        """
+        if not self.connected:
+            return False
+        self.conexao.enviar_linha(pedido)
+        return True
 
-        except Exception as e:
-            messagebox.showerror(
-                'Erro de Conexão',
-                f'Erro ao estabelecer comunicação com o servidor: {str(e)}',
-            )
-            self.root.quit()
+    def ao_conectar(self):
+        """Informa que o handshake com o servidor foi concluído"""
+        self.connected = True
+        self.tentativas_reconexao = 0
+        if self.reconectando:
+            self.reconectando = False
+            self.adicionar_mensagem(f'Reconectado à sala {self.sala}!')
+            return
 
-    def receber_mensagens(self):
-        """Thread que recebe mensagens do servidor continuamente"""
-        while self.thread_ativa and self.connected:
-            try:
-                mensagem = self.client_socket.recv(1024).decode()
-                if mensagem:
-                    self.adicionar_mensagem(mensagem)
-            except:
-                if self.thread_ativa:
-                    self.adicionar_mensagem('Conexão com o servidor perdida!')
+        self.adicionar_mensagem(
+            f'Conectado ao servidor. Bem-vindo à sala {self.sala}!'
+        )
+
+    def ao_desconectar(self, erro):
+        """Trata o encerramento da conexão pelo servidor ou por falha de rede, agendando a reconexão
+
+        Args:
+            erro: Motivo do encerramento
+        """
+        tentar_apos = self.conexao.tentar_apos if self.conexao else None
+        self.conexao = None
+        if self.connected or self.reconectando or tentar_apos is not None:
+            if self.connected:
                 self.connected = False
-                break
+                self.adicionar_mensagem('Conexão com o servidor perdida!')
+            self.reconectando = True
+            self.agendar_reconexao(tentar_apos)
+            return
+
+        messagebox.showerror(
+            'Erro de Conexão',
+            f'Erro ao estabelecer comunicação com o servidor: {erro}',
+        )
+        self.root.quit()
+
+    def agendar_reconexao(self, tentar_apos=None):
+        """Agenda uma nova tentativa de conexão à mesma sala, com backoff exponencial e jitter
+
+        Args:
+            tentar_apos: Espera sugerida pelo servidor, se ele recusou a conexão por sobrecarga
+        """
+        espera = calcular_espera_reconexao(
+            self.tentativas_reconexao, tentar_apos
+        )
+        self.tentativas_reconexao += 1
+        self.adicionar_mensagem(
+            f'Reconectando em {espera:.1f}s '
+            f'(tentativa {self.tentativas_reconexao})...'
+        )
+        self.reconexao_agendada = self.root.after(
+            int(espera * 1000), self.reconectar
+        )
+
+    def reconectar(self):
+        """Tenta restabelecer a conexão com o servidor"""
+        self.reconexao_agendada = None
+        self.conectar_servidor()
 
     def enviar_mensagem(self, event=None):
-        """Envia uma mensagem para o servidor
+        """Envia uma mensagem para o servidor, ou uma mensagem direta se iniciada por /msg
 
         Args:
             event: Evento que disparou a função (opcional)
         """
         mensagem = self.entrada_mensagem.get().strip()
-        if mensagem and self.connected:
+        if not mensagem or not self.connected:
+            return
+        if mensagem.split(maxsplit=1)[0] == diretas.COMANDO_DIRETA:
             try:
-                self.client_socket.send(mensagem.encode())
-                self.entrada_mensagem.delete(0, tk.END)
-            except:
-                self.adicionar_mensagem(
-                    'Erro ao enviar mensagem. Verifique sua conexão.'
+                mensagem = diretas.montar_pedido(
+                    *diretas.interpretar_comando(mensagem)
                 )
-                self.connected = False
+            except diretas.ErroDireta as e:
+                self.adicionar_mensagem(str(e))
+                return
+        # O servidor encerra a conexão de quem envia uma linha acima do limite
+        if len(mensagem.encode()) > TAMANHO_MAX_MENSAGEM:
+            self.adicionar_mensagem(
+                'Mensagem excede o tamanho máximo de '
+                f'{TAMANHO_MAX_MENSAGEM} bytes'
+            )
+            return
+        self.conexao.enviar_linha(mensagem)
+        self.entrada_mensagem.delete(0, tk.END)
+
+    def selecionar_anexo(self):
+        """Abre o seletor de arquivos e envia o arquivo escolhido como anexo"""
+        caminho = filedialog.askopenfilename(parent=self.root)
+        if not caminho:
+            return
+
+        id_anexo = self.anexos_pendentes.setdefault(caminho, anexos.novo_id())
+        self.adicionar_mensagem(
+            f'Enviando anexo {os.path.basename(caminho)}...'
+        )
+        self.iniciar_transferencia(self.transferir_envio, caminho, id_anexo)
+
+    def baixar_anexo(self, id_anexo):
+        """Pergunta onde salvar um anexo anunciado na sala e inicia o download
+
+        Args:
+            id_anexo: ID do anexo
+        """
+        destino = filedialog.asksaveasfilename(parent=self.root)
+        if not destino:
+            return
+
+        self.adicionar_mensagem(f'Baixando anexo para {destino}...')
+        self.iniciar_transferencia(self.transferir_download, id_anexo, destino)
+
+    def iniciar_transferencia(self, funcao, *args):
+        """Executa uma transferência de anexo em uma thread própria, pelo canal lateral
+
+        A thread não toca nos widgets: ela publica avisos numa fila que o loop do Tk
+        consome enquanto houver transferências em andamento.
+
+        Args:
+            funcao: Função que realiza a transferência
+            args: Argumentos da função
+        """
+
+        def executar():
+            try:
+                funcao(*args)
+            finally:
+                self.avisos.put(self.finalizar_transferencia)
+
+        self.transferencias_ativas += 1
+        if self.transferencias_ativas == 1:
+            self.root.after(100, self.processar_avisos)
+
+        thread_transferencia = threading.Thread(target=executar)
+        thread_transferencia.daemon = True
+        thread_transferencia.start()
+
+    def avisar(self, funcao, *args):
+        """Agenda, a partir de uma thread de transferência, uma chamada no loop do Tk
+
+        Args:
+            funcao: Função a ser executada no loop do Tk
+            args: Argumentos da função
+        """
+        self.avisos.put(lambda: funcao(*args))
+
+    def processar_avisos(self):
+        """Executa os avisos publicados pelas threads de transferência"""
+        while True:
+            try:
+                aviso = self.avisos.get_nowait()
+            except queue.Empty:
+                break
+            aviso()
+
+        if self.transferencias_ativas:
+            self.root.after(100, self.processar_avisos)
+
+    def finalizar_transferencia(self):
+        """Contabiliza o fim de uma transferência"""
+        self.transferencias_ativas -= 1
+
+    def transferir_envio(self, caminho, id_anexo):
+        """Envia um anexo ao servidor, retomando envios interrompidos do mesmo arquivo
+
+        Args:
+            caminho: Caminho local do arquivo
+            id_anexo: ID do anexo
+        """
+        try:
+            if self.token_sessao is None:
+                raise anexos.ErroAnexo('conecte-se a uma sala primeiro')
+            anexos.enviar_anexo(
+                self.host, self.port, caminho, self.token_sessao, id_anexo
+            )
+            self.avisar(self.anexos_pendentes.pop, caminho, None)
+        except Exception as e:
+            self.avisar(
+                self.adicionar_mensagem,
+                f'Falha ao enviar anexo: {e}. Anexe o arquivo novamente para retomar.',
+            )
+
+    def transferir_download(self, id_anexo, destino):
+        """Baixa um anexo do servidor, retomando downloads interrompidos
+
+        Args:
+            id_anexo: ID do anexo
+            destino: Caminho local onde o anexo será salvo
+        """
+        try:
+            tamanho = anexos.baixar_anexo(
+                self.host, self.port, id_anexo, destino
+            )
+            self.avisar(
+                self.adicionar_mensagem,
+                f'Anexo salvo em {destino} ({tamanho} bytes)',
+            )
+        except Exception as e:
+            self.avisar(
+                self.adicionar_mensagem,
+                f'Falha ao baixar anexo: {e}. Baixe novamente para retomar.',
+            )
+
+    def abrir_anexo(self, event):
+        """Inicia o download do anexo cujo link foi clicado
+
+        Args:
+            event: Evento de clique sobre o link
+        """
+        for tag in self.mensagens_area.tag_names(tk.CURRENT):
+            if tag.startswith('anexo_'):
+                self.baixar_anexo(tag[len('anexo_') :])
+                return
+
+    def inserir_texto(self, linha, posicao=tk.END):
+        """Insere uma linha na área de chat, transformando anúncios de anexo em links de download
+
+        Args:
+            linha: Texto a ser inserido
+            posicao: Índice ou marca onde a linha será inserida
+        """
+        inicio = 0
+        for anuncio in anexos.PADRAO_ANUNCIO.finditer(linha):
+            self.mensagens_area.insert(
+                posicao, linha[inicio : anuncio.start()]
+            )
+            self.mensagens_area.insert(
+                posicao, '[baixar]', ('anexo', f'anexo_{anuncio.group(1)}')
+            )
+            inicio = anuncio.end()
+        self.mensagens_area.insert(posicao, linha[inicio:] + '\n')
+
+    def total_linhas_exibidas(self):
+        """Retorna quantas linhas de texto estão na área de chat"""
+        return int(self.mensagens_area.index('end-1c').split('.')[0]) - 1
+
+    def descartar_linhas(self, quantidade, do_inicio):
+        """Remove linhas de uma das pontas da área de chat, mantendo a janela com tamanho fixo
+
+        Args:
+            quantidade: Quantidade de linhas a remover
+            do_inicio: True para remover do topo, False para remover do fim
+        """
+        if quantidade <= 0:
+            return
+
+        if do_inicio:
+            self.mensagens_area.delete('1.0', f'{quantidade + 1}.0')
+            for _ in range(quantidade):
+                self.linhas_visiveis.popleft()
+        else:
+            primeira = self.total_linhas_exibidas() - quantidade + 1
+            self.mensagens_area.delete(f'{primeira}.0', 'end-1c')
+            for _ in range(quantidade):
+                self.linhas_visiveis.pop()
+
+        for tag in self.mensagens_area.tag_names():
+            if tag.startswith('anexo_') and not self.mensagens_area.tag_ranges(
+                tag
+            ):
+                self.mensagens_area.tag_delete(tag)
+
+    def ao_rolar_mensagens(self, primeiro, ultimo):
+        """Atualiza a barra de rolagem e carrega páginas do histórico ao atingir as bordas da janela
+
+        Args:
+            primeiro: Fração do topo visível
+            ultimo: Fração do fim visível
+        """
+        self.scrollbar_mensagens.set(primeiro, ultimo)
+        if self.carregando_pagina or not self.linhas_visiveis:
+            return
+
+        if float(primeiro) <= 0.0 and not self.inicio_alcancado:
+            self.carregando_pagina = True
+            self.mensagens_area.after_idle(self.carregar_pagina_anterior)
+        elif float(ultimo) >= 1.0 and not self.seguindo:
+            self.carregando_pagina = True
+            self.mensagens_area.after_idle(self.carregar_pagina_posterior)
+
+    def carregar_pagina_anterior(self):
+        """Carrega do histórico a página anterior à primeira linha exibida"""
+        try:
+            linhas = self.historico.anteriores(
+                self.conversa, self.linhas_visiveis[0], LINHAS_PAGINA
+            )
+            self.inicio_alcancado = len(linhas) < LINHAS_PAGINA
+            if not linhas:
+                return
+
+            self.mensagens_area.config(state=tk.NORMAL)
+            self.mensagens_area.mark_set('insercao', '1.0')
+            for id_linha, texto in linhas:
+                self.inserir_texto(texto, 'insercao')
+            self.linhas_visiveis.extendleft(
+                id_linha for id_linha, _ in reversed(linhas)
+            )
+
+            excesso = len(self.linhas_visiveis) - LINHAS_JANELA
+            if excesso > 0:
+                self.descartar_linhas(excesso, do_inicio=False)
+                self.seguindo = False
+            self.mensagens_area.config(state=tk.DISABLED)
+            self.mensagens_area.yview(f'{len(linhas) + 1}.0')
+        except (tk.TclError, IndexError):
+            pass
+        finally:
+            self.carregando_pagina = False
+
+    def carregar_pagina_posterior(self):
+        """Carrega do histórico a página seguinte à última linha exibida"""
+        try:
+            linhas = self.historico.posteriores(
+                self.conversa, self.linhas_visiveis[-1], LINHAS_PAGINA
+            )
+            self.seguindo = len(linhas) < LINHAS_PAGINA
+            if not linhas:
+                return
+
+            ultima_anterior = self.total_linhas_exibidas()
+            self.mensagens_area.config(state=tk.NORMAL)
+            for id_linha, texto in linhas:
+                self.inserir_texto(texto)
+                self.linhas_visiveis.append(id_linha)
+
+            excesso = len(self.linhas_visiveis) - LINHAS_JANELA
+            if excesso > 0:
+                self.descartar_linhas(excesso, do_inicio=True)
+                self.inicio_alcancado = False
+                ultima_anterior -= excesso
+            self.mensagens_area.config(state=tk.DISABLED)
+            self.mensagens_area.see(f'{max(ultima_anterior, 1)}.0')
+        except (tk.TclError, IndexError):
+            pass
+        finally:
+            self.carregando_pagina = False
 
     def adicionar_mensagem(self, mensagem):
-        """Adiciona uma mensagem à área de chat
+        """Grava uma mensagem no histórico local e a exibe caso a janela esteja acompanhando o fim da conversa
 
         Args:
             mensagem: Texto da mensagem a ser adicionada
         """
         try:
-            if (
+            if not (
                 hasattr(self, 'mensagens_area')
                 and self.mensagens_area.winfo_exists()
             ):
+                return
+
+            for linha in mensagem.splitlines():
+                if not linha.strip():
+                    continue
+
+                id_linha = self.historico.adicionar(self.conversa, linha)
+                if not self.seguindo:
+                    continue
+
                 self.mensagens_area.config(state=tk.NORMAL)
-                self.mensagens_area.insert(tk.END, mensagem + '\n')
+                self.inserir_texto(linha)
+                self.linhas_visiveis.append(id_linha)
+                if len(self.linhas_visiveis) > LINHAS_JANELA:
+                    self.descartar_linhas(
+                        len(self.linhas_visiveis) - LINHAS_JANELA,
+                        do_inicio=True,
+                    )
+                    self.inicio_alcancado = False
                 self.mensagens_area.see(tk.END)
                 self.mensagens_area.config(state=tk.DISABLED)
         except tk.TclError:
@@ -751,6 +1491,7 @@ class ClienteChat:
             return
 
         self.desconectar()
+        self.token_sessao = None
         self.limpar_interface()
         self.root.withdraw()
 
@@ -762,15 +1503,16 @@ class ClienteChat:
         self.root.deiconify()
 
     def desconectar(self):
-        """Desconecta do servidor e finaliza a thread de recebimento"""
-        self.thread_ativa = False
-        if self.connected and self.client_socket:
-            try:
-                self.client_socket.close()
-                self.connected = False
-            except:
-                pass
-        time.sleep(0.2)
+        """Desconecta do servidor e cancela reconexões pendentes"""
+        self.connected = False
+        self.reconectando = False
+        self.tentativas_reconexao = 0
+        if self.reconexao_agendada is not None:
+            self.root.after_cancel(self.reconexao_agendada)
+            self.reconexao_agendada = None
+        if self.conexao is not None:
+            conexao, self.conexao = self.conexao, None
+            conexao.fechar()
 
     def limpar_interface(self):
         """Limpa a interface do cliente"""
@@ -781,12 +1523,15 @@ class ClienteChat:
         """Manipula o evento de fechamento da aplicação"""
         if messagebox.askokcancel('Sair', 'Deseja realmente sair do chat?'):
             self.desconectar()
+            if self.historico is not None:
+                self.historico.fechar()
             self.root.destroy()
 
 
-try:
-    root = tk.Tk()
-    app = ClienteChat(root)
-    root.mainloop()
-except Exception as e:
-    print(f'❌ {e}')
+if __name__ == '__main__':
+    try:
+        root = tk.Tk()
+        app = ClienteChat(root)
+        root.mainloop()
+    except Exception as e:
+        print(f'❌ {e}')
@@ -0,0 +1,90 @@
+import json
+
+MARCADOR_DIRETA = '#DIRETA#'
+COMANDO_DIRETA = '/msg'
+PREFIXO_MENCAO = '@'
+MAX_DESTINATARIOS = 16
+
+
+class ErroDireta(Exception):
+    """Mensagem direta ou menção inválida"""
+
+
+def interpretar_comando(texto):
+    """Interpreta o comando de mensagem direta digitado pelo usuário
+
+    Args:
+        texto: Linha no formato /msg NOME TEXTO
+
+    Returns:
+        tuple: (nome do destinatário, texto da mensagem)
+    """
+    partes = texto.split(maxsplit=2)
+    if len(partes) < 3 or partes[0] != COMANDO_DIRETA:
+        raise ErroDireta(f'Use {COMANDO_DIRETA} NOME MENSAGEM')
+    return partes[1], partes[2]
+
+
+def montar_pedido(destinatario, texto):
+    """Monta a linha de mensagem direta enviada pelo cliente
+
+    Args:
+        destinatario: Nome do destinatário
+        texto: Texto da mensagem
+
+    Returns:
+        str: Linha do protocolo
+    """
+    return MARCADOR_DIRETA + json.dumps(
+        {'para': destinatario, 'texto': texto},
+        ensure_ascii=False,
+        separators=(',', ':'),
+    )
+
+
+def ler_pedido(linha):
+    """Valida uma linha de mensagem direta recebida pelo servidor
+
+    Args:
+        linha: Linha iniciada por MARCADOR_DIRETA
+
+    Returns:
+        tuple: (nome do destinatário, texto da mensagem)
+    """
+    try:
+        pedido = json.loads(linha[len(MARCADOR_DIRETA) :])
+    except ValueError:
+        raise ErroDireta('Mensagem direta malformada')
+    if (
+        not isinstance(pedido, dict)
+        or not isinstance(pedido.get('para'), str)
+        or not isinstance(pedido.get('texto'), str)
+        or not pedido['para']
+        or not pedido['texto'].strip()
+    ):
+        raise ErroDireta('Mensagem direta sem destinatário ou sem texto')
+    return pedido['para'], pedido['texto']
+
+
+def extrair_mencoes(texto):
+    """Retorna os usuários mencionados no início de uma mensagem
+
+    Só as menções que abrem a mensagem, como em "@ana @bia podem revisar?", a
+    endereçam; um @ no meio do texto, como num e-mail, não muda a entrega.
+
+    Args:
+        texto: Texto da mensagem
+
+    Returns:
+        list: Nomes mencionados, sem repetição e na ordem em que aparecem; vazia se a mensagem não começa por uma menção
+    """
+    nomes = []
+    for palavra in texto.split():
+        if not palavra.startswith(PREFIXO_MENCAO):
+            break
+        nome = palavra[len(PREFIXO_MENCAO) :].rstrip(',:')
+        if not nome:
+            break
+        if nome not in nomes:
+            nomes.append(nome)
+    return nomes[:MAX_DESTINATARIOS]
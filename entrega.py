@@ -0,0 +1,257 @@
+import threading
+import time
+
+INTERVALO_LOTE = 0.025
+JANELA_TAXA = 1.0
+TAXA_ATIVAR = 100.0
+TAXA_DESATIVAR = 50.0
+TAMANHO_MAX_LOTE = 256 * 1024
+
+
+class EstadoEntrega:
+    """Modo de entrega, taxa medida, mensagens acumuladas e contagens de uma sala"""
+
+    __slots__ = (
+        'lock',
+        'agrupando',
+        'pendentes',
+        'tamanho',
+        'contagem',
+        'inicio_janela',
+        'mensagens',
+        'agrupadas',
+        'lotes',
+    )
+
+    def __init__(self, agora):
+        """Inicializa a sala em entrega imediata
+
+        Args:
+            agora: Instante atual do relógio monotônico
+        """
+        self.lock = threading.Lock()
+        self.agrupando = False
+        self.pendentes = []
+        self.tamanho = 0
+        self.contagem = 0
+        self.inicio_janela = agora
+        self.mensagens = 0
+        self.agrupadas = 0
+        self.lotes = 0
+
+
+class EntregaAgrupada:
+    """Entrega das mensagens das salas, imediata ou agrupada por tick conforme o movimento
+
+    Em entrega imediata, cada mensagem é um broadcast: um envio por membro. Quando a
+    taxa de mensagens de uma sala passa de taxa_ativar, a sala passa a acumular as
+    mensagens e uma thread as envia juntas a cada tick, num único envio por membro;
+    quando a taxa cai abaixo de taxa_desativar, a sala volta à entrega imediata. A
+    latência adicional fica limitada a um tick.
+
+    Os lotes são enviados com o lock da sala, e a troca de modo só acontece depois
+    de esvaziado o lote, de modo que as mensagens de cada remetente chegam na ordem
+    em que foram enviadas.
+    """
+
+    def __init__(
+        self,
+        publicar,
+        intervalo=INTERVALO_LOTE,
+        taxa_ativar=TAXA_ATIVAR,
+        taxa_desativar=TAXA_DESATIVAR,
+        ao_mudar_modo=None,
+        juntar=b''.join,
+    ):
+        """Inicializa a entrega
+
+        Args:
+            publicar: Função chamada com (sala_id, dados) para enviar bytes a todos os membros da sala
+            intervalo: Segundos entre envios de lotes
+            taxa_ativar: Mensagens por segundo acima das quais a sala passa a agrupar
+            taxa_desativar: Mensagens por segundo abaixo das quais a sala volta à entrega imediata
+            ao_mudar_modo: Função chamada com (sala_id, agrupando, taxa) quando uma sala muda de modo; a taxa é None se a janela de medição não terminou
+            juntar: Função que junta uma lista de mensagens num único lote; por padrão, concatena bytes
+        """
+        self.publicar = publicar
+        self.intervalo = intervalo
+        self.taxa_ativar = taxa_ativar
+        self.taxa_desativar = taxa_desativar
+        self.ao_mudar_modo = ao_mudar_modo
+        self.juntar = juntar
+        self.salas = {}
+        self.esquecidas = EstadoEntrega(0)
+        self.lock = threading.Lock()
+        self.parar_lotes = threading.Event()
+        self.thread_lotes = None
+
+    def estado(self, sala_id, agora):
+        """Retorna o estado de entrega da sala, criando-o se necessário"""
+        estado = self.salas.get(sala_id)
+        if estado is None:
+            with self.lock:
+                estado = self.salas.setdefault(sala_id, EstadoEntrega(agora))
+        return estado
+
+    def medir_taxa(self, estado, agora):
+        """Fecha a janela de medição se ela terminou; chamar com o lock da sala
+
+        Returns:
+            float: Mensagens por segundo na janela encerrada, ou None se ela continua aberta
+        """
+        decorrido = agora - estado.inicio_janela
+        if decorrido < JANELA_TAXA:
+            return None
+        taxa = estado.contagem / decorrido
+        estado.contagem = 0
+        estado.inicio_janela = agora
+        return taxa
+
+    def entregar(self, sala_id, dados):
+        """Entrega uma mensagem já codificada aos membros da sala, agora ou no próximo tick
+
+        Args:
+            sala_id: ID da sala
+            dados: Mensagem já codificada, em bytes ou no formato aceito por juntar
+        """
+        agora = time.monotonic()
+        estado = self.estado(sala_id, agora)
+        with estado.lock:
+            estado.contagem += 1
+            estado.mensagens += 1
+            if not estado.agrupando:
+                taxa = self.medir_taxa(estado, agora)
+                # Sem a thread de lotes, nada enviaria as mensagens acumuladas
+                if (
+                    taxa is not None
+                    and taxa > self.taxa_ativar
+                    and self.thread_lotes is not None
+                ):
+                    estado.agrupando = True
+                    self.avisar_mudanca(sala_id, True, taxa)
+
+            if estado.agrupando:
+                estado.agrupadas += 1
+                estado.pendentes.append(dados)
+                estado.tamanho += len(dados)
+                if estado.tamanho >= TAMANHO_MAX_LOTE:
+                    self.enviar_lote(sala_id, estado)
+                return
+
+        self.publicar(sala_id, dados)
+
+    def enviar_lote(self, sala_id, estado):
+        """Envia as mensagens acumuladas da sala num único envio por membro; chamar com o lock da sala"""
+        if not estado.pendentes:
+            return
+        dados = self.juntar(estado.pendentes)
+        estado.pendentes = []
+        estado.tamanho = 0
+        estado.lotes += 1
+        self.publicar(sala_id, dados)
+
+    def esvaziar(self, sala_id):
+        """Envia já as mensagens acumuladas de uma sala, aos membros que ela tem agora
+
+        Args:
+            sala_id: ID da sala
+        """
+        estado = self.salas.get(sala_id)
+        if estado is None:
+            return
+        with estado.lock:
+            self.enviar_lote(sala_id, estado)
+
+    def enviar_lotes(self, encerrando=False):
+        """Envia os lotes de todas as salas que agrupam e devolve à entrega imediata as que esfriaram
+
+        Args:
+            encerrando: Se True, devolve todas as salas à entrega imediata
+        """
+        agora = time.monotonic()
+        with self.lock:
+            salas = [
+                (sala_id, estado)
+                for sala_id, estado in self.salas.items()
+                if estado.agrupando
+            ]
+
+        for sala_id, estado in salas:
+            with estado.lock:
+                self.enviar_lote(sala_id, estado)
+                taxa = self.medir_taxa(estado, agora)
+                if encerrando or (
+                    taxa is not None and taxa < self.taxa_desativar
+                ):
+                    estado.agrupando = False
+                    self.avisar_mudanca(sala_id, False, taxa)
+
+    def esquecer(self, sala_id):
+        """Descarta o estado de entrega de uma sala despejada, mantendo as suas contagens no total
+
+        As mensagens acumuladas são enviadas antes, e a sala volta à entrega imediata,
+        para que quem ainda tenha o estado em mãos não acumule mensagens que nenhum
+        tick enviaria.
+
+        Args:
+            sala_id: ID da sala
+        """
+        with self.lock:
+            estado = self.salas.pop(sala_id, None)
+        if estado is None:
+            return
+        with estado.lock:
+            self.enviar_lote(sala_id, estado)
+            if estado.agrupando:
+                estado.agrupando = False
+                self.avisar_mudanca(sala_id, False, None)
+        with self.lock:
+            self.esquecidas.mensagens += estado.mensagens
+            self.esquecidas.agrupadas += estado.agrupadas
+            self.esquecidas.lotes += estado.lotes
+
+    def avisar_mudanca(self, sala_id, agrupando, taxa):
+        """Informa a mudança de modo de uma sala, se houver quem queira saber"""
+        if self.ao_mudar_modo is not None:
+            self.ao_mudar_modo(sala_id, agrupando, taxa)
+
+    def estatisticas(self):
+        """Retorna as contagens da entrega
+
+        Returns:
+            dict: Mensagens entregues, quantas foram agrupadas, lotes enviados e salas agrupando agora
+        """
+        with self.lock:
+            estados = list(self.salas.values()) + [self.esquecidas]
+        return {
+            'mensagens': sum(estado.mensagens for estado in estados),
+            'agrupadas': sum(estado.agrupadas for estado in estados),
+            'lotes': sum(estado.lotes for estado in estados),
+            'salas_agrupando': sum(
+                1 for estado in estados if estado.agrupando
+            ),
+        }
+
+    def executar_lotes(self):
+        """Loop da thread de lotes"""
+        while not self.parar_lotes.wait(self.intervalo):
+            self.enviar_lotes()
+
+    def iniciar(self):
+        """Inicia a thread de lotes"""
+        if self.thread_lotes is not None:
+            return
+        self.parar_lotes.clear()
+        self.thread_lotes = threading.Thread(
+            target=self.executar_lotes, daemon=True
+        )
+        self.thread_lotes.start()
+
+    def parar(self):
+        """Encerra a thread de lotes, enviando os lotes pendentes"""
+        if self.thread_lotes is None:
+            return
+        self.parar_lotes.set()
+        self.thread_lotes.join()
+        self.thread_lotes = None
+        self.enviar_lotes(encerrando=True)
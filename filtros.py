@@ -0,0 +1,351 @@
+import os
+import threading
+import time
+from collections import deque
+
+INTERVALO_VERIFICACAO = 2.0
+CARACTERE_MASCARA = '*'
+
+
+class AutomatoTermos:
+    """Autômato de Aho-Corasick que encontra todos os termos de uma lista numa única passada pelo texto
+
+    A comparação ignora maiúsculas e minúsculas. O custo da busca depende do tamanho do
+    texto e da quantidade de ocorrências, e não da quantidade de termos.
+    """
+
+    __slots__ = ('transicoes', 'falhas', 'saidas', 'total_termos')
+
+    def __init__(self, termos):
+        """Monta o autômato
+
+        Args:
+            termos: Termos a procurar; vazios e repetidos são ignorados
+        """
+        self.transicoes = [{}]
+        self.saidas = [()]
+        # Cada caractere vira minúsculo isoladamente, como no texto examinado
+        termos = {
+            tuple(caractere.lower() for caractere in termo)
+            for termo in termos
+            if termo
+        }
+        self.total_termos = len(termos)
+        for termo in termos:
+            estado = 0
+            for caractere in termo:
+                proximo = self.transicoes[estado].get(caractere)
+                if proximo is None:
+                    proximo = len(self.transicoes)
+                    self.transicoes[estado][caractere] = proximo
+                    self.transicoes.append({})
+                    self.saidas.append(())
+                estado = proximo
+            self.saidas[estado] = (len(termo),)
+
+        # Ligações de falha em largura: cada estado herda as saídas do
+        # estado para onde falha, de modo que a busca não precisa segui-las
+        self.falhas = [0] * len(self.transicoes)
+        fila = deque(self.transicoes[0].values())
+        while fila:
+            estado = fila.popleft()
+            for caractere, proximo in self.transicoes[estado].items():
+                fila.append(proximo)
+                falha = self.falhas[estado]
+                while falha and caractere not in self.transicoes[falha]:
+                    falha = self.falhas[falha]
+                falha = self.transicoes[falha].get(caractere, 0)
+                self.falhas[proximo] = falha
+                if self.saidas[falha]:
+                    self.saidas[proximo] += self.saidas[falha]
+
+    def encontrar(self, texto):
+        """Encontra as ocorrências dos termos no texto
+
+        Args:
+            texto: Texto a examinar
+
+        Returns:
+            list: Intervalos (início, fim) das ocorrências, na ordem em que terminam
+        """
+        if self.total_termos == 0:
+            return []
+        minusculo = texto.lower()
+        if len(minusculo) != len(texto):
+            # Alguns caracteres mudam de tamanho ao passar para minúscula;
+            # converte um a um para manter as posições do texto original
+            minusculo = [caractere.lower() for caractere in texto]
+
+        transicoes = self.transicoes
+        falhas = self.falhas
+        saidas = self.saidas
+        estado = 0
+        ocorrencias = []
+        for posicao, caractere in enumerate(minusculo):
+            while estado and caractere not in transicoes[estado]:
+                estado = falhas[estado]
+            estado = transicoes[estado].get(caractere, 0)
+            if saidas[estado]:
+                fim = posicao + 1
+                for tamanho in saidas[estado]:
+                    ocorrencias.append((fim - tamanho, fim))
+        return ocorrencias
+
+
+def isolada(texto, inicio, fim):
+    """Indica se a ocorrência em texto[inicio:fim] é uma palavra inteira"""
+    return (inicio == 0 or not texto[inicio - 1].isalnum()) and (
+        fim == len(texto) or not texto[fim].isalnum()
+    )
+
+
+def ler_termos(caminho):
+    """Lê a lista de termos de um arquivo, um por linha
+
+    Linhas vazias e iniciadas por # são ignoradas.
+
+    Args:
+        caminho: Arquivo UTF-8 com os termos
+
+    Returns:
+        list: Termos lidos
+    """
+    with open(caminho, encoding='utf-8') as arquivo:
+        return [
+            linha.strip()
+            for linha in arquivo
+            if linha.strip() and not linha.lstrip().startswith('#')
+        ]
+
+
+class FiltroTermos:
+    """Etapa que mascara ou bloqueia mensagens com termos proibidos, lidos de um arquivo
+
+    Uma thread verifica periodicamente se o arquivo mudou e, se mudou, monta um novo
+    autômato fora do caminho das mensagens e o troca pelo atual de uma só vez; as
+    mensagens em andamento terminam com o autômato anterior.
+    """
+
+    nome = 'termos'
+
+    def __init__(
+        self,
+        caminho,
+        acao='mascarar',
+        palavras_inteiras=True,
+        intervalo=INTERVALO_VERIFICACAO,
+        avisar=None,
+    ):
+        """Inicializa o filtro e carrega os termos, se o arquivo existir
+
+        Args:
+            caminho: Arquivo com os termos, um por linha
+            acao: 'mascarar' para trocar os termos por asteriscos, 'bloquear' para descartar a mensagem
+            palavras_inteiras: Se True, ignora ocorrências dentro de outras palavras
+            intervalo: Segundos entre verificações do arquivo
+            avisar: Função chamada com uma mensagem a cada recarga ou falha de leitura
+        """
+        if acao not in ('mascarar', 'bloquear'):
+            raise ValueError(f'Ação de filtro desconhecida: {acao}')
+        self.caminho = caminho
+        self.acao = acao
+        self.palavras_inteiras = palavras_inteiras
+        self.intervalo = intervalo
+        self.avisar = avisar
+        self.automato = AutomatoTermos(())
+        self.modificado = None
+        self.parar_verificacao = threading.Event()
+        self.thread_verificacao = None
+        self.recarregar_se_alterado()
+
+    def processar(self, texto):
+        """Aplica o filtro a uma mensagem
+
+        Args:
+            texto: Texto da mensagem
+
+        Returns:
+            str: Texto, mascarado se preciso, ou None se a mensagem foi bloqueada
+        """
+        ocorrencias = self.automato.encontrar(texto)
+        if self.palavras_inteiras:
+            ocorrencias = [
+                (inicio, fim)
+                for inicio, fim in ocorrencias
+                if isolada(texto, inicio, fim)
+            ]
+        if not ocorrencias:
+            return texto
+        if self.acao == 'bloquear':
+            return None
+
+        caracteres = list(texto)
+        for inicio, fim in ocorrencias:
+            caracteres[inicio:fim] = CARACTERE_MASCARA * (fim - inicio)
+        return ''.join(caracteres)
+
+    def recarregar(self):
+        """Lê o arquivo e troca o autômato atual por um novo
+
+        Returns:
+            int: Quantidade de termos carregados
+        """
+        modificado = os.stat(self.caminho).st_mtime_ns
+        inicio = time.perf_counter()
+        automato = AutomatoTermos(ler_termos(self.caminho))
+        self.automato = automato
+        self.modificado = modificado
+        if self.avisar is not None:
+            self.avisar(
+                f'Filtro de termos carregado: {automato.total_termos} '
+                f'termo(s) em {(time.perf_counter() - inicio) * 1000:.1f} ms'
+            )
+        return automato.total_termos
+
+    def recarregar_se_alterado(self):
+        """Recarrega os termos se o arquivo mudou desde a última leitura
+
+        Se o arquivo foi removido, o filtro fica vazio; se não pôde ser lido, os termos
+        anteriores continuam valendo.
+        """
+        try:
+            modificado = os.stat(self.caminho).st_mtime_ns
+        except FileNotFoundError:
+            if self.modificado is not None:
+                self.automato = AutomatoTermos(())
+                self.modificado = None
+                if self.avisar is not None:
+                    self.avisar('Arquivo de termos removido; filtro vazio')
+            return
+        except OSError:
+            return
+
+        if modificado == self.modificado:
+            return
+        try:
+            self.recarregar()
+        except (OSError, UnicodeDecodeError) as e:
+            if self.avisar is not None:
+                self.avisar(f'Falha ao recarregar o filtro de termos: {e}')
+
+    def executar_verificacao(self):
+        """Loop da thread que acompanha o arquivo de termos"""
+        while not self.parar_verificacao.wait(self.intervalo):
+            self.recarregar_se_alterado()
+
+    def iniciar(self):
+        """Inicia a thread que recarrega o arquivo de termos quando ele muda"""
+        if self.thread_verificacao is not None:
+            return
+        self.parar_verificacao.clear()
+        self.thread_verificacao = threading.Thread(
+            target=self.executar_verificacao, daemon=True
+        )
+        self.thread_verificacao.start()
+
+    def parar(self):
+        """Encerra a thread de verificação"""
+        if self.thread_verificacao is None:
+            return
+        self.parar_verificacao.set()
+        self.thread_verificacao.join()
+        self.thread_verificacao = None
+
+
+class MedicaoEtapa:
+    """Contadores de tempo e de resultado de uma etapa do pipeline"""
+
+    __slots__ = ('chamadas', 'total_ns', 'max_ns', 'alteradas', 'bloqueadas')
+
+    def __init__(self):
+        """Inicializa os contadores zerados"""
+        self.chamadas = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.alteradas = 0
+        self.bloqueadas = 0
+
+
+class PipelineMensagens:
+    """Sequência de etapas aplicadas a cada mensagem antes do broadcast
+
+    Uma etapa é qualquer objeto com um atributo nome e um método processar(texto) que
+    retorna o texto, possivelmente alterado, ou None para descartar a mensagem. O
+    tempo de cada etapa é medido em toda chamada.
+    """
+
+    def __init__(self, etapas=()):
+        """Inicializa o pipeline
+
+        Args:
+            etapas: Etapas iniciais, na ordem de aplicação
+        """
+        self.etapas = []
+        self.medicoes = {}
+        self.lock = threading.Lock()
+        for etapa in etapas:
+            self.adicionar(etapa)
+
+    def adicionar(self, etapa):
+        """Acrescenta uma etapa ao final do pipeline"""
+        with self.lock:
+            self.medicoes.setdefault(etapa.nome, MedicaoEtapa())
+            # Troca a lista inteira para não alterá-la durante um processar
+            self.etapas = self.etapas + [etapa]
+
+    def remover(self, nome):
+        """Retira do pipeline as etapas com o nome informado"""
+        with self.lock:
+            self.etapas = [
+                etapa for etapa in self.etapas if etapa.nome != nome
+            ]
+
+    def processar(self, texto):
+        """Aplica as etapas a uma mensagem, em ordem, até o fim ou até uma delas descartá-la
+
+        Args:
+            texto: Texto da mensagem
+
+        Returns:
+            str: Texto final, ou None se alguma etapa descartou a mensagem
+        """
+        for etapa in self.etapas:
+            inicio = time.perf_counter_ns()
+            resultado = etapa.processar(texto)
+            duracao = time.perf_counter_ns() - inicio
+
+            with self.lock:
+                medicao = self.medicoes[etapa.nome]
+                medicao.chamadas += 1
+                medicao.total_ns += duracao
+                if duracao > medicao.max_ns:
+                    medicao.max_ns = duracao
+                if resultado is None:
+                    medicao.bloqueadas += 1
+                elif resultado != texto:
+                    medicao.alteradas += 1
+
+            if resultado is None:
+                return None
+            texto = resultado
+        return texto
+
+    def estatisticas(self):
+        """Retorna as medições de cada etapa
+
+        Returns:
+            dict: Por nome de etapa, chamadas, tempo médio e máximo em microssegundos e mensagens alteradas e bloqueadas
+        """
+        with self.lock:
+            return {
+                nome: {
+                    'chamadas': medicao.chamadas,
+                    'medio_us': medicao.total_ns / medicao.chamadas / 1000
+                    if medicao.chamadas
+                    else 0.0,
+                    'max_us': medicao.max_ns / 1000,
+                    'alteradas': medicao.alteradas,
+                    'bloqueadas': medicao.bloqueadas,
+                }
+                for nome, medicao in self.medicoes.items()
+            }
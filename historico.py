@@ -0,0 +1,114 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class HistoricoLocal:
+    """Histórico de mensagens do cliente gravado em SQLite, consultado em páginas"""
+
+    def __init__(self, caminho):
+        """Abre (ou cria) o banco do histórico
+
+        Args:
+            caminho: Caminho do arquivo SQLite, ou ':memory:'
+        """
+        if caminho != ':memory:':
+            os.makedirs(
+                os.path.dirname(os.path.abspath(caminho)), exist_ok=True
+            )
+        self.conexao = sqlite3.connect(caminho, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conexao:
+            self.conexao.execute('PRAGMA journal_mode=WAL')
+            self.conexao.execute('PRAGMA synchronous=NORMAL')
+            self.conexao.execute(
+                'CREATE TABLE IF NOT EXISTS mensagens ('
+                'id INTEGER PRIMARY KEY, '
+                'conversa TEXT NOT NULL, '
+                'momento REAL NOT NULL, '
+                'texto TEXT NOT NULL)'
+            )
+            self.conexao.execute(
+                'CREATE INDEX IF NOT EXISTS idx_mensagens_conversa '
+                'ON mensagens (conversa, id)'
+            )
+
+    def adicionar(self, conversa, texto):
+        """Grava uma linha no histórico
+
+        Args:
+            conversa: Identificador da conversa (servidor, sala e usuário)
+            texto: Linha de texto
+
+        Returns:
+            int: ID da linha gravada
+        """
+        with self.lock, self.conexao:
+            cursor = self.conexao.execute(
+                'INSERT INTO mensagens (conversa, momento, texto) VALUES (?, ?, ?)',
+                (conversa, time.time(), texto),
+            )
+            return cursor.lastrowid
+
+    def ultimas(self, conversa, limite):
+        """Retorna as linhas mais recentes de uma conversa
+
+        Args:
+            conversa: Identificador da conversa
+            limite: Quantidade máxima de linhas
+
+        Returns:
+            list: Pares (id, texto) em ordem cronológica
+        """
+        with self.lock:
+            linhas = self.conexao.execute(
+                'SELECT id, texto FROM mensagens WHERE conversa = ? '
+                'ORDER BY id DESC LIMIT ?',
+                (conversa, limite),
+            ).fetchall()
+        linhas.reverse()
+        return linhas
+
+    def anteriores(self, conversa, antes_de, limite):
+        """Retorna a página de linhas imediatamente anterior a um ID
+
+        Args:
+            conversa: Identificador da conversa
+            antes_de: ID da primeira linha já exibida
+            limite: Quantidade máxima de linhas
+
+        Returns:
+            list: Pares (id, texto) em ordem cronológica
+        """
+        with self.lock:
+            linhas = self.conexao.execute(
+                'SELECT id, texto FROM mensagens WHERE conversa = ? AND id < ? '
+                'ORDER BY id DESC LIMIT ?',
+                (conversa, antes_de, limite),
+            ).fetchall()
+        linhas.reverse()
+        return linhas
+
+    def posteriores(self, conversa, depois_de, limite):
+        """Retorna a página de linhas imediatamente posterior a um ID
+
+        Args:
+            conversa: Identificador da conversa
+            depois_de: ID da última linha já exibida
+            limite: Quantidade máxima de linhas
+
+        Returns:
+            list: Pares (id, texto) em ordem cronológica
+        """
+        with self.lock:
+            return self.conexao.execute(
+                'SELECT id, texto FROM mensagens WHERE conversa = ? AND id > ? '
+                'ORDER BY id LIMIT ?',
+                (conversa, depois_de, limite),
+            ).fetchall()
+
+    def fechar(self):
+        """Fecha o banco do histórico"""
+        with self.lock:
+            self.conexao.close()
@@ -0,0 +1,205 @@
+import os
+import socket
+import struct
+
+PERFIL_PADRAO = 'padrao'
+PERFIL_BAIXA_LATENCIA = 'baixa-latencia'
+PERFIL_ALTA_VAZAO = 'alta-vazao'
+
+# Segundos que um envio a uma sessão de chat pode ficar parado antes de falhar
+PRAZO_ENVIO_SESSAO = 10
+
+
+class PerfilRede:
+    """Opções de socket aplicadas ao socket de escuta e às conexões
+
+    Valores None mantêm o padrão do sistema operacional.
+    """
+
+    __slots__ = (
+        'nome',
+        'sem_atraso',
+        'buffer_envio',
+        'buffer_recepcao',
+        'keepalive',
+        'adiar_aceite',
+        'backlog',
+    )
+
+    def __init__(
+        self,
+        nome,
+        sem_atraso=None,
+        buffer_envio=None,
+        buffer_recepcao=None,
+        keepalive=None,
+        adiar_aceite=None,
+        backlog=None,
+    ):
+        """Inicializa o perfil
+
+        Args:
+            nome: Nome do perfil
+            sem_atraso: TCP_NODELAY; True envia cada escrita na hora, False deixa o algoritmo de Nagle juntar escritas pequenas
+            buffer_envio: Bytes de SO_SNDBUF
+            buffer_recepcao: Bytes de SO_RCVBUF
+            keepalive: (segundos ocioso, segundos entre sondas, sondas) do keepalive do TCP
+            adiar_aceite: Segundos de TCP_DEFER_ACCEPT: o aceite espera o cliente enviar dados
+            backlog: Conexões pendentes na fila de aceite
+        """
+        self.nome = nome
+        self.sem_atraso = sem_atraso
+        self.buffer_envio = buffer_envio
+        self.buffer_recepcao = buffer_recepcao
+        self.keepalive = keepalive
+        self.adiar_aceite = adiar_aceite
+        self.backlog = backlog
+
+
+# No protocolo do chat o servidor fala primeiro (SOLICITACAO_SALA), então
+# TCP_DEFER_ACCEPT seguraria cada conexão até o fim do prazo; os perfis o
+# deixam desligado, e ele só serve a protocolos em que o cliente fala primeiro
+PERFIS = {
+    PERFIL_PADRAO: PerfilRede(PERFIL_PADRAO),
+    PERFIL_BAIXA_LATENCIA: PerfilRede(
+        PERFIL_BAIXA_LATENCIA,
+        sem_atraso=True,
+        buffer_envio=64 * 1024,
+        buffer_recepcao=64 * 1024,
+        keepalive=(30, 10, 3),
+        backlog=1024,
+    ),
+    PERFIL_ALTA_VAZAO: PerfilRede(
+        PERFIL_ALTA_VAZAO,
+        sem_atraso=False,
+        buffer_envio=1024 * 1024,
+        buffer_recepcao=1024 * 1024,
+        keepalive=(300, 60, 5),
+        backlog=4096,
+    ),
+}
+
+
+def obter_perfil(nome):
+    """Retorna um perfil pelo nome
+
+    Args:
+        nome: Nome do perfil, ou None para o padrão
+
+    Returns:
+        PerfilRede: Perfil encontrado
+    """
+    perfil = PERFIS.get(nome or PERFIL_PADRAO)
+    if perfil is None:
+        raise ValueError(
+            f'Perfil de rede desconhecido: {nome} '
+            f'(use {", ".join(PERFIS)})'
+        )
+    return perfil
+
+
+def definir_opcao(sock, nivel, nome_opcao, valor):
+    """Define uma opção de socket, ignorando as que o sistema não tem
+
+    Args:
+        sock: Socket
+        nivel: Nível da opção, como socket.IPPROTO_TCP
+        nome_opcao: Nome da constante do módulo socket, como 'TCP_KEEPIDLE'
+        valor: Valor inteiro da opção, ou os bytes da estrutura que ela espera
+
+    Returns:
+        bool: True se a opção foi aplicada
+    """
+    opcao = getattr(socket, nome_opcao, None)
+    if opcao is None:
+        return False
+    try:
+        sock.setsockopt(nivel, opcao, valor)
+    except OSError:
+        return False
+    return True
+
+
+def eh_tcp(sock):
+    """Indica se o socket é TCP, e não Unix"""
+    return sock.family in (socket.AF_INET, socket.AF_INET6)
+
+
+def ajustar_buffers(sock, perfil):
+    """Aplica os tamanhos de buffer do perfil"""
+    if perfil.buffer_envio is not None:
+        definir_opcao(
+            sock, socket.SOL_SOCKET, 'SO_SNDBUF', perfil.buffer_envio
+        )
+    if perfil.buffer_recepcao is not None:
+        definir_opcao(
+            sock, socket.SOL_SOCKET, 'SO_RCVBUF', perfil.buffer_recepcao
+        )
+
+
+def ajustar_ouvinte(sock, perfil):
+    """Aplica o perfil a um socket de escuta, antes de listen
+
+    Os buffers definidos antes de listen valem para as conexões aceitas e para o
+    window scaling negociado no handshake do TCP.
+
+    Args:
+        sock: Socket de escuta
+        perfil: PerfilRede
+
+    Returns:
+        int: Backlog a passar para listen, ou None para o padrão
+    """
+    ajustar_buffers(sock, perfil)
+    if eh_tcp(sock) and perfil.adiar_aceite:
+        definir_opcao(
+            sock, socket.IPPROTO_TCP, 'TCP_DEFER_ACCEPT', perfil.adiar_aceite
+        )
+    return perfil.backlog
+
+
+def ajustar_conexao(sock, perfil):
+    """Aplica o perfil a uma conexão aceita ou a um socket de cliente antes de conectar
+
+    Em sockets Unix, só os buffers se aplicam.
+
+    Args:
+        sock: Socket da conexão
+        perfil: PerfilRede
+    """
+    ajustar_buffers(sock, perfil)
+    if not eh_tcp(sock):
+        return
+    if perfil.sem_atraso is not None:
+        definir_opcao(
+            sock, socket.IPPROTO_TCP, 'TCP_NODELAY', int(perfil.sem_atraso)
+        )
+    if perfil.keepalive is not None:
+        ocioso, intervalo, sondas = perfil.keepalive
+        definir_opcao(sock, socket.SOL_SOCKET, 'SO_KEEPALIVE', 1)
+        definir_opcao(sock, socket.IPPROTO_TCP, 'TCP_KEEPIDLE', ocioso)
+        definir_opcao(sock, socket.IPPROTO_TCP, 'TCP_KEEPINTVL', intervalo)
+        definir_opcao(sock, socket.IPPROTO_TCP, 'TCP_KEEPCNT', sondas)
+
+
+def limitar_envio(sock, segundos):
+    """Faz os envios de um socket bloqueante falharem se ficarem parados por mais que o prazo
+
+    Diferente de settimeout, SO_SNDTIMEO não afeta as leituras, então a thread que
+    espera as mensagens do cliente continua bloqueada sem prazo. Um envio que esgota
+    o prazo levanta OSError, e o que já foi escrito no socket fica pela metade.
+
+    Args:
+        sock: Socket bloqueante
+        segundos: Prazo de cada envio sem progresso
+
+    Returns:
+        bool: True se o prazo foi aplicado
+    """
+    if os.name == 'nt':
+        valor = int(segundos * 1000)
+    else:
+        valor = struct.pack(
+            'll', int(segundos), int(segundos % 1 * 1_000_000)
+        )
+    return definir_opcao(sock, socket.SOL_SOCKET, 'SO_SNDTIMEO', valor)
@@ -0,0 +1,355 @@
+import json
+import threading
+
+from quadros import (
+    EVENTO_ENTRADA,
+    EVENTO_MOVIMENTO,
+    EVENTO_SAIDA,
+    Carga,
+    formatar_evento,
+)
+
+MARCADOR_MEMBROS = '#MEMBROS#'
+MARCADOR_DELTA = '#MEMBROS_DELTA#'
+INTERVALO_TICK = 0.2
+MAX_AVISOS_INDIVIDUAIS = 3
+TAMANHO_MAX_BLOCO = 32 * 1024
+MAX_DELTAS_ADIADOS = 256
+
+
+def dividir_nomes(nomes, limite=TAMANHO_MAX_BLOCO):
+    """Divide uma lista de nomes em blocos que cabem numa linha do protocolo
+
+    O custo de cada nome é o que ele ocupa na linha codificada, em bytes, com aspas,
+    escapes e a vírgula.
+
+    Args:
+        nomes: Nomes a dividir
+        limite: Tamanho máximo de cada bloco, em bytes
+
+    Returns:
+        list: Listas de nomes; ao menos uma, mesmo que vazia
+    """
+    blocos = [[]]
+    tamanho = 0
+    for nome in nomes:
+        custo = len(json.dumps(nome, ensure_ascii=False).encode()) + 1
+        if blocos[-1] and tamanho + custo > limite:
+            blocos.append([])
+            tamanho = 0
+        blocos[-1].append(nome)
+        tamanho += custo
+    return blocos
+
+
+def codificar(marcador, dados):
+    """Monta uma linha de presença terminada em \\n"""
+    return (
+        marcador
+        + json.dumps(dados, ensure_ascii=False, separators=(',', ':'))
+        + '\n'
+    ).encode()
+
+
+class PresencaSala:
+    """Lista de membros de uma sala com versão e as mudanças ainda não publicadas"""
+
+    __slots__ = ('versao', 'membros', 'pendentes')
+
+    def __init__(self):
+        """Inicializa a sala vazia na versão 0"""
+        self.versao = 0
+        self.membros = {}
+        self.pendentes = {}
+
+
+class Presenca:
+    """Listas de membros das salas, publicadas como retrato na entrada e como deltas versionados
+
+    Entradas e saídas não são publicadas na hora: acumulam-se por sala e, a cada tick,
+    o saldo vira um único delta (e um único aviso de texto), de modo que uma rajada de
+    entradas e saídas não afogue as mensagens do chat. Um usuário que entra e sai no
+    mesmo tick não gera delta algum.
+
+    Com ids_nomes, retratos e publicações são cargas com as codificações de texto e
+    binária, e os avisos de entrada e saída viram eventos tipados no protocolo binário.
+    """
+
+    def __init__(self, publicar, intervalo=INTERVALO_TICK, ids_nomes=None):
+        """Inicializa a presença
+
+        Args:
+            publicar: Função chamada com (sala_id, dados) para enviar bytes, ou uma Carga, a todos os membros da sala
+            intervalo: Segundos entre publicações
+            ids_nomes: Função que retorna o ID de um nome, ou None para publicar apenas texto
+        """
+        self.publicar = publicar
+        self.intervalo = intervalo
+        self.ids_nomes = ids_nomes
+        self.salas = {}
+        self.lock = threading.Lock()
+        self.parar_publicacao = threading.Event()
+        self.thread_publicacao = None
+
+    def entrar(self, sala_id, nome):
+        """Registra a entrada de um usuário e retorna o retrato da sala para ele
+
+        O retrato corresponde à última versão publicada; a entrada do próprio usuário
+        chega no delta do próximo tick.
+
+        Args:
+            sala_id: ID da sala
+            nome: Nome do usuário
+
+        Returns:
+            bytes: Linhas do retrato, ou Carga com ids_nomes
+        """
+        with self.lock:
+            sala = self.salas.get(sala_id)
+            if sala is None:
+                sala = self.salas[sala_id] = PresencaSala()
+            sala.pendentes[nome] = sala.pendentes.get(nome, 0) + 1
+            return self.montar_retrato(sala)
+
+    def sair(self, sala_id, nome):
+        """Registra a saída de um usuário"""
+        with self.lock:
+            sala = self.salas.get(sala_id)
+            if sala is not None:
+                sala.pendentes[nome] = sala.pendentes.get(nome, 0) - 1
+
+    def obter_retrato(self, sala_id):
+        """Retorna o retrato da sala, pedido por um membro que perdeu a sequência de versões"""
+        with self.lock:
+            sala = self.salas.get(sala_id)
+            if sala is None:
+                sala = PresencaSala()
+            return self.montar_retrato(sala)
+
+    def montar_retrato(self, sala):
+        """Monta as linhas do retrato; blocos intermediários levam continua=True
+
+        Returns:
+            bytes: Linhas do retrato, ou Carga com ids_nomes
+        """
+        blocos = dividir_nomes(sorted(sala.membros))
+        dados = b''.join(
+            codificar(
+                MARCADOR_MEMBROS,
+                {
+                    'versao': sala.versao,
+                    'membros': bloco,
+                    'continua': posicao < len(blocos) - 1,
+                },
+            )
+            for posicao, bloco in enumerate(blocos)
+        )
+        return dados if self.ids_nomes is None else Carga.controle(dados)
+
+    def consolidar(self, sala):
+        """Aplica as mudanças pendentes de uma sala e monta o que deve ser publicado
+
+        Returns:
+            bytes: Avisos de texto e deltas, ou b'' se o saldo do tick não mudou a lista; com ids_nomes, uma Carga, ou None
+        """
+        entraram = []
+        sairam = []
+        for nome, saldo in sala.pendentes.items():
+            antes = sala.membros.get(nome, 0)
+            depois = antes + saldo
+            if depois > 0:
+                sala.membros[nome] = depois
+            else:
+                sala.membros.pop(nome, None)
+            if antes <= 0 < depois:
+                entraram.append(nome)
+            elif depois <= 0 < antes:
+                sairam.append(nome)
+        sala.pendentes.clear()
+        if not entraram and not sairam:
+            return b'' if self.ids_nomes is None else None
+
+        if len(entraram) + len(sairam) <= MAX_AVISOS_INDIVIDUAIS:
+            eventos = [
+                (evento, (nomes,))
+                for evento, nomes in (
+                    (EVENTO_ENTRADA, entraram),
+                    (EVENTO_SAIDA, sairam),
+                )
+                if nomes
+            ]
+        else:
+            eventos = [(EVENTO_MOVIMENTO, (len(entraram), len(sairam)))]
+
+        # Cada bloco é um delta próprio, com sua versão
+        deltas = b''
+        for nomes, chave in ((entraram, 'entraram'), (sairam, 'sairam')):
+            if not nomes:
+                continue
+            for bloco in dividir_nomes(nomes):
+                sala.versao += 1
+                deltas += codificar(
+                    MARCADOR_DELTA,
+                    {
+                        'base': sala.versao - 1,
+                        'versao': sala.versao,
+                        chave: bloco,
+                    },
+                )
+
+        if self.ids_nomes is None:
+            avisos = ''.join(
+                linha + '\n'
+                for evento, valores in eventos
+                for linha in formatar_evento(evento, valores)
+            )
+            return avisos.encode() + deltas
+
+        cargas = []
+        for evento, valores in eventos:
+            if evento == EVENTO_MOVIMENTO:
+                cargas.append(Carga.evento(evento, valores))
+                continue
+            ids = {self.ids_nomes(nome): nome for nome in valores[0]}
+            cargas.append(Carga.evento(evento, (list(ids),), ids.__getitem__))
+        cargas.append(Carga.controle(deltas))
+        return Carga.juntar(cargas)
+
+    def publicar_pendentes(self):
+        """Consolida as mudanças de todas as salas e as publica"""
+        publicacoes = []
+        with self.lock:
+            for sala_id, sala in list(self.salas.items()):
+                if sala.pendentes:
+                    dados = self.consolidar(sala)
+                    if dados:
+                        publicacoes.append((sala_id, dados))
+                if not sala.membros and not sala.pendentes:
+                    del self.salas[sala_id]
+
+        for sala_id, dados in publicacoes:
+            self.publicar(sala_id, dados)
+
+    def executar_publicacao(self):
+        """Loop da thread de publicação"""
+        while not self.parar_publicacao.wait(self.intervalo):
+            self.publicar_pendentes()
+
+    def iniciar(self):
+        """Inicia a thread de publicação"""
+        if self.thread_publicacao is not None:
+            return
+        self.parar_publicacao.clear()
+        self.thread_publicacao = threading.Thread(
+            target=self.executar_publicacao, daemon=True
+        )
+        self.thread_publicacao.start()
+
+    def parar(self):
+        """Encerra a thread de publicação"""
+        if self.thread_publicacao is None:
+            return
+        self.parar_publicacao.set()
+        self.thread_publicacao.join()
+        self.thread_publicacao = None
+
+
+class ListaMembros:
+    """Lista de membros mantida pelo cliente a partir do retrato e dos deltas do servidor"""
+
+    def __init__(self):
+        """Inicializa a lista, ainda sem retrato"""
+        self.versao = None
+        self.membros = set()
+        self.recebendo = None
+        self.adiados = []
+        self.precisa_retrato = False
+        self.retrato_pedido = False
+
+    def pedir_retrato(self):
+        """Indica, uma única vez por falha na sequência, que o cliente deve pedir um novo retrato
+
+        Returns:
+            bool: True se o cliente deve enviar MARCADOR_MEMBROS agora
+        """
+        if self.precisa_retrato and not self.retrato_pedido:
+            self.retrato_pedido = True
+            return True
+        return False
+
+    def processar(self, linha):
+        """Aplica uma linha de presença recebida do servidor
+
+        Deltas que chegam antes do retrato ficam adiados e são aplicados sobre ele. Um
+        delta que pula versões marca precisa_retrato, e o cliente deve pedir um novo
+        retrato (ver pedir_retrato).
+
+        Args:
+            linha: Linha recebida
+
+        Returns:
+            bool: None se a linha não é de presença; senão, True se a lista mudou
+        """
+        if linha.startswith(MARCADOR_MEMBROS):
+            dados = ler_dados(linha, MARCADOR_MEMBROS)
+            if dados is None:
+                return False
+            if self.recebendo is None:
+                self.recebendo = set()
+            self.recebendo.update(dados.get('membros', ()))
+            if dados.get('continua'):
+                return False
+
+            self.membros, self.recebendo = self.recebendo, None
+            self.versao = dados.get('versao', 0)
+            self.precisa_retrato = False
+            self.retrato_pedido = False
+            adiados, self.adiados = self.adiados, []
+            for delta in adiados:
+                self.aplicar_delta(delta)
+            return True
+
+        if linha.startswith(MARCADOR_DELTA):
+            dados = ler_dados(linha, MARCADOR_DELTA)
+            if dados is None:
+                return False
+            if (
+                self.versao is None
+                or self.recebendo is not None
+                or self.precisa_retrato
+            ):
+                self.adiados.append(dados)
+                del self.adiados[:-MAX_DELTAS_ADIADOS]
+                return False
+            return self.aplicar_delta(dados)
+
+        return None
+
+    def aplicar_delta(self, dados):
+        """Aplica um delta sobre a versão atual
+
+        Returns:
+            bool: True se a lista mudou
+        """
+        if dados.get('versao', 0) <= self.versao:
+            return False
+        if dados.get('base') != self.versao:
+            self.precisa_retrato = True
+            return False
+        self.membros.update(dados.get('entraram', ()))
+        self.membros.difference_update(dados.get('sairam', ()))
+        self.versao = dados['versao']
+        return True
+
+
+def ler_dados(linha, marcador):
+    """Decodifica o JSON de uma linha de presença
+
+    Returns:
+        dict: Dados da linha, ou None se ela está malformada
+    """
+    try:
+        dados = json.loads(linha[len(marcador) :])
+    except ValueError:
+        return None
+    return dados if isinstance(dados, dict) else None
@@ -0,0 +1,580 @@
+import errno
+import heapq
+import itertools
+import random
+import select
+import selectors
+import socket
+import time
+
+from perfis_rede import ajustar_conexao
+
+SOLICITACAO_SALA = 'SALA'
+MARCADOR_LISTAR_SALAS = '#LISTAR_SALAS#'
+MARCADOR_TENTE_NOVAMENTE = '#TENTE_NOVAMENTE#'
+PREFIXO_UNIX = 'unix:'
+RECONEXAO_BASE = 0.5
+RECONEXAO_TETO = 30.0
+TAMANHO_LEITURA = 64 * 1024
+TAMANHO_MAX_LINHA = 64 * 1024
+# Limite das linhas que o servidor aceita dos clientes: com nome, destinatários
+# e texto no limite, a linha ou o quadro entregue ainda cabe em TAMANHO_MAX_LINHA
+TAMANHO_MAX_MENSAGEM = 16 * 1024
+CONEXAO_EM_ANDAMENTO = {
+    0,
+    errno.EINPROGRESS,
+    errno.EWOULDBLOCK,
+    getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK),
+}
+
+
+class ErroProtocolo(Exception):
+    """Erro de enquadramento ou sequência de mensagens do protocolo"""
+
+
+def resolver_endereco(host, port):
+    """Resolve o endereço do servidor para criar e conectar o socket
+
+    Um host no formato unix:/caminho/do/socket indica o socket Unix de um servidor
+    na mesma máquina; nesse caso a porta é ignorada.
+
+    Args:
+        host: Endereço do servidor, ou unix: seguido do caminho do socket
+        port: Porta do servidor
+
+    Returns:
+        tuple: (família, tipo, protocolo, endereço) para socket.socket e connect
+    """
+    if host.startswith(PREFIXO_UNIX):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Sockets Unix não são suportados nesta plataforma')
+        return socket.AF_UNIX, socket.SOCK_STREAM, 0, host[len(PREFIXO_UNIX) :]
+    familia, tipo, proto, _, endereco = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM
+    )[0]
+    return familia, tipo, proto, endereco
+
+
+def formatar_endereco(host, port):
+    """Formata o endereço do servidor para mensagens ao usuário"""
+    if host.startswith(PREFIXO_UNIX):
+        return host
+    return f'{host}:{port}'
+
+
+def codificar_linha(texto):
+    """Codifica uma mensagem de texto como linha do protocolo
+
+    Args:
+        texto: Texto da mensagem, sem quebras de linha
+
+    Returns:
+        bytes: Linha terminada em \\n
+    """
+    return texto.replace('\n', ' ').encode() + b'\n'
+
+
+def codificar_varint(valor):
+    """Codifica um inteiro não negativo em varint (7 bits por byte, menos significativos primeiro)
+
+    Args:
+        valor: Inteiro não negativo
+
+    Returns:
+        bytes: Inteiro codificado
+    """
+    saida = bytearray()
+    while valor > 0x7F:
+        saida.append((valor & 0x7F) | 0x80)
+        valor >>= 7
+    saida.append(valor)
+    return bytes(saida)
+
+
+def ler_varint(dados, posicao):
+    """Decodifica um varint a partir de uma posição
+
+    Args:
+        dados: Bytes de origem
+        posicao: Posição do primeiro byte do varint
+
+    Returns:
+        tuple: (valor, posição seguinte ao varint)
+    """
+    valor = 0
+    deslocamento = 0
+    while True:
+        if posicao >= len(dados):
+            raise ErroProtocolo('Varint incompleto')
+        byte = dados[posicao]
+        posicao += 1
+        valor |= (byte & 0x7F) << deslocamento
+        if byte < 0x80:
+            return valor, posicao
+        deslocamento += 7
+        if deslocamento > 63:
+            raise ErroProtocolo('Varint muito longo')
+
+
+def codificar_texto(texto):
+    """Codifica uma string como tamanho em varint seguido dos bytes UTF-8"""
+    dados = texto.encode()
+    return codificar_varint(len(dados)) + dados
+
+
+def ler_texto(dados, posicao):
+    """Decodifica uma string gravada por codificar_texto
+
+    Returns:
+        tuple: (texto, posição seguinte)
+    """
+    tamanho, posicao = ler_varint(dados, posicao)
+    fim = posicao + tamanho
+    if fim > len(dados):
+        raise ErroProtocolo('Texto incompleto')
+    return dados[posicao:fim].decode(errors='replace'), fim
+
+
+def ler_tente_novamente(linha):
+    """Extrai a espera sugerida de uma recusa do servidor por sobrecarga
+
+    Args:
+        linha: Linha recebida no lugar da solicitação de sala
+
+    Returns:
+        float: Segundos sugeridos pelo servidor, ou None se a linha não é uma recusa
+    """
+    if not linha.startswith(MARCADOR_TENTE_NOVAMENTE):
+        return None
+    try:
+        return max(0.0, float(linha[len(MARCADOR_TENTE_NOVAMENTE) :]))
+    except ValueError:
+        return RECONEXAO_BASE
+
+
+def calcular_espera_reconexao(
+    tentativa, tentar_apos=None, base=RECONEXAO_BASE, teto=RECONEXAO_TETO
+):
+    """Calcula a espera antes de uma nova tentativa de conexão, com backoff exponencial e jitter completo
+
+    Args:
+        tentativa: Número de tentativas já feitas desde a última conexão bem sucedida
+        tentar_apos: Espera sugerida pelo servidor, se ele recusou a conexão por sobrecarga
+        base: Espera base da primeira tentativa
+        teto: Maior espera possível do backoff
+
+    Returns:
+        float: Segundos a aguardar
+    """
+    # O expoente é limitado para que uma queda longa não estoure o float
+    espera = random.uniform(0, min(teto, base * 2 ** min(tentativa, 32)))
+    if tentar_apos is not None:
+        espera = max(espera, tentar_apos + random.uniform(0, tentar_apos))
+    return espera
+
+
+class LeitorLinhas:
+    """Separa em linhas os bytes recebidos de um socket, guardando o que sobrar para a próxima leitura"""
+
+    __slots__ = ('sock', 'buffer', 'limite')
+
+    def __init__(self, sock=None, limite=TAMANHO_MAX_LINHA):
+        """Inicializa o leitor
+
+        Args:
+            sock: Socket de origem, usado apenas pela leitura bloqueante
+            limite: Tamanho máximo de uma linha em bytes, sem o terminador
+        """
+        self.sock = sock
+        self.buffer = bytearray()
+        self.limite = limite
+
+    def alimentar(self, dados):
+        """Acrescenta bytes recebidos e retorna as linhas completas
+
+        Args:
+            dados: Bytes recebidos
+
+        Returns:
+            list: Linhas completas decodificadas, sem o terminador
+        """
+        self.buffer += dados
+        if b'\n' not in dados:
+            if len(self.buffer) > self.limite:
+                raise ErroProtocolo('Linha excede o tamanho máximo')
+            return []
+
+        excede = len(self.buffer) > self.limite
+        *linhas, resto = self.buffer.split(b'\n')
+        self.buffer = bytearray(resto)
+        # Só um buffer acima do limite pode conter uma linha acima do limite
+        if excede and (
+            len(resto) > self.limite
+            or any(len(linha) > self.limite for linha in linhas)
+        ):
+            raise ErroProtocolo('Linha excede o tamanho máximo')
+        return [linha.decode(errors='replace') for linha in linhas]
+
+    def ler_linha(self):
+        """Lê a próxima linha de forma bloqueante
+
+        Returns:
+            str: Linha decodificada, ou None se a conexão foi encerrada
+        """
+        while True:
+            fim = self.buffer.find(b'\n')
+            if fim > self.limite:
+                raise ErroProtocolo('Linha excede o tamanho máximo')
+            if fim >= 0:
+                linha = bytes(self.buffer[:fim])
+                del self.buffer[: fim + 1]
+                return linha.decode(errors='replace')
+
+            if len(self.buffer) > self.limite:
+                raise ErroProtocolo('Linha excede o tamanho máximo')
+            dados = self.sock.recv(TAMANHO_LEITURA)
+            if not dados:
+                return None
+            self.buffer += dados
+
+
+class ConexaoChat:
+    """Conexão não bloqueante com o servidor, conduzida por um loop de eventos externo
+
+    O loop informa quando o socket pode ser lido ou escrito chamando processar_leitura
+    e processar_escrita; a conexão avisa o loop quando passa a ter dados para enviar
+    (atualizar) ou quando é encerrada (remover).
+    """
+
+    def __init__(
+        self,
+        loop,
+        host,
+        port,
+        handshake=(),
+        ao_conectar=None,
+        ao_receber=None,
+        ao_desconectar=None,
+        decodificador=None,
+        perfil=None,
+    ):
+        """Inicializa a conexão, sem abrir o socket
+
+        Args:
+            loop: Loop de eventos com os métodos registrar, atualizar e remover
+            host: Endereço do servidor, ou unix: seguido do caminho do socket
+            port: Porta do servidor, ignorada em endereços unix:
+            handshake: Linhas enviadas ao servidor quando ele solicitar a sala
+            ao_conectar: Função chamada quando o handshake é concluído
+            ao_receber: Função chamada com cada linha recebida após o handshake
+            ao_desconectar: Função chamada com a mensagem de erro (ou None) ao encerrar
+            decodificador: Objeto com alimentar(dados) que interpreta os bytes recebidos após o handshake, no lugar do leitor de linhas; ao_receber recebe os itens que ele retornar
+            perfil: PerfilRede aplicado ao socket antes de conectar, ou None para as opções padrão
+        """
+        self.loop = loop
+        self.host = host
+        self.port = port
+        self.handshake = list(handshake)
+        self.ao_conectar = ao_conectar
+        self.ao_receber = ao_receber
+        self.ao_desconectar = ao_desconectar
+        self.sock = None
+        self.estado = 'fechada'
+        self.tentar_apos = None
+        self.leitor = LeitorLinhas()
+        self.decodificador = decodificador
+        self.perfil = perfil
+        self.saida = bytearray()
+
+    def iniciar(self):
+        """Cria o socket não bloqueante e inicia a conexão com o servidor"""
+        try:
+            familia, tipo, proto, endereco = resolver_endereco(
+                self.host, self.port
+            )
+            self.sock = socket.socket(familia, tipo, proto)
+            if self.perfil is not None:
+                ajustar_conexao(self.sock, self.perfil)
+            self.sock.setblocking(False)
+            resultado = self.sock.connect_ex(endereco)
+        except OSError as e:
+            self.encerrar(str(e))
+            return
+
+        if resultado not in CONEXAO_EM_ANDAMENTO:
+            self.encerrar(
+                f'Falha na conexão: {errno.errorcode.get(resultado, resultado)}'
+            )
+            return
+
+        self.estado = 'conectando'
+        self.loop.registrar(self)
+
+    @property
+    def aberta(self):
+        """Indica se o socket ainda está em uso"""
+        return self.estado != 'fechada'
+
+    @property
+    def conectada(self):
+        """Indica se o handshake foi concluído"""
+        return self.estado == 'conectada'
+
+    def fileno(self):
+        """Retorna o descritor do socket"""
+        return self.sock.fileno()
+
+    def quer_escrever(self):
+        """Indica se a conexão aguarda o socket ficar disponível para escrita
+
+        Linhas enfileiradas antes do fim do handshake esperam por ele, para não chegarem
+        ao servidor antes da sala e do nome.
+        """
+        if self.estado == 'conectando':
+            return True
+        return self.estado == 'conectada' and bool(self.saida)
+
+    def enviar_linha(self, texto):
+        """Enfileira uma linha para envio
+
+        Args:
+            texto: Texto da mensagem
+        """
+        if not self.aberta:
+            return
+        precisava_escrever = self.quer_escrever()
+        self.saida += codificar_linha(texto)
+        if not precisava_escrever:
+            self.loop.atualizar(self)
+
+    def processar_escrita(self):
+        """Conclui a conexão pendente ou envia os dados enfileirados"""
+        if self.estado == 'conectando':
+            erro = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if erro:
+                self.encerrar(
+                    f'Falha na conexão: {errno.errorcode.get(erro, erro)}'
+                )
+                return
+            self.estado = 'handshake'
+            self.loop.atualizar(self)
+            return
+        if self.estado != 'conectada':
+            return
+
+        try:
+            enviados = self.sock.send(self.saida)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.encerrar(str(e))
+            return
+
+        del self.saida[:enviados]
+        if not self.saida:
+            self.loop.atualizar(self)
+
+    def processar_leitura(self):
+        """Lê os dados disponíveis e entrega as linhas completas"""
+        try:
+            dados = self.sock.recv(TAMANHO_LEITURA)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.encerrar(str(e))
+            return
+
+        if not dados:
+            self.encerrar('Conexão encerrada pelo servidor')
+            return
+
+        try:
+            if self.estado == 'handshake':
+                dados = self.ler_solicitacao(dados)
+                if not dados or not self.conectada:
+                    return
+            if self.decodificador is not None:
+                itens = self.decodificador.alimentar(dados)
+            else:
+                itens = self.leitor.alimentar(dados)
+        except ErroProtocolo as e:
+            self.encerrar(str(e))
+            return
+
+        for item in itens:
+            if not self.aberta:
+                return
+            if isinstance(item, str) and item.startswith(
+                MARCADOR_TENTE_NOVAMENTE
+            ):
+                self.recusada(item)
+            elif self.ao_receber:
+                self.ao_receber(item)
+
+    def ler_solicitacao(self, dados):
+        """Conclui o handshake quando chega a primeira linha do servidor
+
+        Args:
+            dados: Bytes recebidos durante o handshake
+
+        Returns:
+            bytes: O que veio depois da primeira linha, ainda não interpretado
+        """
+        buffer = self.leitor.buffer
+        buffer += dados
+        fim = buffer.find(b'\n')
+        if fim < 0:
+            if len(buffer) > TAMANHO_MAX_LINHA:
+                raise ErroProtocolo('Linha excede o tamanho máximo')
+            return b''
+        linha = bytes(buffer[:fim]).decode(errors='replace')
+        resto = bytes(buffer[fim + 1 :])
+        buffer.clear()
+        self.concluir_handshake(linha)
+        return resto
+
+    def concluir_handshake(self, linha):
+        """Responde à solicitação de sala do servidor com as linhas de handshake
+
+        Args:
+            linha: Primeira linha enviada pelo servidor
+        """
+        if linha.startswith(MARCADOR_TENTE_NOVAMENTE):
+            self.recusada(linha)
+            return
+        if linha != SOLICITACAO_SALA:
+            self.encerrar('Resposta inesperada do servidor')
+            return
+
+        self.estado = 'conectada'
+        # As linhas do handshake vão à frente das enfileiradas enquanto ele durava
+        self.saida[:0] = b''.join(map(codificar_linha, self.handshake))
+        if self.saida:
+            self.loop.atualizar(self)
+        if self.ao_conectar:
+            self.ao_conectar()
+
+    def recusada(self, linha):
+        """Encerra a conexão recusada pelo servidor por sobrecarga, guardando a espera sugerida
+
+        Args:
+            linha: Linha de recusa com a espera sugerida
+        """
+        self.tentar_apos = ler_tente_novamente(linha)
+        self.encerrar(
+            f'Servidor ocupado, tente novamente em {self.tentar_apos:.1f}s'
+        )
+
+    def fechar(self):
+        """Encerra a conexão por iniciativa do cliente, sem avisar ao_desconectar"""
+        self.ao_desconectar = None
+        self.encerrar(None)
+
+    def encerrar(self, erro):
+        """Fecha o socket, remove a conexão do loop e avisa ao_desconectar
+
+        Args:
+            erro: Motivo do encerramento, ou None quando pedido pelo cliente
+        """
+        if self.sock is not None:
+            if self.estado != 'fechada':
+                self.loop.remover(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+        self.estado = 'fechada'
+        ao_desconectar, self.ao_desconectar = self.ao_desconectar, None
+        if ao_desconectar:
+            ao_desconectar(erro)
+
+
+class LoopSelectores:
+    """Loop de eventos baseado em selectors, para clientes sem interface gráfica"""
+
+    def __init__(self):
+        """Inicializa o loop sem conexões"""
+        self.seletor = selectors.DefaultSelector()
+        self.temporizadores = []
+        self.sequencia = itertools.count()
+
+    def eventos(self, conexao):
+        """Retorna os eventos que devem ser monitorados para a conexão"""
+        if conexao.quer_escrever():
+            return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def registrar(self, conexao):
+        """Passa a monitorar uma conexão"""
+        self.seletor.register(conexao.sock, self.eventos(conexao), conexao)
+
+    def atualizar(self, conexao):
+        """Ajusta os eventos monitorados da conexão"""
+        self.seletor.modify(conexao.sock, self.eventos(conexao), conexao)
+
+    def remover(self, conexao):
+        """Deixa de monitorar uma conexão prestes a ser fechada"""
+        self.seletor.unregister(conexao.sock)
+
+    def agendar(self, atraso, funcao):
+        """Agenda uma função para ser executada após um intervalo
+
+        Args:
+            atraso: Segundos até a execução
+            funcao: Função sem argumentos
+        """
+        heapq.heappush(
+            self.temporizadores,
+            (time.monotonic() + atraso, next(self.sequencia), funcao),
+        )
+
+    def executar_uma_vez(self, timeout=None):
+        """Espera por eventos de rede ou pelo próximo temporizador e os despacha
+
+        Args:
+            timeout: Espera máxima em segundos, ou None para aguardar indefinidamente
+        """
+        if self.temporizadores:
+            restante = max(0.0, self.temporizadores[0][0] - time.monotonic())
+            timeout = restante if timeout is None else min(timeout, restante)
+
+        for chave, eventos in self.seletor.select(timeout):
+            conexao = chave.data
+            if eventos & selectors.EVENT_WRITE and conexao.aberta:
+                conexao.processar_escrita()
+            if eventos & selectors.EVENT_READ and conexao.aberta:
+                conexao.processar_leitura()
+
+        agora = time.monotonic()
+        while self.temporizadores and self.temporizadores[0][0] <= agora:
+            _, _, funcao = heapq.heappop(self.temporizadores)
+            funcao()
+
+
+def aguardar_eventos(conexoes, timeout):
+    """Espera, com select, até alguma conexão poder ser lida ou escrita e despacha os eventos
+
+    Útil para loops que não têm suporte a monitorar descritores, como o do Tk no Windows.
+
+    Args:
+        conexoes: Conexões abertas
+        timeout: Tempo máximo de espera em segundos
+    """
+    conexoes = [conexao for conexao in conexoes if conexao.aberta]
+    if not conexoes:
+        return
+
+    leitura, escrita, _ = select.select(
+        conexoes,
+        [conexao for conexao in conexoes if conexao.quer_escrever()],
+        [],
+        timeout,
+    )
+    for conexao in escrita:
+        if conexao.aberta:
+            conexao.processar_escrita()
+    for conexao in leitura:
+        if conexao.aberta:
+            conexao.processar_leitura()
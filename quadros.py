@@ -0,0 +1,464 @@
+from anexos import MARCADOR_ANUNCIO
+from protocolo import (
+    TAMANHO_MAX_LINHA,
+    ErroProtocolo,
+    codificar_linha,
+    codificar_texto,
+    codificar_varint,
+    ler_texto,
+    ler_varint,
+)
+
+MARCADOR_BINARIO = '#BINARIO#'
+
+QUADRO_NOME = 1
+QUADRO_SALA = 2
+QUADRO_MENSAGEM = 3
+QUADRO_EVENTO = 4
+QUADRO_CONTROLE = 5
+QUADRO_DIRETA = 6
+QUADRO_ESQUECER = 7
+
+# IDs por quadro de esquecimento, para o quadro caber em TAMANHO_MAX_LINHA
+IDS_POR_ESQUECIMENTO = 4096
+
+EVENTO_ENTRADA = 1
+EVENTO_SAIDA = 2
+EVENTO_MOVIMENTO = 3
+EVENTO_BLOQUEADA = 4
+EVENTO_NAO_RECUPERADAS = 5
+EVENTO_ANEXO = 6
+EVENTO_SEM_DESTINO = 7
+
+# Campos de cada evento, na ordem em que são codificados: 'nome' é o ID de um
+# nome, 'nomes' uma lista de IDs, 'inteiro' um varint e 'texto' uma string
+CAMPOS_EVENTOS = {
+    EVENTO_ENTRADA: ('nomes',),
+    EVENTO_SAIDA: ('nomes',),
+    EVENTO_MOVIMENTO: ('inteiro', 'inteiro'),
+    EVENTO_BLOQUEADA: (),
+    EVENTO_NAO_RECUPERADAS: ('inteiro',),
+    EVENTO_ANEXO: ('nome', 'texto', 'inteiro', 'texto'),
+    EVENTO_SEM_DESTINO: ('texto',),
+}
+
+
+def codificar_quadro(tipo, corpo=b''):
+    """Monta um quadro: tamanho em varint, tipo em um byte e corpo
+
+    Args:
+        tipo: Tipo do quadro (QUADRO_*)
+        corpo: Bytes do corpo
+
+    Returns:
+        bytes: Quadro codificado
+    """
+    return codificar_varint(len(corpo) + 1) + bytes((tipo,)) + corpo
+
+
+def quadro_nome(id_nome, nome):
+    """Monta o quadro que associa um ID de nome ao nome, enviado uma vez por sessão"""
+    return codificar_quadro(
+        QUADRO_NOME, codificar_varint(id_nome) + codificar_texto(nome)
+    )
+
+
+def quadro_esquecer(ids_nomes):
+    """Monta os quadros que mandam o cliente esquecer nomes apresentados antes
+
+    Args:
+        ids_nomes: IDs dos nomes a esquecer
+
+    Returns:
+        bytes: Um ou mais quadros codificados
+    """
+    quadros = []
+    for inicio in range(0, len(ids_nomes), IDS_POR_ESQUECIMENTO):
+        corpo = b''.join(
+            map(
+                codificar_varint,
+                ids_nomes[inicio : inicio + IDS_POR_ESQUECIMENTO],
+            )
+        )
+        quadros.append(codificar_quadro(QUADRO_ESQUECER, corpo))
+    return b''.join(quadros)
+
+
+def quadro_sala(id_sala, sala):
+    """Monta o quadro que informa o ID e o nome da sala da sessão"""
+    return codificar_quadro(
+        QUADRO_SALA, codificar_varint(id_sala) + codificar_texto(sala)
+    )
+
+
+def quadro_mensagem(remetente, texto):
+    """Monta o quadro de uma mensagem de chat
+
+    Args:
+        remetente: ID do nome do autor
+        texto: Texto da mensagem
+    """
+    return codificar_quadro(
+        QUADRO_MENSAGEM, codificar_varint(remetente) + texto.encode()
+    )
+
+
+def quadro_direta(remetente, destinatarios, texto):
+    """Monta o quadro de uma mensagem direta ou com menções
+
+    Args:
+        remetente: ID do nome do autor
+        destinatarios: IDs dos nomes dos destinatários
+        texto: Texto da mensagem
+    """
+    corpo = bytearray(codificar_varint(remetente))
+    corpo += codificar_varint(len(destinatarios))
+    for id_nome in destinatarios:
+        corpo += codificar_varint(id_nome)
+    corpo += texto.encode()
+    return codificar_quadro(QUADRO_DIRETA, bytes(corpo))
+
+
+def quadro_controle(linha):
+    """Monta o quadro que leva uma linha de controle do protocolo de texto, como as de presença e de busca"""
+    return codificar_quadro(QUADRO_CONTROLE, linha.encode())
+
+
+def quadro_evento(evento, valores):
+    """Monta o quadro de um evento do sistema
+
+    Args:
+        evento: Tipo do evento (EVENTO_*)
+        valores: Valores dos campos do evento, com IDs no lugar dos nomes
+
+    Returns:
+        bytes: Quadro codificado
+    """
+    corpo = bytearray(codificar_varint(evento))
+    for campo, valor in zip(CAMPOS_EVENTOS[evento], valores):
+        if campo == 'nomes':
+            corpo += codificar_varint(len(valor))
+            for id_nome in valor:
+                corpo += codificar_varint(id_nome)
+        elif campo == 'texto':
+            corpo += codificar_texto(valor)
+        else:
+            corpo += codificar_varint(valor)
+    return codificar_quadro(QUADRO_EVENTO, bytes(corpo))
+
+
+def formatar_mensagem(nome, texto):
+    """Formata uma mensagem de chat como é exibida e enviada no protocolo de texto"""
+    return f'{nome}: {texto}'
+
+
+def formatar_direta(nome, destinatarios, texto):
+    """Formata uma mensagem direta como é exibida e enviada no protocolo de texto"""
+    return f'{nome} (para {", ".join(destinatarios)}): {texto}'
+
+
+def formatar_evento(evento, valores):
+    """Formata um evento do sistema como é exibido e enviado no protocolo de texto
+
+    Args:
+        evento: Tipo do evento
+        valores: Valores dos campos, com os nomes já resolvidos
+
+    Returns:
+        list: Linhas de texto do evento
+    """
+    if evento == EVENTO_ENTRADA:
+        return [f'{nome} Entrou na sala' for nome in valores[0]]
+    if evento == EVENTO_SAIDA:
+        return [f'{nome}: Saiu da sala' for nome in valores[0]]
+    if evento == EVENTO_MOVIMENTO:
+        return [
+            f'{valores[0]} usuário(s) entraram e {valores[1]} saíram da sala'
+        ]
+    if evento == EVENTO_BLOQUEADA:
+        return ['Mensagem não enviada: bloqueada pelo filtro de conteúdo']
+    if evento == EVENTO_NAO_RECUPERADAS:
+        return [
+            f'{valores[0]} mensagem(ns) enviada(s) enquanto você esteve fora '
+            'não puderam ser recuperadas'
+        ]
+    if evento == EVENTO_ANEXO:
+        nome, arquivo, tamanho, id_anexo = valores
+        return [
+            f'{nome} enviou o anexo {arquivo} ({tamanho} bytes) '
+            f'{MARCADOR_ANUNCIO}{id_anexo}'
+        ]
+    if evento == EVENTO_SEM_DESTINO:
+        return [
+            f'Mensagem não entregue a {valores[0]}: usuário(s) fora da sala '
+            'ou desconectado(s)'
+        ]
+    return []
+
+
+class Carga:
+    """Conteúdo entregue a sessões nas duas codificações, de texto e binária
+
+    Sessões que negociaram o protocolo binário recebem os quadros; as demais, as linhas
+    de texto. A carga guarda também os nomes que os quadros citam, com seus IDs, para
+    que o servidor apresente a cada sessão, uma única vez, os nomes que ela ainda não
+    conhece, mesmo que o nome já tenha saído da tabela quando a carga é entregue.
+    """
+
+    __slots__ = ('texto', 'binario', 'nomes')
+
+    def __init__(self, texto, binario, nomes=()):
+        """Inicializa a carga
+
+        Args:
+            texto: Linhas do protocolo de texto
+            binario: Quadros do protocolo binário
+            nomes: Pares (ID, nome) dos nomes citados pelos quadros
+        """
+        self.texto = texto
+        self.binario = binario
+        self.nomes = nomes
+
+    def __len__(self):
+        """Total de bytes das duas codificações"""
+        return len(self.texto) + len(self.binario)
+
+    @classmethod
+    def mensagem(cls, remetente, nome, texto):
+        """Monta a carga de uma mensagem de chat
+
+        Args:
+            remetente: ID do nome do autor
+            nome: Nome do autor
+            texto: Texto da mensagem
+        """
+        return cls(
+            codificar_linha(formatar_mensagem(nome, texto)),
+            quadro_mensagem(remetente, texto),
+            ((remetente, nome),),
+        )
+
+    @classmethod
+    def direta(cls, remetente, nome, destinatarios, nomes, texto):
+        """Monta a carga de uma mensagem direta ou com menções
+
+        Args:
+            remetente: ID do nome do autor
+            nome: Nome do autor
+            destinatarios: IDs dos nomes dos destinatários
+            nomes: Nomes dos destinatários
+            texto: Texto da mensagem
+        """
+        citados = {remetente: nome}
+        citados.update(zip(destinatarios, nomes))
+        return cls(
+            codificar_linha(formatar_direta(nome, nomes, texto)),
+            quadro_direta(remetente, destinatarios, texto),
+            tuple(citados.items()),
+        )
+
+    @classmethod
+    def evento(cls, evento, valores=(), nome_de=None):
+        """Monta a carga de um evento do sistema
+
+        Args:
+            evento: Tipo do evento
+            valores: Valores dos campos, com IDs no lugar dos nomes
+            nome_de: Função que retorna o nome de um ID; necessária se o evento cita nomes
+        """
+        nomes = []
+        resolvidos = []
+        for campo, valor in zip(CAMPOS_EVENTOS[evento], valores):
+            if campo == 'nome':
+                nome = nome_de(valor)
+                nomes.append((valor, nome))
+                resolvidos.append(nome)
+            elif campo == 'nomes':
+                pares = [(id_nome, nome_de(id_nome)) for id_nome in valor]
+                nomes.extend(pares)
+                resolvidos.append([nome for _, nome in pares])
+            else:
+                resolvidos.append(valor)
+        linhas = formatar_evento(evento, resolvidos)
+        return cls(
+            b''.join(map(codificar_linha, linhas)),
+            quadro_evento(evento, valores),
+            tuple(nomes),
+        )
+
+    @classmethod
+    def controle(cls, dados):
+        """Monta a carga de linhas de controle já codificadas em texto
+
+        Args:
+            dados: Uma ou mais linhas terminadas em \\n
+        """
+        return cls(
+            dados,
+            b''.join(
+                quadro_controle(linha.decode(errors='replace'))
+                for linha in dados.split(b'\n')[:-1]
+            ),
+        )
+
+    @classmethod
+    def juntar(cls, cargas):
+        """Junta várias cargas numa só, na ordem dada"""
+        if len(cargas) == 1:
+            return cargas[0]
+        nomes = {}
+        for carga in cargas:
+            nomes.update(carga.nomes)
+        return cls(
+            b''.join(carga.texto for carga in cargas),
+            b''.join(carga.binario for carga in cargas),
+            tuple(nomes.items()),
+        )
+
+
+class DecodificadorQuadros:
+    """Separa e interpreta os quadros recebidos pelo cliente, guardando o que sobrar para a próxima leitura
+
+    Os quadros de nome, de esquecimento e de sala só atualizam as tabelas do
+    decodificador; os demais
+    viram itens: linhas de controle como str, mensagens como ('mensagem', nome, texto),
+    mensagens diretas como ('direta', nome, destinatários, texto) e eventos como
+    ('evento', tipo, valores), com os nomes já resolvidos.
+    """
+
+    __slots__ = ('buffer', 'nomes', 'sala')
+
+    def __init__(self):
+        """Inicializa o decodificador sem nomes conhecidos"""
+        self.buffer = bytearray()
+        self.nomes = {}
+        self.sala = None
+
+    def nome(self, id_nome):
+        """Retorna o nome de um ID, ou #ID se o servidor ainda não o apresentou"""
+        nome = self.nomes.get(id_nome)
+        return f'#{id_nome}' if nome is None else nome
+
+    def alimentar(self, dados):
+        """Acrescenta bytes recebidos e retorna os itens dos quadros completos
+
+        Args:
+            dados: Bytes recebidos
+
+        Returns:
+            list: Itens interpretados, na ordem dos quadros
+        """
+        self.buffer += dados
+        buffer = bytes(self.buffer)
+        total = len(buffer)
+        nomes = self.nomes
+        itens = []
+        posicao = 0
+        while posicao < total:
+            tamanho = buffer[posicao]
+            if tamanho < 0x80:
+                inicio = posicao + 1
+            else:
+                try:
+                    tamanho, inicio = ler_varint(buffer, posicao)
+                except ErroProtocolo:
+                    # Varint incompleto espera mais bytes; longo demais é erro
+                    if total - posicao > 9:
+                        raise
+                    break
+            if tamanho == 0 or tamanho > TAMANHO_MAX_LINHA:
+                raise ErroProtocolo('Quadro com tamanho inválido')
+            fim = inicio + tamanho
+            if fim > total:
+                break
+            posicao = fim
+            # Mensagens, o caso comum, são lidas aqui mesmo
+            if buffer[inicio] == QUADRO_MENSAGEM:
+                remetente = buffer[inicio + 1] if fim > inicio + 1 else 0x80
+                if remetente < 0x80:
+                    texto = inicio + 2
+                else:
+                    remetente, texto = ler_varint(buffer, inicio + 1)
+                nome = nomes.get(remetente)
+                itens.append(
+                    (
+                        'mensagem',
+                        f'#{remetente}' if nome is None else nome,
+                        buffer[texto:fim].decode(errors='replace'),
+                    )
+                )
+                continue
+            item = self.interpretar(buffer[inicio], buffer[inicio + 1 : fim])
+            if item is not None:
+                itens.append(item)
+        del self.buffer[:posicao]
+        return itens
+
+    def interpretar(self, tipo, corpo):
+        """Interpreta o corpo de um quadro
+
+        Returns:
+            Item do quadro, ou None se ele não gera item
+        """
+        if tipo == QUADRO_CONTROLE:
+            return corpo.decode(errors='replace')
+        if tipo == QUADRO_MENSAGEM:
+            remetente, posicao = ler_varint(corpo, 0)
+            return (
+                'mensagem',
+                self.nome(remetente),
+                corpo[posicao:].decode(errors='replace'),
+            )
+        if tipo == QUADRO_DIRETA:
+            remetente, posicao = ler_varint(corpo, 0)
+            quantidade, posicao = ler_varint(corpo, posicao)
+            destinatarios = []
+            for _ in range(quantidade):
+                id_nome, posicao = ler_varint(corpo, posicao)
+                destinatarios.append(self.nome(id_nome))
+            return (
+                'direta',
+                self.nome(remetente),
+                destinatarios,
+                corpo[posicao:].decode(errors='replace'),
+            )
+        if tipo == QUADRO_EVENTO:
+            return self.interpretar_evento(corpo)
+        if tipo == QUADRO_ESQUECER:
+            posicao = 0
+            while posicao < len(corpo):
+                id_nome, posicao = ler_varint(corpo, posicao)
+                self.nomes.pop(id_nome, None)
+            return None
+        if tipo in (QUADRO_NOME, QUADRO_SALA):
+            id_valor, posicao = ler_varint(corpo, 0)
+            valor, _ = ler_texto(corpo, posicao)
+            if tipo == QUADRO_NOME:
+                self.nomes[id_valor] = valor
+            else:
+                self.sala = (id_valor, valor)
+        # Tipos desconhecidos são ignorados, para versões futuras do servidor
+        return None
+
+    def interpretar_evento(self, corpo):
+        """Lê os campos de um quadro de evento conforme CAMPOS_EVENTOS"""
+        evento, posicao = ler_varint(corpo, 0)
+        campos = CAMPOS_EVENTOS.get(evento)
+        if campos is None:
+            return None
+        valores = []
+        for campo in campos:
+            if campo == 'nomes':
+                quantidade, posicao = ler_varint(corpo, posicao)
+                nomes = []
+                for _ in range(quantidade):
+                    id_nome, posicao = ler_varint(corpo, posicao)
+                    nomes.append(self.nome(id_nome))
+                valores.append(nomes)
+            elif campo == 'texto':
+                valor, posicao = ler_texto(corpo, posicao)
+                valores.append(valor)
+            else:
+                valor, posicao = ler_varint(corpo, posicao)
+                valores.append(self.nome(valor) if campo == 'nome' else valor)
+        return ('evento', evento, valores)
@@ -0,0 +1,139 @@
+import threading
+import time
+
+from protocolo import (
+    ErroProtocolo,
+    codificar_texto,
+    codificar_varint,
+    ler_texto,
+    ler_varint,
+)
+
+ASSINATURA = b'CSRT\x01'
+EVENTO_ENTRADA = 1
+EVENTO_MENSAGEM = 2
+EVENTO_SAIDA = 3
+EVENTO_RECUSA = 4
+
+
+class GravadorRastro:
+    """Grava em formato binário compacto os eventos de conexão e mensagens do servidor
+
+    Cada registro é o tipo do evento (1 byte), o intervalo desde o registro anterior
+    em microssegundos (varint) e os campos do evento. Com redigir=True o conteúdo das
+    mensagens não é gravado, apenas o seu tamanho.
+    """
+
+    def __init__(self, caminho, redigir=True):
+        """Abre o arquivo de rastro
+
+        Args:
+            caminho: Caminho do arquivo a ser criado
+            redigir: Se True, omite o conteúdo das mensagens
+        """
+        self.caminho = caminho
+        self.redigir = redigir
+        self.arquivo = open(caminho, 'wb', buffering=64 * 1024)
+        self.arquivo.write(ASSINATURA + bytes([int(redigir)]))
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+
+    def gravar(self, tipo, campos):
+        """Grava um registro com o intervalo desde o registro anterior
+
+        Args:
+            tipo: Tipo do evento
+            campos: Campos já codificados
+        """
+        with self.lock:
+            if self.arquivo is None:
+                return
+            agora = time.monotonic()
+            intervalo = max(0, int((agora - self.ultimo) * 1_000_000))
+            self.ultimo = agora
+            self.arquivo.write(
+                bytes([tipo]) + codificar_varint(intervalo) + campos
+            )
+
+    def registrar_entrada(self, sessao_id, sala, nome):
+        """Registra a entrada de uma sessão em uma sala"""
+        self.gravar(
+            EVENTO_ENTRADA,
+            codificar_varint(sessao_id)
+            + codificar_texto(sala)
+            + codificar_texto(nome),
+        )
+
+    def registrar_mensagem(self, sessao_id, mensagem):
+        """Registra uma mensagem enviada por uma sessão"""
+        dados = mensagem.encode()
+        campos = codificar_varint(sessao_id) + codificar_varint(len(dados))
+        if not self.redigir:
+            campos += dados
+        self.gravar(EVENTO_MENSAGEM, campos)
+
+    def registrar_saida(self, sessao_id):
+        """Registra a saída de uma sessão"""
+        self.gravar(EVENTO_SAIDA, codificar_varint(sessao_id))
+
+    def registrar_recusa(self):
+        """Registra uma conexão recusada pelo controle de admissão"""
+        self.gravar(EVENTO_RECUSA, b'')
+
+    def fechar(self):
+        """Grava o que estiver em buffer e fecha o arquivo"""
+        with self.lock:
+            if self.arquivo is not None:
+                self.arquivo.close()
+                self.arquivo = None
+
+
+def ler_rastro(caminho):
+    """Lê um arquivo de rastro
+
+    Args:
+        caminho: Caminho do arquivo
+
+    Returns:
+        tuple: (redigido, lista de eventos); cada evento é uma tupla (tipo, instante em segundos, campos...)
+    """
+    with open(caminho, 'rb') as arquivo:
+        dados = arquivo.read()
+
+    if not dados.startswith(ASSINATURA):
+        raise ErroProtocolo('Arquivo de rastro inválido')
+
+    redigido = bool(dados[len(ASSINATURA)])
+    posicao = len(ASSINATURA) + 1
+    instante = 0
+    eventos = []
+    while posicao < len(dados):
+        tipo = dados[posicao]
+        intervalo, posicao = ler_varint(dados, posicao + 1)
+        instante += intervalo
+        segundos = instante / 1_000_000
+
+        if tipo == EVENTO_ENTRADA:
+            sessao_id, posicao = ler_varint(dados, posicao)
+            sala, posicao = ler_texto(dados, posicao)
+            nome, posicao = ler_texto(dados, posicao)
+            eventos.append((tipo, segundos, sessao_id, sala, nome))
+        elif tipo == EVENTO_MENSAGEM:
+            sessao_id, posicao = ler_varint(dados, posicao)
+            tamanho, posicao = ler_varint(dados, posicao)
+            conteudo = None
+            if not redigido:
+                conteudo = dados[posicao : posicao + tamanho].decode(
+                    errors='replace'
+                )
+                posicao += tamanho
+            eventos.append((tipo, segundos, sessao_id, tamanho, conteudo))
+        elif tipo == EVENTO_SAIDA:
+            sessao_id, posicao = ler_varint(dados, posicao)
+            eventos.append((tipo, segundos, sessao_id))
+        elif tipo == EVENTO_RECUSA:
+            eventos.append((tipo, segundos))
+        else:
+            raise ErroProtocolo(f'Evento desconhecido no rastro: {tipo}')
+
+    return redigido, eventos
@@ -0,0 +1,412 @@
+from collections import deque
+import os
+import secrets
+import sys
+import threading
+import time
+
+from protocolo import (
+    ErroProtocolo,
+    codificar_texto,
+    codificar_varint,
+    ler_texto,
+    ler_varint,
+)
+
+MARCADOR_SESSAO = '#SESSAO#'
+MARCADOR_RETOMAR = '#RETOMAR#'
+ASSINATURA_ESTADO = b'CSES\x01'
+CAPACIDADE_REPETICAO = 500
+VALIDADE_TOKEN = 3600.0
+INTERVALO_RETRATO = 10.0
+TAMANHO_TOKEN = 32
+# Objeto da carga, cabeçalhos das duas codificações, tupla de nomes e posição
+# no deque, além dos dados
+CUSTO_MENSAGEM = 2 * sys.getsizeof(b'') + sys.getsizeof((0,)) + 64
+
+
+class ErroEstado(Exception):
+    """Arquivo de estado do servidor inválido ou corrompido"""
+
+
+class BufferRepeticao:
+    """Últimas mensagens de uma sala, numeradas, para reenvio a sessões retomadas"""
+
+    __slots__ = ('proxima', 'mensagens', 'tamanho', 'lock_publicacao')
+
+    def __init__(self, proxima=1, capacidade=CAPACIDADE_REPETICAO):
+        """Inicializa o buffer vazio
+
+        Args:
+            proxima: Número da próxima mensagem da sala
+            capacidade: Quantidade de mensagens mantidas
+        """
+        self.proxima = proxima
+        self.mensagens = deque(maxlen=capacidade)
+        self.tamanho = 0
+        # Ordena a publicação das mensagens da sala com a entrada de sessões
+        self.lock_publicacao = threading.Lock()
+
+    @property
+    def posicao(self):
+        """Número da última mensagem da sala, ou 0 se ainda não houve nenhuma"""
+        return self.proxima - 1
+
+    def adicionar(self, dados):
+        """Guarda uma mensagem já codificada e retorna o seu número"""
+        seq = self.proxima
+        if len(self.mensagens) == self.mensagens.maxlen:
+            self.tamanho -= len(self.mensagens[0]) + CUSTO_MENSAGEM
+        self.mensagens.append(dados)
+        self.tamanho += len(dados) + CUSTO_MENSAGEM
+        self.proxima += 1
+        return seq
+
+    def esvaziar(self):
+        """Descarta as mensagens guardadas, mantendo a numeração da sala"""
+        self.mensagens.clear()
+        self.tamanho = 0
+
+    def desde(self, posicao):
+        """Retorna as mensagens posteriores a uma posição
+
+        Args:
+            posicao: Número da última mensagem que o cliente recebeu
+
+        Returns:
+            tuple: (lista de mensagens, quantidade de mensagens que já saíram do buffer)
+        """
+        primeira = self.proxima - len(self.mensagens)
+        perdidas = max(0, primeira - (posicao + 1))
+        inicio = max(0, posicao + 1 - primeira)
+        if inicio >= len(self.mensagens):
+            return [], perdidas
+        return list(self.mensagens)[inicio:], perdidas
+
+
+class SessaoRetomavel:
+    """Token de sessão com a sala, o usuário e a posição até onde ele recebeu mensagens"""
+
+    __slots__ = ('nome', 'sala', 'posicao', 'expira')
+
+    def __init__(self, nome, sala, posicao=0, expira=None):
+        """Inicializa o registro
+
+        Args:
+            nome: Nome do usuário
+            sala: Nome da sala
+            posicao: Última mensagem entregue antes da desconexão
+            expira: Horário Unix em que o token deixa de valer, ou None enquanto a sessão está ativa
+        """
+        self.nome = nome
+        self.sala = sala
+        self.posicao = posicao
+        self.expira = expira
+
+
+class Retomada:
+    """Tokens de sessão, buffers de repetição e retrato periódico do estado do servidor
+
+    Cada sessão recebe um token; ao reconectar com ele, o cliente recebe as mensagens da
+    sala que perdeu, se ainda estiverem no buffer. Salas, numeração das mensagens e
+    tokens são gravados periodicamente por uma thread, copiando o estado sob o lock e
+    codificando e gravando o arquivo fora dele.
+
+    Com um orçamento de memória, os buffers das salas usadas há mais tempo podem ser
+    esvaziados; a numeração continua, e quem retomar a sessão nelas é avisado das
+    mensagens que não puderam ser recuperadas. O retrato esquece as salas que o servidor
+    despejou e às quais nenhum token se refere.
+    """
+
+    def __init__(
+        self,
+        caminho,
+        listar_salas,
+        capacidade=CAPACIDADE_REPETICAO,
+        intervalo=INTERVALO_RETRATO,
+        validade=VALIDADE_TOKEN,
+        orcamento=None,
+    ):
+        """Inicializa a retomada
+
+        Args:
+            caminho: Arquivo do retrato do estado
+            listar_salas: Função que retorna os nomes de todas as salas do servidor
+            capacidade: Mensagens mantidas por sala para reenvio
+            intervalo: Segundos entre retratos
+            validade: Segundos que um token vale após a desconexão
+            orcamento: OrcamentoMemoria que limita o total dos buffers, ou None
+        """
+        self.caminho = caminho
+        self.listar_salas = listar_salas
+        self.capacidade = capacidade
+        self.intervalo = intervalo
+        self.validade = validade
+        self.buffers = {}
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.parar_retratos = threading.Event()
+        self.thread_retratos = None
+        self.orcamento = orcamento
+        if orcamento is not None:
+            orcamento.registrar_dono('retomada', self.descartar)
+
+    def buffer(self, sala):
+        """Retorna o buffer de repetição da sala, criando-o se necessário; chamar sob o lock"""
+        buffer = self.buffers.get(sala)
+        if buffer is None:
+            buffer = self.buffers[sala] = BufferRepeticao(
+                capacidade=self.capacidade
+            )
+        return buffer
+
+    def lock_publicacao(self, sala):
+        """Retorna o lock sob o qual as mensagens da sala são registradas e entregues
+
+        Uma sessão que entra na sala sob o mesmo lock recebe cada mensagem uma única
+        vez: ou no reenvio, se ela foi registrada antes, ou ao vivo, se depois.
+
+        Args:
+            sala: Nome da sala
+
+        Returns:
+            threading.Lock: Lock de publicação da sala
+        """
+        with self.lock:
+            return self.buffer(sala).lock_publicacao
+
+    def registrar_mensagem(self, sala, dados):
+        """Guarda uma mensagem enviada na sala
+
+        Args:
+            sala: Nome da sala
+            dados: Mensagem já codificada, como entregue aos membros
+
+        Returns:
+            int: Número da mensagem na sala
+        """
+        with self.lock:
+            buffer = self.buffer(sala)
+            seq = buffer.adicionar(dados)
+            if self.orcamento is not None:
+                self.orcamento.usar('retomada', sala, buffer.tamanho)
+            return seq
+
+    def descartar(self, sala):
+        """Esvazia o buffer de repetição de uma sala, mantendo a numeração
+
+        Args:
+            sala: Nome da sala
+        """
+        with self.lock:
+            buffer = self.buffers.get(sala)
+            if buffer is not None:
+                buffer.esvaziar()
+
+    def abrir_sessao(self, nome, sala, token=None):
+        """Associa uma sessão que entrou na sala a um token, retomando o anterior se válido
+
+        Args:
+            nome: Nome do usuário
+            sala: Nome da sala
+            token: Token apresentado pelo cliente, ou None
+
+        Returns:
+            tuple: (token da sessão, mensagens perdidas a reenviar, quantidade de mensagens que não puderam ser recuperadas); sem retomada, a lista é vazia
+        """
+        with self.lock:
+            buffer = self.buffer(sala)
+            anterior = self.tokens.get(token) if token else None
+            if (
+                anterior is not None
+                and anterior.expira is not None
+                and anterior.expira > time.time()
+                and anterior.nome == nome
+                and anterior.sala == sala
+            ):
+                mensagens, perdidas = buffer.desde(anterior.posicao)
+                anterior.expira = None
+                return token, mensagens, perdidas
+
+            token = secrets.token_hex(TAMANHO_TOKEN // 2)
+            self.tokens[token] = SessaoRetomavel(nome, sala)
+            return token, [], 0
+
+    def fechar_sessao(self, token):
+        """Guarda a posição de uma sessão encerrada e começa a contar a validade do token"""
+        with self.lock:
+            registro = self.tokens.get(token)
+            if registro is not None:
+                registro.posicao = self.buffer(registro.sala).posicao
+                registro.expira = time.time() + self.validade
+
+    def sessao_ativa(self, token):
+        """Retorna o nome e a sala da sessão conectada dona do token
+
+        Args:
+            token: Token apresentado pelo cliente
+
+        Returns:
+            tuple: (nome, sala), ou None se o token não pertence a uma sessão conectada
+        """
+        with self.lock:
+            registro = self.tokens.get(token) if token else None
+            if registro is None or registro.expira is not None:
+                return None
+            return registro.nome, registro.sala
+
+    def salvar(self):
+        """Grava o retrato do estado: salas, numeração das mensagens e tokens válidos"""
+        salas = list(self.listar_salas())
+        agora = time.time()
+        with self.lock:
+            for token in [
+                token
+                for token, registro in self.tokens.items()
+                if registro.expira is not None and registro.expira <= agora
+            ]:
+                del self.tokens[token]
+            # Salas despejadas só continuam numeradas enquanto algum token
+            # guarda uma posição nelas
+            mantidas = set(salas)
+            mantidas.update(registro.sala for registro in self.tokens.values())
+            for sala in [s for s in self.buffers if s not in mantidas]:
+                del self.buffers[sala]
+                if self.orcamento is not None:
+                    self.orcamento.esquecer('retomada', sala)
+            posicoes = {
+                sala: buffer.posicao for sala, buffer in self.buffers.items()
+            }
+            tokens = [
+                (
+                    token,
+                    registro.nome,
+                    registro.sala,
+                    registro.posicao,
+                    registro.expira,
+                )
+                for token, registro in self.tokens.items()
+            ]
+
+        indices = {}
+        for sala in list(posicoes) + salas:
+            indices.setdefault(sala, len(indices))
+
+        dados = bytearray(ASSINATURA_ESTADO)
+        dados += codificar_varint(int(agora))
+        dados += codificar_varint(len(indices))
+        for sala in indices:
+            dados += codificar_texto(sala)
+            dados += codificar_varint(posicoes.get(sala, 0))
+
+        dados += codificar_varint(len(tokens))
+        for token, nome, sala, posicao, expira in tokens:
+            # Sessões ativas gravam a posição atual da sala: se o servidor cair
+            # agora, é até ali que elas receberam
+            if expira is None:
+                posicao = posicoes.get(sala, posicao)
+                restante = int(self.validade)
+            else:
+                restante = max(0, int(expira - agora))
+            dados += codificar_texto(token)
+            dados += codificar_texto(nome)
+            dados += codificar_varint(indices[sala])
+            dados += codificar_varint(posicao)
+            dados += codificar_varint(restante)
+
+        os.makedirs(
+            os.path.dirname(os.path.abspath(self.caminho)), exist_ok=True
+        )
+        temporario = self.caminho + '.tmp'
+        with open(temporario, 'wb') as arquivo:
+            arquivo.write(dados)
+        os.replace(temporario, self.caminho)
+
+    def carregar(self):
+        """Lê o último retrato do estado, numa única passada pelo arquivo
+
+        Returns:
+            list: Nomes das salas restauradas; vazia se não há retrato
+        """
+        try:
+            with open(self.caminho, 'rb') as arquivo:
+                dados = arquivo.read()
+        except FileNotFoundError:
+            return []
+        if not dados.startswith(ASSINATURA_ESTADO):
+            raise ErroEstado(f'Arquivo de estado inválido: {self.caminho}')
+
+        try:
+            gravado, posicao = ler_varint(dados, len(ASSINATURA_ESTADO))
+            # A validade dos tokens continua correndo enquanto o servidor esteve parado
+            atraso = max(0, time.time() - gravado)
+            total_salas, posicao = ler_varint(dados, posicao)
+            salas = []
+            buffers = {}
+            for _ in range(total_salas):
+                sala, posicao = ler_texto(dados, posicao)
+                ultima, posicao = ler_varint(dados, posicao)
+                sala = sys.intern(sala)
+                salas.append(sala)
+                buffers[sala] = BufferRepeticao(ultima + 1, self.capacidade)
+
+            total_tokens, posicao = ler_varint(dados, posicao)
+            tokens = {}
+            agora = time.time()
+            for _ in range(total_tokens):
+                token, posicao = ler_texto(dados, posicao)
+                nome, posicao = ler_texto(dados, posicao)
+                indice, posicao = ler_varint(dados, posicao)
+                ultima, posicao = ler_varint(dados, posicao)
+                restante, posicao = ler_varint(dados, posicao)
+                if restante > atraso and indice < len(salas):
+                    tokens[token] = SessaoRetomavel(
+                        sys.intern(nome),
+                        salas[indice],
+                        ultima,
+                        agora + restante - atraso,
+                    )
+        except ErroProtocolo as e:
+            raise ErroEstado(
+                f'Arquivo de estado corrompido: {self.caminho}'
+            ) from e
+
+        with self.lock:
+            self.buffers.update(buffers)
+            self.tokens.update(tokens)
+        return salas
+
+    def estatisticas(self):
+        """Retorna a quantidade de salas com numeração e de tokens conhecidos"""
+        with self.lock:
+            return {'salas': len(self.buffers), 'tokens': len(self.tokens)}
+
+    def executar_retratos(self):
+        """Loop da thread de retratos"""
+        while not self.parar_retratos.wait(self.intervalo):
+            try:
+                self.salvar()
+            except OSError:
+                pass
+
+    def iniciar(self):
+        """Inicia a thread de retratos periódicos"""
+        if self.thread_retratos is not None:
+            return
+        self.parar_retratos.clear()
+        self.thread_retratos = threading.Thread(
+            target=self.executar_retratos, daemon=True
+        )
+        self.thread_retratos.start()
+
+    def parar(self):
+        """Encerra a thread de retratos e grava o retrato final"""
+        if self.thread_retratos is None:
+            return
+        self.parar_retratos.set()
+        self.thread_retratos.join()
+        self.thread_retratos = None
+        try:
+            self.salvar()
+        except OSError:
+            pass
@@ -1,22 +1,73 @@
+import itertools
+import os
+import selectors
 import socket
+import stat
 import threading
 import tkinter as tk
 from tkinter import scrolledtext, PhotoImage
 import time
 
+import anexos
+import busca
+import diretas
+from admissao import ControleAdmissao
+from ciclo_salas import CicloSalas, OrcamentoMemoria
+from entrega import EntregaAgrupada
+from filtros import FiltroTermos, PipelineMensagens
+from perfis_rede import (
+    PERFIL_PADRAO,
+    PERFIS,
+    PRAZO_ENVIO_SESSAO,
+    ajustar_conexao,
+    ajustar_ouvinte,
+    limitar_envio,
+    obter_perfil,
+)
+from presenca import MARCADOR_MEMBROS, Presenca
+from quadros import (
+    EVENTO_ANEXO,
+    EVENTO_BLOQUEADA,
+    EVENTO_NAO_RECUPERADAS,
+    EVENTO_SEM_DESTINO,
+    MARCADOR_BINARIO,
+    Carga,
+    formatar_mensagem,
+    quadro_controle,
+    quadro_esquecer,
+    quadro_nome,
+    quadro_sala,
+)
+from rastro import GravadorRastro
+from retomada import MARCADOR_RETOMAR, MARCADOR_SESSAO, Retomada
+from protocolo import (
+    MARCADOR_LISTAR_SALAS,
+    MARCADOR_TENTE_NOVAMENTE,
+    PREFIXO_UNIX,
+    SOLICITACAO_SALA,
+    TAMANHO_MAX_MENSAGEM,
+    LeitorLinhas,
+    codificar_linha,
+)
+from sessoes import IndiceUsuarios, Sessao, TabelaInterna
+
 
 class Servidor:
     """Classe do Serviddor"""
 
-    def __init__(self, root):
-        """Inicializa o servidor
+    def __init__(self, root=None, diretorio='.'):
+        """Inicializa o servidor; as pastas de estado só são criadas ao iniciá-lo
 
         Args:
-            root: Janela pai do servidor
+            root: Janela pai do servidor. Sem janela, o servidor roda sem interface e registra os logs apenas no terminal
+            diretorio: Diretório base dos anexos, índices, estado, filtros e rastros
         """
         self.root = root
-        self.configurar_janela()
-        self.criar_widgets()
+        self.diretorio = diretorio
+        self.log_area = None
+        if self.root is not None:
+            self.configurar_janela()
+            self.criar_widgets()
         self.inicializar_variaveis()
 
     def configurar_janela(self):
@@ -32,8 +83,9 @@ class Servidor:
             pass
 
     def criar_widgets(self):
-        """Cria os principais elementos da tela, como o frame dos campos, botões e o frame de logs"""
+        """Cria os principais elementos da tela, como o frame dos campos, botões, a barra de status e o frame de logs"""
         self.criar_frame_config()
+        self.criar_barra_status()
         self.criar_area_logs()
 
     def criar_frame_config(self):
@@ -72,6 +124,68 @@ class Servidor:
         )
         self.btn_pausar.grid(row=0, column=5, padx=5, pady=5)
 
+        self.gravar_rastro = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            frame_config,
+            text='Gravar rastro',
+            variable=self.gravar_rastro,
+        ).grid(row=1, column=0, columnspan=3, sticky=tk.W, padx=5)
+
+        self.rastro_completo = tk.BooleanVar(value=False)
+        tk.Checkbutton(
+            frame_config,
+            text='Incluir conteúdo das mensagens',
+            variable=self.rastro_completo,
+        ).grid(row=1, column=3, columnspan=3, sticky=tk.W, padx=5)
+
+        tk.Label(frame_config, text='Socket Unix:').grid(
+            row=2, column=0, padx=5, pady=5
+        )
+        self.unix_entry = tk.Entry(frame_config, width=30)
+        self.unix_entry.grid(
+            row=2, column=1, columnspan=5, sticky=tk.W, padx=5, pady=5
+        )
+
+        tk.Label(frame_config, text='Perfil de rede:').grid(
+            row=3, column=0, padx=5, pady=5
+        )
+        self.perfil_var = tk.StringVar(value=PERFIL_PADRAO)
+        tk.OptionMenu(frame_config, self.perfil_var, *PERFIS).grid(
+            row=3, column=1, columnspan=2, sticky=tk.W, padx=5, pady=5
+        )
+
+    def criar_barra_status(self):
+        """Cria a barra com as contagens de conexões ativas, handshakes pendentes e conexões descartadas"""
+        self.status_label = tk.Label(self.root, anchor=tk.W)
+        self.status_label.pack(fill=tk.X, padx=10)
+        self.root.after(1000, self.atualizar_status)
+
+    def atualizar_status(self):
+        """Atualiza a barra de status a cada segundo, com a admissão, as salas em lote, a memória fria e o tempo médio de cada etapa de filtro"""
+        estatisticas = self.admissao.estatisticas()
+        em_lote = self.entrega.estatisticas()['salas_agrupando']
+        memoria = self.orcamento.estatisticas()
+        descartes = ', '.join(
+            f'{motivo}: {total}'
+            for motivo, total in sorted(estatisticas['descartes'].items())
+        )
+        self.status_label.config(
+            text=f"Conexões: {estatisticas['conexoes']} | "
+            f"Handshakes: {estatisticas['handshakes']} | "
+            f"Descartadas: {estatisticas['total_descartes']}"
+            + (f' ({descartes})' if descartes else '')
+            + f' | Salas em lote: {em_lote}'
+            + f" | Memória fria: {memoria['usado'] / 2**20:.1f}/"
+            f"{memoria['limite'] / 2**20:.0f} MiB"
+            + ''.join(
+                f" | Filtro {nome}: {etapa['medio_us']:.1f} µs/msg, "
+                f"{etapa['alteradas'] + etapa['bloqueadas']} filtrada(s)"
+                for nome, etapa in self.filtros.estatisticas().items()
+                if etapa['chamadas']
+            )
+        )
+        self.root.after(1000, self.atualizar_status)
+
     def criar_area_logs(self):
         """Cria a área de logs do servidor, onde serão exibidas todas as mensagens de status e eventos"""
         tk.Label(self.root, text='Logs do Servidor:').pack(
@@ -83,11 +197,51 @@ class Servidor:
         self.log_area.pack(padx=10, pady=5, fill=tk.BOTH, expand=True)
 
     def inicializar_variaveis(self):
-        """Inicializa as variáveis de controle do servidor, como status de execução, socket e dicionário de salas"""
+        """Inicializa as variáveis de controle do servidor, como status de execução, socket, tabelas de nomes e salas e o dicionário de salas"""
         self.servidor_rodando = False
         self.server = None
+        self.server_unix = None
+        self.perfil_rede = obter_perfil(PERFIL_PADRAO)
+        self.despertador = None
+        self.servidor_pronto = threading.Event()
         self.thread_servidor = None
+        self.rastro = None
+        self.tabela_nomes = TabelaInterna()
+        self.tabela_salas = TabelaInterna()
         self.salas = {}
+        self.usuarios = IndiceUsuarios()
+        self.lock_salas = threading.Lock()
+        self.contador_sessoes = itertools.count(1)
+        self.anexos = anexos.RepositorioAnexos(
+            os.path.join(self.diretorio, 'anexos')
+        )
+        self.orcamento = OrcamentoMemoria()
+        self.busca = busca.IndiceBusca(
+            os.path.join(self.diretorio, 'indices'), orcamento=self.orcamento
+        )
+        self.entrega = EntregaAgrupada(
+            self.broadcast,
+            ao_mudar_modo=self.avisar_modo_entrega,
+            juntar=Carga.juntar,
+        )
+        self.presenca = Presenca(
+            self.entrega.entregar, ids_nomes=self.tabela_nomes.id_avulso
+        )
+        self.retomada = Retomada(
+            os.path.join(self.diretorio, 'estado', 'estado.bin'),
+            self.listar_salas,
+            orcamento=self.orcamento,
+        )
+        self.ciclo_salas = CicloSalas(
+            self.despejar_salas_vazias, self.orcamento
+        )
+        self.estado_restaurado = False
+        self.admissao = ControleAdmissao()
+        self.filtro_termos = FiltroTermos(
+            os.path.join(self.diretorio, 'filtros', 'termos.txt'),
+            avisar=lambda mensagem: self.log(mensagem),
+        )
+        self.filtros = PipelineMensagens([self.filtro_termos])
 
     def log(self, mensagem):
         """Adiciona uma mensagem ao log com timestamp atual
@@ -97,8 +251,9 @@ class Servidor:
         """
         timestamp = time.strftime('%d/%m/%Y %H:%M:%S', time.localtime())
         log_msg = f'[{timestamp}] {mensagem}\n'
-        self.log_area.insert(tk.END, log_msg)
-        self.log_area.see(tk.END)
+        if self.log_area is not None:
+            self.log_area.insert(tk.END, log_msg)
+            self.log_area.see(tk.END)
         print(log_msg, end='')
 
     def validar_campos(self):
@@ -134,8 +289,13 @@ class Servidor:
             return
 
         host, port = dados
+        caminho_unix = self.unix_entry.get().strip() or None
+        self.perfil_rede = obter_perfil(self.perfil_var.get())
+        if self.gravar_rastro.get():
+            self.iniciar_rastro(redigir=not self.rastro_completo.get())
+
         self.thread_servidor = threading.Thread(
-            target=self.executar_servidor, args=(host, port)
+            target=self.executar_servidor, args=(host, port, caminho_unix)
         )
         self.thread_servidor.daemon = True
         self.thread_servidor.start()
@@ -143,7 +303,12 @@ class Servidor:
         self.servidor_rodando = True
         self.btn_iniciar.config(state=tk.DISABLED)
         self.btn_pausar.config(state=tk.NORMAL)
-        self.log(f'Servidor iniciado em {host}:{port}')
+        self.log(
+            f'Servidor iniciado em {host}:{port} '
+            f'(perfil de rede {self.perfil_rede.nome})'
+        )
+        if caminho_unix:
+            self.log(f'Servidor iniciado em {PREFIXO_UNIX}{caminho_unix}')
 
     def pausar_servidor(self):
         """Pausa a execução do servidor e fecha todas as conexões ativas"""
@@ -151,41 +316,238 @@ class Servidor:
             return
 
         self.servidor_rodando = False
-        if self.server:
-            try:
-                self.server.close()
-            except:
-                pass
+        for ouvinte in (self.server, self.server_unix):
+            if ouvinte:
+                try:
+                    ouvinte.close()
+                except:
+                    pass
+        self.despertar()
 
+        self.parar_rastro()
         self.log('Servidor pausado')
         self.btn_iniciar.config(state=tk.NORMAL)
         self.btn_pausar.config(state=tk.DISABLED)
 
-    def broadcast(self, sala, mensagem):
+    def iniciar_rastro(self, caminho=None, redigir=True):
+        """Começa a gravar o rastro binário de conexões e mensagens, usado para reproduzir a carga real em testes
+
+        Args:
+            caminho: Arquivo do rastro; por padrão, um arquivo com data e hora na pasta rastros do diretório base
+            redigir: Se True, grava apenas o tamanho das mensagens, sem o conteúdo
+        """
+        if caminho is None:
+            pasta = os.path.join(self.diretorio, 'rastros')
+            os.makedirs(pasta, exist_ok=True)
+            caminho = os.path.join(
+                pasta, time.strftime('rastro-%Y%m%d-%H%M%S.bin')
+            )
+
+        self.parar_rastro()
+        self.rastro = GravadorRastro(caminho, redigir)
+        self.log(f'Gravando rastro em {caminho}')
+
+    def parar_rastro(self):
+        """Encerra a gravação do rastro, se houver uma em andamento"""
+        if self.rastro is not None:
+            rastro, self.rastro = self.rastro, None
+            rastro.fechar()
+            self.log(f'Rastro gravado em {rastro.caminho}')
+
+    def broadcast(self, sala_id, mensagem):
         """Envia uma mensagem para todos os clientes em uma sala específica
 
+        Cada sessão recebe a codificação que negociou; texto e bytes soltos são enviados
+        como estão a todas.
+
         Args:
-            sala: Nome da sala
-            mensagem: Mensagem a ser enviada
+            sala_id: ID da sala na tabela de salas
+            mensagem: Carga, texto ou bytes a ser enviado
         """
-        if sala not in self.salas:
+        membros = self.salas.get(sala_id)
+        if not membros:
             return
 
-        clientes_para_remover = []
-        for cliente in self.salas[sala]:
+        if isinstance(mensagem, str):
+            mensagem = mensagem.encode()
+
+        with self.lock_salas:
+            sessoes = tuple(membros.values())
+
+        sessoes_para_remover = []
+        for sessao in sessoes:
             try:
-                if isinstance(mensagem, str):
-                    mensagem = mensagem.encode()
-                cliente.send(mensagem)
+                self.enviar(sessao, mensagem)
             except:
-                clientes_para_remover.append(cliente)
+                sessoes_para_remover.append(sessao)
+
+        if sessoes_para_remover:
+            with self.lock_salas:
+                for sessao in sessoes_para_remover:
+                    membros.pop(sessao.id, None)
+                if not membros:
+                    self.ciclo_salas.marcar_vazia(sala_id)
+
+    def codificar(self, sessao, carga):
+        """Escolhe os bytes de uma carga para uma sessão
+
+        No protocolo binário, os quadros são precedidos pela apresentação dos nomes que a
+        sessão ainda não conhece e, se a tabela dela está cheia, pelo esquecimento dos
+        menos usados. Chamar sob o lock de envio da sessão e confirmar a apresentação
+        depois do envio, ainda sob o lock.
+
+        Args:
+            sessao: Sessão de destino
+            carga: Carga, ou bytes enviados como estão
+
+        Returns:
+            tuple: (bytes a enviar, argumentos de NomesApresentados.confirmar ou None)
+        """
+        if not isinstance(carga, Carga):
+            return carga, None
+        conhecidos = sessao.nomes_enviados
+        if conhecidos is None:
+            return carga.texto, None
+        if not carga.nomes:
+            return carga.binario, None
+        novos, esquecidos = conhecidos.apresentar(carga.nomes)
+        if not novos:
+            return carga.binario, None
+        apresentacoes = b''.join(
+            quadro_nome(id_nome, nome) for id_nome, nome in novos
+        )
+        if esquecidos:
+            apresentacoes = quadro_esquecer(esquecidos) + apresentacoes
+        return apresentacoes + carga.binario, (novos, esquecidos)
+
+    def enviar(self, sessao, carga):
+        """Envia uma carga a uma única sessão, na codificação que ela negociou
+
+        O envio inteiro acontece sob o lock de envio da sessão, para que quadros de
+        threads diferentes não se intercalem no socket. Se o envio falha, inclusive por
+        passar PRAZO_ENVIO_SESSAO parado diante de um cliente que não lê, a conexão é
+        derrubada: o que foi escrito ficou pela metade, e a thread da sessão, ao ver o
+        socket fechado, a remove.
+
+        Args:
+            sessao: Sessão de destino
+            carga: Carga, ou bytes enviados como estão
+        """
+        with sessao.lock_envio:
+            dados, apresentados = self.codificar(sessao, carga)
+            try:
+                sessao.client.sendall(dados)
+            except OSError:
+                try:
+                    sessao.client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                raise
+            if apresentados:
+                sessao.nomes_enviados.confirmar(*apresentados)
+
+    def avisar_modo_entrega(self, sala_id, agrupando, taxa):
+        """Registra no log a troca do modo de entrega de uma sala
+
+        Args:
+            sala_id: ID da sala
+            agrupando: Se a sala passou a entregar as mensagens em lotes
+            taxa: Mensagens por segundo medidas, ou None
+        """
+        try:
+            sala = self.tabela_salas.obter_valor(sala_id)
+        except KeyError:
+            # A sala foi despejada depois da última medição
+            return
+        medida = f' ({taxa:.0f} msg/s)' if taxa is not None else ''
+        if agrupando:
+            self.log(
+                f'Sala {sala} passou a entregar em lotes de '
+                f'{self.entrega.intervalo * 1000:.0f} ms{medida}'
+            )
+        else:
+            self.log(f'Sala {sala} voltou à entrega imediata{medida}')
+
+    def recusar_conexao(self, client, addr, espera, binario=False):
+        """Recusa uma conexão por sobrecarga, sugerindo ao cliente quando tentar novamente
+
+        Args:
+            client: Socket do cliente
+            addr: Endereço do cliente
+            espera: Segundos que o cliente deve aguardar
+            binario: Se o cliente já negociou o protocolo binário
+        """
+        linha = f'{MARCADOR_TENTE_NOVAMENTE}{espera:.1f}'
+        try:
+            client.setblocking(False)
+            client.send(
+                quadro_controle(linha) if binario else codificar_linha(linha)
+            )
+        except:
+            pass
+        self.fechar_conexao(client)
+        if self.rastro is not None:
+            self.rastro.registrar_recusa()
+
+    def iniciar_atendimento(self, client, addr):
+        """Inicia a thread que atende uma conexão admitida, do handshake ao encerramento
+
+        Args:
+            client: Socket do cliente
+            addr: Endereço do cliente
+        """
+        thread_cliente = threading.Thread(
+            target=self.atender_conexao, args=(client, addr)
+        )
+        thread_cliente.daemon = True
+        try:
+            thread_cliente.start()
+        except RuntimeError:
+            # Sem thread, a conexão nunca passa pelo atendimento que a libera
+            self.admissao.concluir_handshake()
+            self.admissao.liberar(addr)
+            self.fechar_conexao(client)
 
-        for cliente in clientes_para_remover:
-            if cliente in self.salas[sala]:
-                self.salas[sala].remove(cliente)
+    def atender_conexao(self, client, addr):
+        """Atende uma conexão admitida e a libera no controle de admissão ao final
+
+        Args:
+            client: Socket do cliente
+            addr: Endereço do cliente
+        """
+        try:
+            self.processar_cliente(client, addr)
+        finally:
+            self.admissao.liberar(addr)
+
+    def ler_handshake(self, leitor):
+        """Lê as linhas de handshake do cliente
+
+        Args:
+            leitor: Leitor de linhas do socket do cliente
+
+        Antes da sala, o cliente pode enviar uma linha pedindo o protocolo binário e,
+        se volta de uma queda, uma linha com o token da sessão anterior.
+
+        Returns:
+            tuple: (sala, nome, token, binario); o nome é None em pedidos de lista de salas e de anexos, e a sala é None se o cliente desconectou
+        """
+        sala = leitor.ler_linha()
+        binario = sala == MARCADOR_BINARIO
+        if binario:
+            sala = leitor.ler_linha()
+        token = None
+        if sala is not None and sala.startswith(MARCADOR_RETOMAR):
+            token = sala[len(MARCADOR_RETOMAR) :]
+            sala = leitor.ler_linha()
+        if sala is None or sala == MARCADOR_LISTAR_SALAS:
+            return sala, None, token, binario
+        if sala.startswith((anexos.MARCADOR_ENVIAR, anexos.MARCADOR_BAIXAR)):
+            return sala, None, token, binario
+        return sala, leitor.ler_linha(), token, binario
 
     def processar_cliente(self, client, addr):
-        """Processa a conexão inicial de um cliente, determinando se é uma solicitação de lista de salas ou entrada em sala
+        """Processa a conexão de um cliente, determinando se é uma solicitação de lista de salas, de anexo ou entrada em sala
 
         Args:
             client: Socket do cliente
@@ -193,15 +555,41 @@ class Servidor:
         """
         try:
             self.log(f'{addr} se conectou ao Servidor')
-            client.send(b'SALA')
-            sala = client.recv(1024).decode()
+            # O handshake sai da contagem de pendentes em qualquer desfecho,
+            # inclusive quando a conexão cai já no primeiro envio
+            try:
+                client.settimeout(self.admissao.tempo_handshake)
+                client.sendall(codificar_linha(SOLICITACAO_SALA))
+                leitor = LeitorLinhas(client, TAMANHO_MAX_MENSAGEM)
+                sala, nome, token, binario = self.ler_handshake(leitor)
+            finally:
+                self.admissao.concluir_handshake()
+            client.settimeout(None)
+            if sala is None:
+                self.fechar_conexao(client)
+                return
 
-            if sala == '#LISTAR_SALAS#':
+            if sala.startswith(
+                (anexos.MARCADOR_ENVIAR, anexos.MARCADOR_BAIXAR)
+            ):
+                self.transferir_anexo(client, addr, sala)
+                return
+
+            if sala == MARCADOR_LISTAR_SALAS:
                 self.enviar_lista_salas(client, addr)
                 return
 
-            nome = client.recv(1024).decode()
-            self.adicionar_cliente_sala(client, nome, sala, addr)
+            if nome is None:
+                self.fechar_conexao(client)
+                return
+
+            # Um cliente que para de ler não prende quem envia para a sala dele
+            limitar_envio(client, PRAZO_ENVIO_SESSAO)
+            sessao = self.adicionar_cliente_sala(
+                client, nome, sala, addr, token, binario
+            )
+            if sessao is not None:
+                self.gerenciar_mensagens(sessao, leitor)
 
         except Exception as e:
             self.fechar_conexao(client)
@@ -213,69 +601,484 @@ class Servidor:
             client: Socket do cliente
             addr: Endereço do cliente
         """
-        client.recv(1024).decode()
-        salas_disponiveis = '|'.join(self.salas.keys())
-        client.send(salas_disponiveis.encode())
+        salas_disponiveis = '|'.join(self.listar_salas())
+        client.sendall(codificar_linha(salas_disponiveis))
         self.log(f'Lista de salas enviada para {addr}')
         client.close()
 
-    def adicionar_cliente_sala(self, client, nome, sala, addr):
-        """Adiciona um cliente a uma sala e inicia uma thread para gerenciar suas mensagens
+    def listar_salas(self):
+        """Retorna os nomes de todas as salas conhecidas pelo servidor"""
+        with self.lock_salas:
+            return [
+                self.tabela_salas.obter_valor(sala_id) for sala_id in self.salas
+            ]
+
+    def registrar_sessao(self, client, nome, sala, addr, binario=False):
+        """Cria a sessão do cliente, internando nome e sala, e a inclui nos membros da sala
 
         Args:
             client: Socket do cliente
             nome: Nome do usuário
             sala: Nome da sala
             addr: Endereço do cliente
+            binario: Se o cliente negociou o protocolo binário
+
+        Returns:
+            Sessao: Sessão registrada, com o lock de envio já adquirido para que nada chegue antes da saudação; ou None se a sala está lotada
         """
-        if sala not in self.salas:
-            self.salas[sala] = []
+        # Nome e sala são internados sob o lock das salas, o mesmo sob o qual
+        # remover_cliente e despejar_salas_vazias os liberam
+        with self.lock_salas:
+            sala_id = self.tabela_salas.obter_id(sala)
+            membros = self.salas.get(sala_id)
+            if membros is None:
+                membros = self.salas[sala_id] = {}
+            elif not self.admissao.admitir_na_sala(len(membros)):
+                return None
 
-        self.salas[sala].append(client)
-        self.log(f'{nome} se conectou na sala {sala} INFO {addr}')
-        self.broadcast(sala, f'{nome} Entrou na sala\n')
+            sessao = Sessao(
+                next(self.contador_sessoes),
+                client,
+                addr,
+                self.tabela_nomes.obter_id(nome),
+                sala_id,
+                binario=binario,
+            )
+            sessao.lock_envio.acquire()
+            membros[sessao.id] = sessao
+            self.usuarios.adicionar(sessao)
+            self.ciclo_salas.marcar_ocupada(sala_id)
+        return sessao
 
-        thread_cliente = threading.Thread(
-            target=self.gerenciar_mensagens, args=(nome, sala, client)
+    def transferir_anexo(self, client, addr, linha):
+        """Atende uma transferência de anexo, seja de envio ou de download
+
+        Args:
+            client: Socket do cliente
+            addr: Endereço do cliente
+            linha: Linha de cabeçalho da transferência
+        """
+        try:
+            anexos.priorizar_como_transferencia(client)
+            if linha.startswith(anexos.MARCADOR_ENVIAR):
+                self.receber_anexo(
+                    client,
+                    addr,
+                    anexos.ler_cabecalho(linha, anexos.MARCADOR_ENVIAR),
+                )
+            else:
+                self.enviar_anexo(
+                    client,
+                    addr,
+                    anexos.ler_cabecalho(linha, anexos.MARCADOR_BAIXAR),
+                )
+        except anexos.ErroAnexo as e:
+            self.log(f'Erro na transferência de anexo de {addr}: {e}')
+            try:
+                client.sendall(f'ERRO {e}\n'.encode())
+            except:
+                pass
+        except Exception as e:
+            self.log(f'Transferência de anexo de {addr} interrompida: {e}')
+        finally:
+            self.fechar_conexao(client)
+
+    def receber_anexo(self, client, addr, cabecalho):
+        """Recebe um anexo enviado pelo cliente, retomando do ponto já gravado, e o anuncia na sala
+
+        O envio vale só para uma sessão de chat conectada: o token dela define o
+        autor, a sala do anúncio e a cota usada, e o nome do arquivo passa pelos
+        filtros como uma mensagem.
+
+        Args:
+            client: Socket do cliente
+            addr: Endereço do cliente
+            cabecalho: Campos do cabeçalho de envio
+        """
+        id_anexo = anexos.validar_id(cabecalho.get('id'))
+        token = str(cabecalho.get('token', ''))
+        ativa = self.retomada.sessao_ativa(token)
+        if ativa is None:
+            raise anexos.ErroAnexo('Envio de anexo exige uma sessão ativa')
+        nome, _ = ativa
+        arquivo = (
+            os.path.basename(str(cabecalho.get('arquivo', ''))) or id_anexo
         )
-        thread_cliente.daemon = True
-        thread_cliente.start()
+        arquivo = self.filtros.processar(arquivo)
+        if arquivo is None:
+            raise anexos.ErroAnexo('Nome de arquivo bloqueado pelos filtros')
+        try:
+            tamanho = int(cabecalho.get('tamanho'))
+        except (TypeError, ValueError):
+            raise anexos.ErroAnexo('Tamanho de anexo inválido')
 
-    def gerenciar_mensagens(self, nome, sala, client):
-        """Gerencia o recebimento de mensagens de um cliente específico
+        ja_concluido = os.path.exists(self.anexos.caminho(id_anexo))
+        offset = self.anexos.iniciar_recebimento(
+            id_anexo, arquivo, tamanho, nome
+        )
+        try:
+            client.sendall(f'{offset}\n'.encode())
+            if ja_concluido:
+                client.sendall(b'OK\n')
+                return
+
+            if offset < tamanho:
+                self.log(
+                    f'Recebendo anexo {arquivo} de {addr} '
+                    f'a partir do byte {offset}'
+                )
+                anexos.receber_arquivo(
+                    client,
+                    self.anexos.caminho_parcial(id_anexo),
+                    tamanho - offset,
+                )
+            concluido = self.anexos.concluir(id_anexo)
+        finally:
+            self.anexos.encerrar_recebimento(id_anexo)
+        if not concluido:
+            self.log(
+                f'Anexo {arquivo} de {addr} incompleto, aguardando retomada'
+            )
+            return
+
+        client.sendall(b'OK\n')
+        self.log(f'Anexo {arquivo} ({tamanho} bytes) recebido de {addr}')
+        # O anúncio vai para a sala em que a sessão está ao fim do envio
+        ativa = self.retomada.sessao_ativa(token)
+        sala_id = ativa and self.tabela_salas.buscar_id(ativa[1])
+        if sala_id is not None:
+            # O autor pode já ter saído e não estar mais na tabela de nomes
+            id_nome = self.tabela_nomes.id_avulso(nome)
+            self.entrega.entregar(
+                sala_id,
+                Carga.evento(
+                    EVENTO_ANEXO,
+                    (id_nome, arquivo, tamanho, id_anexo),
+                    {id_nome: nome}.__getitem__,
+                ),
+            )
+
+    def enviar_anexo(self, client, addr, cabecalho):
+        """Transmite um anexo armazenado para o cliente a partir do deslocamento pedido
+
+        Args:
+            client: Socket do cliente
+            addr: Endereço do cliente
+            cabecalho: Campos do cabeçalho de download
+        """
+        caminho = self.anexos.caminho(cabecalho.get('id'))
+        if not os.path.exists(caminho):
+            raise anexos.ErroAnexo('Anexo não encontrado')
+
+        tamanho = os.path.getsize(caminho)
+        offset = cabecalho.get('offset', 0)
+        if not isinstance(offset, int) or not 0 <= offset <= tamanho:
+            raise anexos.ErroAnexo('Deslocamento inválido')
+
+        client.sendall(f'{tamanho}\n'.encode())
+        enviados = anexos.enviar_arquivo(client, caminho, offset)
+        self.log(f'{enviados} bytes de anexo enviados para {addr}')
+
+    def adicionar_cliente_sala(
+        self, client, nome, sala, addr, token=None, binario=False
+    ):
+        """Adiciona um cliente a uma sala e lhe envia a lista de membros, ou o recusa se a sala está lotada
+
+        Os demais membros são avisados da entrada no próximo tick da presença. O cliente
+        recebe o token da sessão e, se retomou uma sessão anterior, as mensagens que perdeu.
+        No protocolo binário, o primeiro quadro informa o ID da sala.
+
+        A entrada acontece sob o lock de publicação da sala: cada mensagem registrada
+        antes vai no reenvio, e cada uma registrada depois, ao vivo. Nenhuma entrega ao
+        vivo chega antes da saudação, que é escrita com o lock de envio da sessão tomado
+        desde o registro.
 
         Args:
+            client: Socket do cliente
             nome: Nome do usuário
             sala: Nome da sala
-            client: Socket do cliente
+            addr: Endereço do cliente
+            token: Token de uma sessão anterior, apresentado no handshake
+            binario: Se o cliente negociou o protocolo binário
+
+        Returns:
+            Sessao: Sessão do cliente, ou None se ele foi recusado
         """
+        with self.retomada.lock_publicacao(sala):
+            # O lote pendente foi registrado antes da entrada e vai só para quem
+            # já estava na sala
+            sala_id = self.tabela_salas.buscar_id(sala)
+            if sala_id is not None:
+                self.entrega.esvaziar(sala_id)
+            sessao = self.registrar_sessao(client, nome, sala, addr, binario)
+            if sessao is not None:
+                sessao.token, perdidas, fora_do_buffer = (
+                    self.retomada.abrir_sessao(nome, sala, token)
+                )
+        if sessao is None:
+            self.log(f'{nome} recusado: sala {sala} lotada INFO {addr}')
+            self.recusar_conexao(
+                client, addr, self.admissao.sugerir_espera(), binario
+            )
+            return None
+
+        self.log(f'{nome} se conectou na sala {sala} INFO {addr}')
+        if self.rastro is not None:
+            self.rastro.registrar_entrada(sessao.id, sala, nome)
+        try:
+            try:
+                self.enviar_saudacao(
+                    sessao, nome, sala, token, perdidas, fora_do_buffer
+                )
+            finally:
+                sessao.lock_envio.release()
+        except OSError:
+            self.remover_cliente(sessao)
+            return None
+        return sessao
+
+    def enviar_saudacao(
+        self, sessao, nome, sala, token, perdidas, fora_do_buffer
+    ):
+        """Envia à sessão que acabou de entrar a presença, o token e o reenvio; chamar com o lock de envio dela
+
+        Args:
+            sessao: Sessão que entrou
+            nome: Nome do usuário
+            sala: Nome da sala
+            token: Token apresentado no handshake
+            perdidas: Mensagens a reenviar, se a sessão foi retomada
+            fora_do_buffer: Mensagens perdidas que não puderam ser recuperadas
+        """
+        cargas = [
+            self.presenca.entrar(sessao.sala_id, nome),
+            Carga.controle(codificar_linha(MARCADOR_SESSAO + sessao.token)),
+        ]
+        if token == sessao.token:
+            self.log(
+                f'{nome} retomou a sessão na sala {sala}: '
+                f'{len(perdidas)} mensagem(ns) reenviada(s)'
+            )
+            if fora_do_buffer:
+                cargas.append(
+                    Carga.evento(EVENTO_NAO_RECUPERADAS, (fora_do_buffer,))
+                )
+            cargas.extend(perdidas)
+        dados, apresentados = self.codificar(sessao, Carga.juntar(cargas))
+        if sessao.nomes_enviados is not None:
+            dados = quadro_sala(sessao.sala_id, sala) + dados
+        sessao.client.sendall(dados)
+        if apresentados:
+            sessao.nomes_enviados.confirmar(*apresentados)
+
+    def gerenciar_mensagens(self, sessao, leitor):
+        """Gerencia o recebimento de mensagens de um cliente específico
+
+        Uma linha acima de TAMANHO_MAX_MENSAGEM encerra a conexão no leitor, antes
+        dos filtros, da entrega e do buffer de retomada.
+
+        Args:
+            sessao: Sessão do cliente
+            leitor: Leitor de linhas do socket do cliente
+        """
+        nome = self.tabela_nomes.obter_valor(sessao.nome_id)
+        sala = self.tabela_salas.obter_valor(sessao.sala_id)
         while self.servidor_rodando:
             try:
-                mensagem = client.recv(1024)
-                if not mensagem:
+                mensagem = leitor.ler_linha()
+                if mensagem is None:
                     break
+                if not mensagem:
+                    continue
+                if mensagem.startswith(busca.MARCADOR_BUSCAR):
+                    self.responder_busca(sessao, sala, mensagem)
+                    continue
+                if mensagem.startswith(diretas.MARCADOR_DIRETA):
+                    self.receber_direta(sessao, nome, mensagem)
+                    continue
+                if mensagem == MARCADOR_MEMBROS:
+                    self.enviar(
+                        sessao, self.presenca.obter_retrato(sessao.sala_id)
+                    )
+                    continue
+
+                # O rastro guarda a mensagem como o cliente a enviou
+                if self.rastro is not None:
+                    self.rastro.registrar_mensagem(sessao.id, mensagem)
+                mensagem = self.filtros.processar(mensagem)
+                if mensagem is None:
+                    self.enviar(sessao, Carga.evento(EVENTO_BLOQUEADA))
+                    continue
+                # Um @ que não cita ninguém da sala, como "@todos", não
+                # desvia a mensagem: ela segue para a sala como qualquer outra
+                mencoes = diretas.extrair_mencoes(mensagem)
+                if mencoes and self.enviar_direta(
+                    sessao, nome, mencoes, mensagem, sessao.sala_id
+                ):
+                    continue
 
-                mensagem_formatada = f'{nome}: {mensagem.decode()}\n'
-                self.log(f'[Sala {sala}] {mensagem_formatada.strip()}')
-                self.broadcast(sala, mensagem_formatada)
+                self.log(f'[Sala {sala}] {formatar_mensagem(nome, mensagem)}')
+                carga = Carga.mensagem(sessao.nome_id, nome, mensagem)
+                with self.retomada.lock_publicacao(sala):
+                    self.retomada.registrar_mensagem(sala, carga)
+                    self.entrega.entregar(sessao.sala_id, carga)
+                self.busca.indexar(sala, nome, mensagem)
             except:
                 break
 
-        self.remover_cliente(nome, sala, client)
+        self.remover_cliente(sessao)
 
-    def remover_cliente(self, nome, sala, client):
-        """Remove um cliente de uma sala e notifica os demais usuários
+    def receber_direta(self, sessao, nome, linha):
+        """Valida e filtra uma mensagem direta e a encaminha ao destinatário
 
         Args:
-            nome: Nome do usuário
+            sessao: Sessão do remetente
+            nome: Nome do remetente
+            linha: Linha iniciada por MARCADOR_DIRETA
+        """
+        try:
+            destinatario, texto = diretas.ler_pedido(linha)
+        except diretas.ErroDireta as e:
+            self.enviar(sessao, Carga.controle(codificar_linha(str(e))))
+            return
+        texto = self.filtros.processar(texto)
+        if texto is None:
+            self.enviar(sessao, Carga.evento(EVENTO_BLOQUEADA))
+            return
+        self.enviar_direta(sessao, nome, [destinatario], texto)
+
+    def enviar_direta(self, sessao, nome, destinatarios, texto, sala_id=None):
+        """Entrega uma mensagem apenas aos destinatários e às sessões do remetente
+
+        As sessões de cada destinatário vêm do índice de usuários, sem percorrer os
+        membros da sala. Mensagens diretas e menções não entram no buffer de retomada
+        nem no índice de busca da sala, que os demais membros podem consultar.
+
+        Args:
+            sessao: Sessão do remetente
+            nome: Nome do remetente
+            destinatarios: Nomes dos destinatários
+            texto: Texto já filtrado
+            sala_id: Se informado, só as sessões dos destinatários nesta sala recebem a mensagem, como nas menções
+
+        Returns:
+            bool: True se algum destinatário recebeu; numa menção em que nenhum está na sala, nada é enviado, nem o aviso de destinatários ausentes
+        """
+        encontrados = {}
+        ausentes = []
+        sessoes = {}
+        with self.lock_salas:
+            for destinatario in destinatarios:
+                id_nome = self.tabela_nomes.buscar_id(destinatario)
+                alvos = self.usuarios.sessoes(id_nome)
+                if sala_id is not None:
+                    alvos = [alvo for alvo in alvos if alvo.sala_id == sala_id]
+                if not alvos:
+                    ausentes.append(destinatario)
+                    continue
+                encontrados[id_nome] = destinatario
+                sessoes.update((alvo.id, alvo) for alvo in alvos)
+            if encontrados:
+                sessoes.update(
+                    (propria.id, propria)
+                    for propria in self.usuarios.sessoes(sessao.nome_id)
+                )
+
+        if not encontrados and sala_id is not None:
+            return False
+        if ausentes:
+            aviso = Carga.evento(EVENTO_SEM_DESTINO, (', '.join(ausentes),))
+            self.enviar(sessao, aviso)
+        if not encontrados:
+            return False
+
+        carga = Carga.direta(
+            sessao.nome_id,
+            nome,
+            list(encontrados),
+            list(encontrados.values()),
+            texto,
+        )
+        for alvo in sessoes.values():
+            try:
+                self.enviar(alvo, carga)
+            except OSError:
+                # A sessão sai pela sua própria thread ao perceber a falha
+                pass
+        self.log(
+            f'{nome} enviou mensagem direta a '
+            f'{", ".join(encontrados.values())} '
+            f'({len(sessoes)} sessão(ões))'
+        )
+        return True
+
+    def responder_busca(self, sessao, sala, linha):
+        """Busca no histórico da sala e envia os resultados apenas ao cliente que pediu
+
+        Args:
+            sessao: Sessão do cliente
             sala: Nome da sala
-            client: Socket do cliente
+            linha: Linha com o pedido de busca
+        """
+        try:
+            pedido = busca.ler_pedido(linha)
+        except busca.ErroBusca as e:
+            self.enviar(
+                sessao,
+                Carga.controle(
+                    codificar_linha(busca.montar_fim(0, erro=str(e)))
+                ),
+            )
+            return
+
+        inicio = time.perf_counter()
+        resultados, truncado = self.busca.buscar(sala, pedido)
+        resposta = b''.join(
+            codificar_linha(busca.montar_resultado(*resultado))
+            for resultado in resultados
+        )
+        resposta += codificar_linha(
+            busca.montar_fim(len(resultados), truncado)
+        )
+        self.enviar(sessao, Carga.controle(resposta))
+        self.log(
+            f'[Sala {sala}] Busca por {pedido["termos"]!r}: '
+            f'{len(resultados)} resultado(s) em '
+            f'{(time.perf_counter() - inicio) * 1000:.1f} ms'
+        )
+
+    def remover_cliente(self, sessao):
+        """Remove um cliente de uma sala; os demais usuários são notificados no próximo tick da presença
+
+        Args:
+            sessao: Sessão do cliente
         """
-        if sala in self.salas and client in self.salas[sala]:
-            self.salas[sala].remove(client)
+        with self.lock_salas:
+            # A sala pode já ter sido despejada, se uma falha de envio a deixou
+            # vazia, e uma remoção repetida já liberou o nome
+            nome = self.tabela_nomes.buscar_valor(sessao.nome_id)
+            sala = self.tabela_salas.buscar_valor(sessao.sala_id)
+            # O nome sai da tabela com a última sessão do usuário
+            if self.usuarios.remover(sessao):
+                self.tabela_nomes.liberar(sessao.nome_id)
+            membros = self.salas.get(sessao.sala_id)
+            removida = (
+                membros is not None
+                and membros.pop(sessao.id, None) is not None
+            )
+            if membros is not None and not membros:
+                self.ciclo_salas.marcar_vazia(sessao.sala_id)
+
+        # A sessão pode já ter sido tirada da sala por uma falha de envio no
+        # broadcast, mas continua na lista de membros até sair por aqui
+        if nome is not None:
+            self.presenca.sair(sessao.sala_id, nome)
+        self.retomada.fechar_sessao(sessao.token)
+        if removida:
             self.log(f'{nome} saiu da sala {sala}')
-            self.broadcast(sala, f'{nome}: Saiu da sala\n')
-        self.fechar_conexao(client)
+            if self.rastro is not None:
+                self.rastro.registrar_saida(sessao.id)
+        self.fechar_conexao(sessao.client)
 
     def fechar_conexao(self, client):
         """Fecha a conexão com um cliente
@@ -288,25 +1091,183 @@ class Servidor:
         except:
             pass
 
-    def executar_servidor(self, host, port):
+    def restaurar_estado(self):
+        """Recria as salas e os tokens de sessão a partir do último retrato gravado, uma única vez por processo"""
+        if self.estado_restaurado:
+            return
+        self.estado_restaurado = True
+
+        inicio = time.perf_counter()
+        try:
+            salas = self.retomada.carregar()
+        except Exception as e:
+            self.log(f'Retrato do estado ignorado: {e}')
+            return
+        if not salas:
+            return
+
+        with self.lock_salas:
+            for sala in salas:
+                sala_id = self.tabela_salas.obter_id(sala)
+                if not self.salas.setdefault(sala_id, {}):
+                    self.ciclo_salas.marcar_vazia(sala_id)
+        tokens = self.retomada.estatisticas()['tokens']
+        self.log(
+            f'Estado restaurado: {len(salas)} sala(s) e {tokens} sessão(ões) '
+            f'retomáveis em {(time.perf_counter() - inicio) * 1000:.1f} ms'
+        )
+
+    def despejar_salas_vazias(self, agora):
+        """Remove as salas que continuam vazias além do prazo, com o estado de entrega e o índice de busca delas
+
+        Args:
+            agora: Instante atual do relógio monotônico
+        """
+        with self.lock_salas:
+            despejadas = {
+                sala_id: self.tabela_salas.obter_valor(sala_id)
+                for sala_id in self.ciclo_salas.vencidas(agora)
+                if not self.salas.get(sala_id, True)
+            }
+            for sala_id in despejadas:
+                del self.salas[sala_id]
+                self.tabela_salas.liberar(sala_id)
+
+        for sala_id, sala in despejadas.items():
+            self.entrega.esquecer(sala_id)
+            self.busca.descartar(sala)
+            self.log(f'Sala {sala} removida após ficar vazia')
+
+    def abrir_socket_unix(self, caminho):
+        """Cria o socket Unix de escuta, removendo o arquivo deixado por uma execução anterior
+
+        Args:
+            caminho: Caminho do arquivo do socket
+
+        Returns:
+            socket.socket: Socket em escuta
+        """
+        try:
+            if stat.S_ISSOCK(os.stat(caminho).st_mode):
+                os.unlink(caminho)
+        except FileNotFoundError:
+            pass
+
+        ouvinte = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            ouvinte.bind(caminho)
+            self.escutar(ouvinte)
+        except OSError:
+            ouvinte.close()
+            raise
+        return ouvinte
+
+    def escutar(self, ouvinte):
+        """Aplica o perfil de rede a um socket de escuta já associado ao endereço e começa a escutar
+
+        Args:
+            ouvinte: Socket de escuta
+        """
+        backlog = ajustar_ouvinte(ouvinte, self.perfil_rede)
+        if backlog is None:
+            ouvinte.listen()
+        else:
+            ouvinte.listen(backlog)
+
+    def despertar(self):
+        """Acorda o loop de aceite para que ele perceba que o servidor parou
+
+        O loop espera no seletor sem prazo; sem este aviso, ele só voltaria a checar
+        servidor_rodando na próxima conexão.
+        """
+        despertador = self.despertador
+        if despertador is None:
+            return
+        try:
+            despertador.send(b'\0')
+        except OSError:
+            pass
+
+    def fechar_socket_unix(self, caminho):
+        """Fecha o socket Unix de escuta e remove o seu arquivo"""
+        if self.server_unix is None:
+            return
+        self.server_unix.close()
+        self.server_unix = None
+        try:
+            os.unlink(caminho)
+        except OSError:
+            pass
+
+    def aceitar_conexao(self, ouvinte, caminho_unix):
+        """Aceita uma conexão pendente num dos sockets de escuta e a encaminha ao atendimento
+
+        Conexões pelo socket Unix não têm IP; o endereço delas é unix: seguido do
+        caminho do socket, e todas contam como um mesmo endereço na admissão.
+
+        Args:
+            ouvinte: Socket de escuta pronto para leitura
+            caminho_unix: Caminho do socket Unix, ou None
+        """
+        try:
+            client, addr = ouvinte.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if ouvinte is self.server_unix:
+            addr = PREFIXO_UNIX + caminho_unix
+        ajustar_conexao(client, self.perfil_rede)
+        espera = self.admissao.admitir(addr)
+        if espera is not None:
+            self.recusar_conexao(client, addr, espera)
+            return
+        self.iniciar_atendimento(client, addr)
+
+    def executar_servidor(self, host, port, caminho_unix=None):
         """Executa o loop principal do servidor, aceitando novas conexões
 
+        Com caminho_unix, o servidor também escuta num socket Unix, para clientes na
+        mesma máquina; o protocolo é o mesmo nos dois sockets. Os sockets recebem as
+        opções de perfil_rede. O loop espera no seletor sem prazo, e despertar o acorda
+        quando o servidor para.
+
         Args:
             host: Endereço IP do servidor
             port: Porta do servidor
+            caminho_unix: Caminho do socket Unix, ou None para escutar apenas em TCP
         """
+        seletor = selectors.DefaultSelector()
+        acordar, self.despertador = socket.socketpair()
+        acordar.setblocking(False)
+        seletor.register(acordar, selectors.EVENT_READ)
         try:
+            self.restaurar_estado()
             self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server.bind((host, port))
-            self.server.listen()
-            self.server.settimeout(1)
+            self.escutar(self.server)
+            ouvintes = [self.server]
+            if caminho_unix:
+                self.server_unix = self.abrir_socket_unix(caminho_unix)
+                ouvintes.append(self.server_unix)
+            for ouvinte in ouvintes:
+                ouvinte.setblocking(False)
+                seletor.register(ouvinte, selectors.EVENT_READ)
+            # As pastas de estado são criadas aqui, antes do primeiro cliente
+            self.busca.iniciar()
+            self.presenca.iniciar()
+            self.retomada.iniciar()
+            self.anexos.iniciar()
+            self.filtro_termos.iniciar()
+            self.entrega.iniciar()
+            self.ciclo_salas.iniciar()
+            self.servidor_pronto.set()
 
             while self.servidor_rodando:
                 try:
-                    client, addr = self.server.accept()
-                    self.processar_cliente(client, addr)
-                except socket.timeout:
-                    continue
+                    for chave, _ in seletor.select():
+                        if chave.fileobj is acordar:
+                            acordar.recv(4096)
+                            continue
+                        self.aceitar_conexao(chave.fileobj, caminho_unix)
                 except:
                     if self.servidor_rodando:
                         continue
@@ -314,13 +1275,27 @@ class Servidor:
             if self.servidor_rodando:
                 self.log(f'Erro ao iniciar servidor: {str(e)}')
         finally:
+            self.servidor_pronto.clear()
+            seletor.close()
+            despertador, self.despertador = self.despertador, None
+            despertador.close()
+            acordar.close()
+            self.ciclo_salas.parar()
+            self.busca.parar()
+            self.presenca.parar()
+            self.entrega.parar()
+            self.retomada.parar()
+            self.anexos.parar()
+            self.filtro_termos.parar()
             if self.server:
                 self.server.close()
+            self.fechar_socket_unix(caminho_unix)
 
 
-try:
-    root = tk.Tk()
-    app = Servidor(root)
-    root.mainloop()
-except Exception as e:
-    print(f'❌ {e}')
+if __name__ == '__main__':
+    try:
+        root = tk.Tk()
+        app = Servidor(root)
+        root.mainloop()
+    except Exception as e:
+        print(f'❌ {e}')
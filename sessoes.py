@@ -0,0 +1,288 @@
+import itertools
+import sys
+import threading
+
+# Nomes que uma sessão binária guarda apresentados; além disso, os menos usados
+# recentemente são esquecidos e reapresentados se voltarem a aparecer
+CAPACIDADE_NOMES = 1024
+
+
+class TabelaInterna:
+    """Tabela de strings internadas, associando cada valor distinto a um ID inteiro estável
+
+    Valores liberados saem da tabela, mas seus IDs não são reutilizados: quem guardou
+    um ID, como uma sessão binária que já recebeu o nome, nunca o vê associado a outro
+    valor. Cada sessão guarda só os IDs recentes, em NomesApresentados.
+    """
+
+    __slots__ = ('_ids', '_valores', '_proximo', '_lock')
+
+    def __init__(self):
+        """Inicializa a tabela vazia"""
+        self._ids = {}
+        self._valores = {}
+        self._proximo = itertools.count()
+        self._lock = threading.Lock()
+
+    def obter_id(self, valor):
+        """Retorna o ID do valor, registrando-o na primeira ocorrência
+
+        Args:
+            valor: String a ser internada
+
+        Returns:
+            int: ID inteiro associado ao valor
+        """
+        id_valor = self._ids.get(valor)
+        if id_valor is not None:
+            return id_valor
+
+        with self._lock:
+            id_valor = self._ids.get(valor)
+            if id_valor is None:
+                id_valor = next(self._proximo)
+                valor = sys.intern(valor)
+                self._valores[id_valor] = valor
+                self._ids[valor] = id_valor
+            return id_valor
+
+    def buscar_id(self, valor):
+        """Retorna o ID do valor sem registrá-lo
+
+        Args:
+            valor: String procurada
+
+        Returns:
+            int: ID do valor, ou None se ele não está registrado
+        """
+        return self._ids.get(valor)
+
+    def id_avulso(self, valor):
+        """Retorna o ID do valor, ou um ID novo que não fica registrado
+
+        Serve a quem precisa citar um valor que pode já ter sido liberado, como o nome
+        de quem acabou de sair, sem trazê-lo de volta à tabela.
+
+        Args:
+            valor: String procurada
+
+        Returns:
+            int: ID do valor, ou um ID nunca usado antes
+        """
+        id_valor = self._ids.get(valor)
+        if id_valor is not None:
+            return id_valor
+        with self._lock:
+            return next(self._proximo)
+
+    def obter_valor(self, id_valor):
+        """Retorna a string associada a um ID
+
+        Args:
+            id_valor: ID inteiro obtido por obter_id e ainda não liberado
+
+        Returns:
+            str: Valor internado
+        """
+        return self._valores[id_valor]
+
+    def buscar_valor(self, id_valor):
+        """Retorna a string associada a um ID sem exigir que ele ainda esteja registrado
+
+        Args:
+            id_valor: ID inteiro obtido por obter_id
+
+        Returns:
+            str: Valor internado, ou None se o ID já foi liberado
+        """
+        return self._valores.get(id_valor)
+
+    def liberar(self, id_valor):
+        """Tira um valor da tabela; seu ID não volta a ser usado
+
+        Args:
+            id_valor: ID do valor; IDs já liberados são ignorados
+        """
+        with self._lock:
+            valor = self._valores.pop(id_valor, None)
+            if valor is not None:
+                del self._ids[valor]
+
+    def __contains__(self, valor):
+        return valor in self._ids
+
+    def __len__(self):
+        return len(self._valores)
+
+
+class NomesApresentados:
+    """IDs de nomes já apresentados a uma sessão binária, limitados aos usados mais recentemente
+
+    Como os IDs não são reutilizados, a rotatividade de usuários faria a tabela crescer
+    sem limite, no servidor e no cliente. Passada a capacidade, os IDs menos usados
+    saem daqui e o cliente recebe um quadro para esquecê-los; um ID esquecido que
+    volte a ser citado é apresentado de novo. Usar sob o lock de envio da sessão.
+    """
+
+    __slots__ = ('_ids', 'capacidade')
+
+    def __init__(self, capacidade=CAPACIDADE_NOMES):
+        """Inicializa a tabela vazia
+
+        Args:
+            capacidade: Quantidade de IDs guardados antes de esquecer os mais antigos
+        """
+        # Dicionário usado como lista ordenada: do menos ao mais recentemente usado
+        self._ids = {}
+        self.capacidade = capacidade
+
+    def apresentar(self, nomes):
+        """Marca os nomes citados por um envio como usados e separa o que falta apresentar
+
+        Os IDs esquecidos nunca estão entre os citados, que o cliente precisa conhecer
+        ao ler o envio; se o envio cita mais nomes que a capacidade, a tabela passa
+        dela até o próximo envio.
+
+        Args:
+            nomes: Pares (ID, nome) citados pelo envio
+
+        Returns:
+            tuple: (pares ainda não apresentados, IDs a esquecer), a confirmar depois do envio
+        """
+        ids = self._ids
+        novos = []
+        for par in nomes:
+            if par[0] in ids:
+                ids[par[0]] = ids.pop(par[0])
+            else:
+                novos.append(par)
+        excesso = len(ids) + len(novos) - self.capacidade
+        if not novos or excesso <= 0:
+            return novos, ()
+        # Os citados já conhecidos acabaram de ir para o fim
+        livres = len(ids) - (len(nomes) - len(novos))
+        return novos, list(itertools.islice(ids, min(excesso, livres)))
+
+    def confirmar(self, novos, esquecidos):
+        """Registra o resultado de apresentar depois que o envio foi feito
+
+        Args:
+            novos: Pares (ID, nome) apresentados
+            esquecidos: IDs que o cliente foi instruído a esquecer
+        """
+        ids = self._ids
+        for id_nome in esquecidos:
+            del ids[id_nome]
+        for id_nome, _ in novos:
+            ids[id_nome] = None
+
+    def __contains__(self, id_nome):
+        return id_nome in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class Sessao:
+    """Estado compacto de uma conexão de chat ativa"""
+
+    __slots__ = (
+        'id',
+        'client',
+        'addr',
+        'nome_id',
+        'sala_id',
+        'token',
+        'nomes_enviados',
+        'lock_envio',
+    )
+
+    def __init__(
+        self,
+        id_sessao,
+        client,
+        addr,
+        nome_id,
+        sala_id,
+        token=None,
+        binario=False,
+    ):
+        """Inicializa a sessão
+
+        Args:
+            id_sessao: Identificador único da sessão no servidor
+            client: Socket do cliente
+            addr: Endereço do cliente
+            nome_id: ID do nome do usuário na tabela de nomes
+            sala_id: ID da sala na tabela de salas
+            token: Token de retomada da sessão
+            binario: Se a sessão negociou o protocolo binário
+        """
+        self.id = id_sessao
+        self.client = client
+        self.addr = addr
+        self.nome_id = nome_id
+        self.sala_id = sala_id
+        self.token = token
+        # IDs de nomes já apresentados à sessão; None no protocolo de texto
+        self.nomes_enviados = NomesApresentados() if binario else None
+        # A thread do cliente, a presença e a entrega escrevem no mesmo socket
+        self.lock_envio = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f'Sessao(id={self.id}, nome_id={self.nome_id}, '
+            f'sala_id={self.sala_id})'
+        )
+
+
+class IndiceUsuarios:
+    """Sessões ativas de cada usuário, indexadas pelo ID do nome
+
+    Um mesmo usuário pode ter várias sessões, em salas diferentes ou na mesma sala.
+    O índice é protegido pelo lock das salas do servidor, sob o qual todos os métodos
+    devem ser chamados.
+    """
+
+    __slots__ = ('_sessoes',)
+
+    def __init__(self):
+        """Inicializa o índice vazio"""
+        self._sessoes = {}
+
+    def adicionar(self, sessao):
+        """Inclui uma sessão nas do seu usuário"""
+        sessoes = self._sessoes.get(sessao.nome_id)
+        if sessoes is None:
+            sessoes = self._sessoes[sessao.nome_id] = {}
+        sessoes[sessao.id] = sessao
+
+    def remover(self, sessao):
+        """Retira uma sessão, esquecendo o usuário quando ela era a última
+
+        Returns:
+            bool: True se o usuário ficou sem sessões nesta chamada
+        """
+        sessoes = self._sessoes.get(sessao.nome_id)
+        if sessoes is None:
+            return False
+        sessoes.pop(sessao.id, None)
+        if not sessoes:
+            del self._sessoes[sessao.nome_id]
+            return True
+        return False
+
+    def sessoes(self, nome_id):
+        """Retorna as sessões ativas de um usuário
+
+        Args:
+            nome_id: ID do nome do usuário
+
+        Returns:
+            tuple: Sessões do usuário; vazia se ele não está conectado
+        """
+        sessoes = self._sessoes.get(nome_id)
+        return tuple(sessoes.values()) if sessoes else ()
+
+    def __len__(self):
+        return len(self._sessoes)
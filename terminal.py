@@ -0,0 +1,444 @@
+"""Cliente de chat para terminal e pipes, sem interface gráfica
+
+Cada linha lida da entrada padrão é enviada como mensagem, e cada mensagem
+recebida da sala é escrita na saída padrão. Avisos de conexão vão para a saída
+de erro, de modo que a saída padrão contenha apenas as mensagens do chat.
+
+Linhas iniciadas por /buscar pesquisam o histórico da sala, por exemplo
+"/buscar deploy desde:2024-05-01 ate:2024-05-02T18:00", e a linha /membros
+lista quem está na sala; as respostas também vão para a saída padrão.
+
+Linhas no formato "/msg NOME TEXTO" vão apenas para o usuário NOME, e
+mensagens que começam por menções, como "@ana @bia podem revisar?", apenas
+para os mencionados que estão na sala.
+
+Processos na mesma máquina que o servidor, como bots, podem usar o socket Unix
+dele no lugar de HOST e PORTA, com o endereço unix:/caminho/do/socket.
+
+Uso:
+    python terminal.py HOST PORTA NOME SALA [--reconectar] [--permanecer] [--perfil baixa-latencia]
+    python terminal.py unix:/caminho/do/socket NOME SALA
+    python terminal.py HOST PORTA --listar-salas
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+
+import busca
+import diretas
+from perfis_rede import PERFIL_PADRAO, PERFIS, obter_perfil
+from presenca import MARCADOR_MEMBROS, ListaMembros
+from protocolo import (
+    MARCADOR_LISTAR_SALAS,
+    PREFIXO_UNIX,
+    TAMANHO_LEITURA,
+    TAMANHO_MAX_MENSAGEM,
+    ConexaoChat,
+    ErroProtocolo,
+    LeitorLinhas,
+    LoopSelectores,
+    calcular_espera_reconexao,
+    formatar_endereco,
+)
+from retomada import MARCADOR_RETOMAR, MARCADOR_SESSAO
+
+
+class EntradaPadrao:
+    """Linhas da entrada padrão entregues ao loop de eventos
+
+    Uma thread lê a entrada padrão e repassa os bytes por um par de sockets, já que
+    nem todas as plataformas permitem monitorar a entrada padrão com selectors.
+    """
+
+    def __init__(self, loop, ao_receber, ao_terminar):
+        """Inicializa a entrada e começa a ler a entrada padrão
+
+        Args:
+            loop: Loop de eventos com os métodos registrar e remover
+            ao_receber: Função chamada com cada linha lida
+            ao_terminar: Função chamada quando a entrada padrão termina
+        """
+        self.loop = loop
+        self.ao_receber = ao_receber
+        self.ao_terminar = ao_terminar
+        self.leitor = LeitorLinhas()
+        # Resto de uma linha longa demais, descartado até a próxima quebra
+        self.descartando = False
+        self.sock, self.escrita = socket.socketpair()
+        self.sock.setblocking(False)
+        self.aberta = True
+        self.loop.registrar(self)
+        threading.Thread(target=self.copiar_entrada, daemon=True).start()
+
+    def copiar_entrada(self):
+        """Copia a entrada padrão para o par de sockets até o fim do arquivo"""
+        # os.read evita o lock do buffer de sys.stdin, que impediria o
+        # interpretador de encerrar enquanto a thread aguarda a entrada
+        try:
+            while True:
+                dados = os.read(sys.stdin.fileno(), TAMANHO_LEITURA)
+                if not dados:
+                    break
+                self.escrita.sendall(dados)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.escrita.close()
+
+    def quer_escrever(self):
+        return False
+
+    def processar_leitura(self):
+        """Entrega as linhas completas recebidas da thread de leitura"""
+        try:
+            dados = self.sock.recv(TAMANHO_LEITURA)
+        except (BlockingIOError, InterruptedError):
+            return
+
+        if not dados:
+            if self.leitor.buffer:
+                self.ao_receber(self.leitor.buffer.decode(errors='replace'))
+            self.fechar()
+            self.ao_terminar()
+            return
+
+        # Cada pedaço termina em no máximo uma quebra de linha, para que uma linha
+        # longa demais seja descartada sem levar as vizinhas junto
+        pedacos = dados.split(b'\n')
+        for pedaco in pedacos[:-1]:
+            self.alimentar(pedaco + b'\n')
+        if pedacos[-1]:
+            self.alimentar(pedacos[-1])
+
+    def alimentar(self, pedaco):
+        """Passa ao leitor um pedaço com no máximo uma quebra de linha, no final
+
+        Args:
+            pedaco: Bytes lidos da entrada padrão
+        """
+        fim_de_linha = pedaco.endswith(b'\n')
+        if self.descartando:
+            self.descartando = not fim_de_linha
+            return
+        try:
+            linhas = self.leitor.alimentar(pedaco)
+        except ErroProtocolo as e:
+            self.leitor.buffer.clear()
+            self.descartando = not fim_de_linha
+            avisar(f'Linha da entrada ignorada: {e}')
+            return
+        for linha in linhas:
+            self.ao_receber(linha)
+
+    def fechar(self):
+        """Deixa de monitorar a entrada"""
+        if self.aberta:
+            self.aberta = False
+            self.loop.remover(self)
+            self.sock.close()
+
+
+class ClienteTerminal:
+    """Cliente de chat que liga a entrada e a saída padrão a uma sala"""
+
+    def __init__(
+        self,
+        host,
+        port,
+        nome,
+        sala,
+        reconectar=False,
+        permanecer=False,
+        perfil=None,
+    ):
+        """Inicializa o cliente
+
+        Args:
+            host: Endereço do servidor, ou unix: seguido do caminho do socket
+            port: Porta do servidor, ignorada em endereços unix:
+            nome: Nome do usuário
+            sala: Sala de chat
+            reconectar: Se True, volta à sala após quedas em vez de encerrar
+            permanecer: Se True, continua recebendo mensagens após o fim da entrada padrão
+            perfil: PerfilRede da conexão, ou None para as opções padrão
+        """
+        self.host = host
+        self.port = port
+        self.nome = nome
+        self.sala = sala
+        self.reconectar = reconectar
+        self.permanecer = permanecer
+        self.perfil = perfil
+        self.loop = LoopSelectores()
+        self.conexao = None
+        self.membros = ListaMembros()
+        self.token_sessao = None
+        self.tentativas_reconexao = 0
+        self.fim_entrada = False
+        self.rodando = True
+        self.codigo_saida = 0
+
+    def executar(self):
+        """Conecta à sala e conduz o loop de eventos até o cliente encerrar
+
+        Returns:
+            int: Código de saída do processo
+        """
+        self.conectar_servidor()
+        EntradaPadrao(
+            self.loop, self.enviar_mensagem, self.ao_terminar_entrada
+        )
+        while self.rodando:
+            self.loop.executar_uma_vez(0.5)
+            if self.fim_entrada and not self.permanecer:
+                self.encerrar_se_enviado()
+        return self.codigo_saida
+
+    def conectar_servidor(self):
+        """Inicia a conexão não bloqueante com o servidor"""
+        self.membros = ListaMembros()
+        handshake = [self.sala, self.nome]
+        if self.token_sessao:
+            handshake.insert(0, MARCADOR_RETOMAR + self.token_sessao)
+        self.conexao = ConexaoChat(
+            self.loop,
+            self.host,
+            self.port,
+            handshake=handshake,
+            ao_conectar=self.ao_conectar,
+            ao_receber=self.exibir_mensagem,
+            ao_desconectar=self.ao_desconectar,
+            perfil=self.perfil,
+        )
+        self.conexao.iniciar()
+
+    def ao_conectar(self):
+        """Registra a conclusão do handshake"""
+        self.tentativas_reconexao = 0
+        avisar(
+            f'Conectado à sala {self.sala} em '
+            f'{formatar_endereco(self.host, self.port)}'
+        )
+
+    def exibir_mensagem(self, linha):
+        """Escreve uma mensagem recebida na saída padrão"""
+        if linha.startswith(MARCADOR_SESSAO):
+            self.token_sessao = linha[len(MARCADOR_SESSAO) :]
+            return
+        if self.membros.processar(linha) is not None:
+            if self.membros.pedir_retrato() and self.conexao is not None:
+                self.conexao.enviar_linha(MARCADOR_MEMBROS)
+            return
+
+        resposta = busca.ler_resposta(linha)
+        if resposta is not None:
+            tipo, dados = resposta
+            if tipo == 'fim':
+                self.concluir_busca(dados)
+                return
+            linha = busca.formatar_resultado(dados)
+        sys.stdout.write(linha + '\n')
+        sys.stdout.flush()
+
+    def enviar_mensagem(self, linha):
+        """Envia uma linha da entrada padrão como mensagem, como busca se iniciada por /buscar ou como mensagem direta se iniciada por /msg"""
+        mensagem = linha.strip()
+        if not mensagem or self.conexao is None:
+            return
+
+        comando = mensagem.split(maxsplit=1)[0]
+        if comando == '/membros':
+            self.exibir_membros()
+            return
+        if comando == '/buscar':
+            try:
+                pedido = busca.interpretar_consulta(mensagem[len('/buscar') :])
+            except busca.ErroBusca as e:
+                avisar(str(e))
+                return
+            mensagem = busca.montar_pedido(pedido)
+        elif comando == diretas.COMANDO_DIRETA:
+            try:
+                destinatario, texto = diretas.interpretar_comando(mensagem)
+            except diretas.ErroDireta as e:
+                avisar(str(e))
+                return
+            mensagem = diretas.montar_pedido(destinatario, texto)
+        # O servidor encerra a conexão de quem envia uma linha acima do limite
+        if len(mensagem.encode()) > TAMANHO_MAX_MENSAGEM:
+            avisar(
+                'Mensagem excede o tamanho máximo de '
+                f'{TAMANHO_MAX_MENSAGEM} bytes'
+            )
+            return
+        self.conexao.enviar_linha(mensagem)
+
+    def exibir_membros(self):
+        """Escreve na saída padrão os membros atuais da sala, um por linha"""
+        for nome in sorted(self.membros.membros):
+            sys.stdout.write(nome + '\n')
+        sys.stdout.flush()
+        avisar(f'{len(self.membros.membros)} membro(s) na sala {self.sala}')
+
+    def concluir_busca(self, dados):
+        """Informa o fim dos resultados de uma busca"""
+        if dados.get('erro'):
+            avisar(f'Busca recusada: {dados["erro"]}')
+        elif dados.get('truncado'):
+            avisar(
+                f'{dados.get("total", 0)} resultado(s); busca interrompida, '
+                'refine os termos ou o período'
+            )
+        else:
+            avisar(f'{dados.get("total", 0)} resultado(s)')
+
+    def ao_terminar_entrada(self):
+        """Marca o fim da entrada padrão"""
+        self.fim_entrada = True
+
+    def encerrar_se_enviado(self):
+        """Encerra o cliente quando as mensagens pendentes já foram enviadas"""
+        conexao = self.conexao
+        if conexao is None:
+            self.rodando = False
+        elif conexao.conectada and not conexao.quer_escrever():
+            conexao.fechar()
+            self.conexao = None
+            self.rodando = False
+
+    def ao_desconectar(self, erro):
+        """Trata o encerramento da conexão, reconectando se configurado
+
+        Args:
+            erro: Motivo do encerramento
+        """
+        tentar_apos = self.conexao.tentar_apos if self.conexao else None
+        self.conexao = None
+        avisar(erro)
+        if not self.reconectar or (self.fim_entrada and not self.permanecer):
+            self.codigo_saida = 1
+            self.rodando = False
+            return
+
+        espera = calcular_espera_reconexao(
+            self.tentativas_reconexao, tentar_apos
+        )
+        self.tentativas_reconexao += 1
+        avisar(
+            f'Reconectando em {espera:.1f}s '
+            f'(tentativa {self.tentativas_reconexao})...'
+        )
+        self.loop.agendar(espera, self.conectar_servidor)
+
+
+def listar_salas(host, port):
+    """Escreve na saída padrão as salas disponíveis no servidor, uma por linha
+
+    Returns:
+        int: Código de saída do processo
+    """
+    loop = LoopSelectores()
+    resultado = {'codigo': 1, 'rodando': True}
+
+    def receber_lista(linha):
+        for sala in filter(None, linha.split('|')):
+            sys.stdout.write(sala + '\n')
+        sys.stdout.flush()
+        resultado['codigo'] = 0
+        conexao.fechar()
+        resultado['rodando'] = False
+
+    def ao_desconectar(erro):
+        avisar(erro)
+        resultado['rodando'] = False
+
+    conexao = ConexaoChat(
+        loop,
+        host,
+        port,
+        handshake=(MARCADOR_LISTAR_SALAS,),
+        ao_receber=receber_lista,
+        ao_desconectar=ao_desconectar,
+    )
+    conexao.iniciar()
+    while resultado['rodando']:
+        loop.executar_uma_vez(0.5)
+    return resultado['codigo']
+
+
+def avisar(mensagem):
+    """Escreve um aviso do cliente na saída de erro"""
+    print(mensagem, file=sys.stderr, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        'host', help='endereço do servidor, ou unix:/caminho/do/socket'
+    )
+    parser.add_argument(
+        'port',
+        nargs='?',
+        help='porta do servidor; omitida em endereços unix:',
+    )
+    parser.add_argument('nome', nargs='?', help='nome do usuário')
+    parser.add_argument('sala', nargs='?', help='sala de chat')
+    parser.add_argument(
+        '--listar-salas',
+        action='store_true',
+        help='lista as salas disponíveis e encerra',
+    )
+    parser.add_argument(
+        '--reconectar',
+        action='store_true',
+        help='volta à sala após quedas em vez de encerrar',
+    )
+    parser.add_argument(
+        '--permanecer',
+        action='store_true',
+        help='continua recebendo mensagens após o fim da entrada padrão',
+    )
+    parser.add_argument(
+        '--perfil',
+        choices=list(PERFIS),
+        default=PERFIL_PADRAO,
+        help='opções de socket da conexão',
+    )
+    args = parser.parse_args()
+
+    if args.host.startswith(PREFIXO_UNIX):
+        # Sem porta, os argumentos posicionais chegam deslocados
+        if args.sala is None:
+            args.port, args.nome, args.sala = 0, args.port, args.nome
+        args.port = 0
+    else:
+        try:
+            args.port = int(args.port)
+        except (TypeError, ValueError):
+            parser.error('informe uma PORTA numérica')
+
+    if args.listar_salas:
+        return listar_salas(args.host, args.port)
+    if not args.nome or not args.sala:
+        parser.error('informe NOME e SALA, ou use --listar-salas')
+
+    cliente = ClienteTerminal(
+        args.host,
+        args.port,
+        args.nome,
+        args.sala,
+        reconectar=args.reconectar,
+        permanecer=args.permanecer,
+        perfil=obter_perfil(args.perfil),
+    )
+    try:
+        return cliente.executar()
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())